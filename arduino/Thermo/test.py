@@ -1,41 +1,152 @@
-import serial
+# -*- coding: utf-8 -*-
+"""
+Stress tests of the thermostat's RPC server using the app's client, over the
+serial port of a board plugged in over USB or over TCP. Many requests are
+kept in flight at once and each must get it's own response while the
+notifications keep flowing.
+
+The emulator can stand in for the board, run it with --serial and pass the
+pseudo terminal it prints as the address.
+
+Usage:
+
+    python test.py [--address /dev/ttyACM0@115200] [--count 100]
+                   [--concurrency 10]
+
+"""
+import os
+import sys
 import json
+import time
+import logging
+import argparse
 
-class Thermostat(serial.Serial):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
 
-    def query(self,cmd,raw=False):
-        self.write(cmd if raw else json.dumps(cmd))
-        r = self.read(1)
-        assert r, "FAIL: NO RESPONSE"
-        r = r+self.read(self.inWaiting())
-        print r
-        return json.loads(r)
+from atom.api import Instance, Int
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, DeferredList, DeferredSemaphore, TimeoutError, inlineCallbacks
+)
+from twisted.internet.task import deferLater
+from client import Thermostat, RPCError, connect
 
 
-def testStress():
-    t = Thermostat('/dev/ttyACM0',115200)
-    try:
-        for i in range(100):
-            t.query({'method':'toggleLed','params':{'status':True},'id':i})
-            t.query({'method':'noid','params':{'status':False}})
-            t.query({'id':'nomethod','params':{'status':False}})
-            t.query({'method':'toggleLed','params':{'status':False},'id':i})
-            t.query({'method':'crap','params':{'status':False},'id':i})
-            t.query({'method':'getMeasuredTemp','id':i})
-        print "Test PASSED!!!"
-    finally:
-        t.close()
-        
-def testBadCmd():
-    t = Thermostat('/dev/ttyACM0',115200)
+class TestThermostat(Thermostat):
+    """ Fires ready when connected and counts the notifications """
+
+    ready = Instance(object).tag(local=True)
+    notifications = Int().tag(local=True)
+
+    def _default_ready(self):
+        return Deferred()
+
+    @inlineCallbacks
+    def onConnect(self):
+        yield super(TestThermostat, self).onConnect()
+        if not self.ready.called:
+            self.ready.callback(self._protocol)
+
+    def onNotify(self, change):
+        self.notifications += 1
+        super(TestThermostat, self).onNotify(change)
+
+
+@inlineCallbacks
+def testStress(protocol, count, concurrency):
+    """ Run rounds of requests with the given number of rounds in flight """
+    semaphore = DeferredSemaphore(concurrency)
+
+    @inlineCallbacks
+    def run(i):
+        state = yield protocol.getState()
+        assert 'insideTemp' in state, "FAIL: INVALID STATE {}".format(state)
+        led = bool(i % 2)
+        state = yield protocol.setState(ledActive=led)
+        assert state['ledActive'] == led, "FAIL: LED NOT SET"
+        try:
+            yield protocol.crap(status=False)
+            raise AssertionError("FAIL: UNKNOWN METHOD SUCCEEDED")
+        except RPCError:
+            pass
+
+    start = time.time()
+    results = yield DeferredList([semaphore.run(run, i)
+                                  for i in range(count)], consumeErrors=True)
+    failures = [r for ok, r in results if not ok]
+    for failure in failures[:5]:
+        print(failure.getErrorMessage())
+    assert not failures, "FAIL: {} of {} rounds failed".format(
+        len(failures), count)
+    elapsed = time.time()-start
+    print("{} requests in {:0.2f}s ({:0.0f}/s)".format(
+        count*3, elapsed, count*3/elapsed))
+    print("Test PASSED!!!")
+
+
+@inlineCallbacks
+def testBadCmd(protocol):
+    """ Invalid requests must not break the server. They are sent one at a
+    time since the firmware's responses to them can't be matched to a
+    request.
+
+    """
+    for msg in ('this is not json',
+                {'method': 'getState'},
+                {'id': 'nomethod', 'params': {'status': False}},
+                {'method': 'crap', 'params': {'status': False}, 'id': 1}):
+        if not isinstance(msg, str):
+            msg = json.dumps(msg)
+        protocol.transport.write(msg.encode('utf-8'))
+        yield deferLater(reactor, 0.5, lambda: None)
+        state = yield protocol.getState()
+        assert 'insideTemp' in state, "FAIL: NO STATE AFTER {}".format(msg)
+    print("Test PASSED!!!")
+
+
+@inlineCallbacks
+def run(args):
+    t = TestThermostat(heartbeatInterval=5)
+    connector = connect(args.address, t)
     try:
-        for i in range(1):
-            t.query({'method':'getMeasuredTemp','id':i})
-            t.query('this is not json',raw=True)
-            t.query({'method':'getMeasuredTemp','id':i})
-        print "Test PASSED!!!"
+        try:
+            protocol = yield t.ready.addTimeout(args.timeout, reactor)
+        except TimeoutError:
+            raise AssertionError("FAIL: NOT CONNECTED ({})".format(t.status))
+        yield testStress(protocol, args.count, args.concurrency)
+        yield testBadCmd(protocol)
+        print("{} notifications received".format(t.notifications))
+    except Exception as e:
+        print(e)
+        args.failed = True
     finally:
-        t.close()
-    
-if __name__=='__main__':
-    test()
\ No newline at end of file
+        t.stopTrying()
+        connector.disconnect()
+        reactor.stop()
+
+
+def main():
+    doc = __doc__.strip().split("\n\n")[0]
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('--address', default='/dev/ttyACM0@115200',
+                        help="Serial device (with an optional baud rate) or "
+                             "host:port")
+    parser.add_argument('--count', type=int, default=100,
+                        help="Number of rounds of requests")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="Rounds in flight at once")
+    parser.add_argument('--timeout', type=float, default=10,
+                        help="Seconds to wait for the connection")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+    args.failed = False
+    reactor.callWhenRunning(run, args)
+    reactor.run()
+    sys.exit(1 if args.failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the per call overhead of RPCProtocol with each installed codec. A
+call is a getState request and it's response, the transport is in memory
+so only the client's own work is measured (stub, encoding, framing,
+decoding and dispatching).
+
+The "uncached" row is the stdlib json codec with a stub built on every
+call, like attribute lookups did before the stubs were cached.
+
+Usage:
+
+    python benchmarks/bench_codecs.py [--calls 10000] [--repeat 5]
+
+"""
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from client import RPCProtocol, log
+from codec import available, lookup
+from bench_framing import STATE
+
+
+class MemoryTransport(object):
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def loseConnection(self):
+        pass
+
+
+class BenchProtocol(RPCProtocol):
+    def __init__(self, codec):
+        super(BenchProtocol, self).__init__(codec)
+        self.transport = MemoryTransport()
+        self.results = 0
+
+    def uncached(self, method):
+        """ Build a stub for every call """
+        @inlineCallbacks
+        def call(*args, **kwargs):
+            request = self._buildRequest(method, args, kwargs)
+            log.info("request: %s", request)
+            response = yield self.sendRequest(request)
+            log.info("response: %s", response)
+            returnValue(self._getResult(response))
+        return call
+
+    def done(self, result):
+        self.results += 1
+
+
+def responses(codec, n):
+    """ Encoded getState responses for request ids 1 to n """
+    return [codec.encode({'jsonrpc': '2.0', 'id': i+1, 'result': STATE})
+            for i in range(n)]
+
+
+def run(codec, data, cached=True):
+    p = BenchProtocol(codec)
+    for response in data:
+        if cached:
+            d = p.getState()
+        else:
+            d = p.uncached('getState')()
+        p.dataReceived(response)
+        d.addCallback(p.done)
+    assert p.results == len(data), (codec, p.results)
+    return p
+
+
+def main():
+    doc = __doc__.strip().split("\n\n")[0]
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('--calls', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    cases = [('uncached', 'json', False)]
+    cases += [(name, name, True) for name in available()]
+    print("{:<10} {:>10} {:>12} {:>12}".format(
+        'codec', 'us/call', 'calls/s', 'bytes/call'))
+    for label, name, cached in cases:
+        data = responses(lookup(name), args.calls)
+        t = min(timeit.repeat(lambda: run(name, data, cached),
+                              number=1, repeat=args.repeat))
+        p = run(name, data, cached)
+        size = (p.transport.written+sum(len(r) for r in data))/args.calls
+        print("{:<10} {:>10.1f} {:>12.0f} {:>12.0f}".format(
+            label, t/args.calls*1e6, args.calls/t, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the Twisted client (loadtest.py) with the asyncio client
+(aioloadtest.py), and uvloop when it's installed, at increasing connection
+counts. Every client runs against the same emulator.
+
+The Twisted client and emulator can run on another interpreter than the
+asyncio client (ex. python 2), see --twisted-python and --asyncio-python.
+
+Usage:
+
+    python3 benchmarks/bench_eventloops.py --devices 100,1000,5000
+
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+from common import spawn_emulator
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#: Results shown in the table
+COLUMNS = ('connected', 'calls_per_s', 'p50_ms', 'p99_ms', 'timeouts',
+           'rss_per_connection_kb')
+
+
+def run(python, script, devices, args, extra=()):
+    """ Run one of the load tests and return it's results """
+    cmd = [python, os.path.join(HERE, script), '--no-spawn', '--json',
+           '--devices', str(devices), '--port', str(args.port),
+           '--duration', str(args.duration),
+           '--concurrency', str(args.concurrency)]+list(extra)
+    try:
+        output = subprocess.check_output(cmd)
+    except subprocess.CalledProcessError as e:
+        print("{} failed with exit code {}".format(script, e.returncode))
+        return None
+    return json.loads(output.decode('utf-8'))
+
+
+def has_uvloop(python):
+    return subprocess.call([python, '-c', 'import uvloop'],
+                           stderr=subprocess.DEVNULL) == 0
+
+
+def main():
+    doc = __doc__.strip().split("\n\n")[0]
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('--devices', default='100,1000',
+                        help="Comma separated connection counts")
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--notify-rate', type=float, default=0.5)
+    parser.add_argument('--twisted-python', default=sys.executable,
+                        help="Python with twisted for the emulator and "
+                             "the Twisted client")
+    parser.add_argument('--asyncio-python', default=sys.executable,
+                        help="Python 3 used for the asyncio client")
+    args = parser.parse_args()
+
+    loops = [('twisted', args.twisted_python, 'loadtest.py', ()),
+             ('asyncio', args.asyncio_python, 'aioloadtest.py',
+              ('--loop', 'asyncio'))]
+    if has_uvloop(args.asyncio_python):
+        loops.append(('uvloop', args.asyncio_python, 'aioloadtest.py',
+                      ('--loop', 'uvloop')))
+
+    rows = []
+    for devices in [int(n) for n in args.devices.split(',')]:
+        proc = spawn_emulator(devices, args.port, args.notify_rate,
+                              python=args.twisted_python)
+        try:
+            for name, python, script, extra in loops:
+                results = run(python, script, devices, args, extra)
+                if results is not None:
+                    rows.append((devices, name, results))
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    header = "{:>8} {:<8} ".format('devices', 'loop')
+    header += " ".join("{:>12}".format(c[:12]) for c in COLUMNS)
+    print(header)
+    for devices, name, results in rows:
+        line = "{:>8} {:<8} ".format(devices, name)
+        line += " ".join("{:>12.1f}".format(results[c]) for c in COLUMNS)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the streaming JSONFramer used by RPCProtocol against the previous
+LineReceiver based implementation which split on '}' and re-parsed the
+whole buffer every time a closing bracket arrived.
+
+Usage:
+
+    python benchmarks/bench_framing.py [--segment 64] [--repeat 5]
+
+"""
+import os
+import sys
+import json
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.protocols.basic import LineReceiver
+from client import RPCProtocol
+
+
+#: Response to getState as sent by the firmware
+STATE = {
+    "tempPin1": 6, "tempPin2": 7, "ledPin": 13, "fanPin": 9,
+    "fireplacePin": 10, "heatPin": 11, "coolPin": 12,
+    "fireplacePresent": False, "coolPresent": True, "heatPresent": True,
+    "fanPresent": True, "configured": True, "heatMode": "furnace",
+    "fanMode": "auto", "systemMode": "heat", "ledActive": False,
+    "fireplaceActive": False, "fanActive": False, "heatActive": True,
+    "coolActive": False, "hysteresisTemp": 0.6, "desiredTemp": 21.5,
+    "insideTemp": 20.899999618530273, "insideHumidity": 41.20000076293945,
+    "outsideTemp": 0.0, "outsideHumidity": 0.0, "wifiSsid": "home {ap}",
+    "wifiIp": "192.168.1.101", "version": "Sun Oct 15 12:00:00 2017",
+}
+
+
+def traffic(n):
+    """ Build a stream of n getState responses each followed by a burst of
+    update notifications, like the firmware sends while a client polls.
+
+    """
+    msgs = []
+    for i in range(n):
+        msgs.append({"jsonrpc": "2.0", "id": i+1, "result": STATE})
+        for name in ("insideTemp", "insideHumidity", "heatActive"):
+            msgs.append({"type": "update", "name": name,
+                         "old": 20.8, "value": 20.9})
+    data = b''.join(json.dumps(m).encode('utf-8') for m in msgs)
+    return data, len(msgs)
+
+
+def segments(data, size):
+    """ Split the stream into TCP segments of the given size """
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+class LegacyProtocol(LineReceiver, object):
+    """ The previous framing logic of RPCProtocol """
+    def __init__(self):
+        self.delimiter = b'}'
+        self.msgbuf = b''
+        self.count = 0
+
+    def lineReceived(self, line):
+        self.msgbuf += line+self.delimiter
+        try:
+            response = json.loads(self.msgbuf)
+            self.msgbuf = b''
+        except ValueError:
+            return
+        self.count += 1
+
+
+class CountingProtocol(RPCProtocol):
+    """ The current RPCProtocol with dispatching stubbed out """
+    def __init__(self):
+        super(CountingProtocol, self).__init__()
+        self.count = 0
+
+    def messageReceived(self, response):
+        self.count += 1
+
+
+def run(cls, chunks, expected):
+    p = cls()
+    for chunk in chunks:
+        p.dataReceived(chunk)
+    assert p.count == expected, (cls, p.count, expected)
+
+
+def main():
+    doc = __doc__.strip().split("\n\n")[0]
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('--messages', type=int, default=200,
+                        help="Number of getState responses")
+    parser.add_argument('--segment', type=int, default=64,
+                        help="TCP segment size in bytes")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    data, expected = traffic(args.messages)
+    chunks = segments(data, args.segment)
+    print("{} messages, {} bytes in {} segments of {} bytes".format(
+        expected, len(data), len(chunks), args.segment))
+    results = {}
+    for cls in (LegacyProtocol, CountingProtocol):
+        t = min(timeit.repeat(lambda: run(cls, chunks, expected),
+                              number=1, repeat=args.repeat))
+        results[cls.__name__] = t
+        print("{:<20} {:8.2f} ms  {:10.0f} msg/s".format(
+            cls.__name__, t*1000, expected/t))
+    print("Speedup: {:.1f}x".format(
+        results['LegacyProtocol']/results['CountingProtocol']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Measure how the notification throughput of the sharded supervisor
+(src/shard.py) scales with the number of workers. The devices are spread
+over several emulator processes and send notifications faster than a
+single worker can apply them, the throughput is the sum of the
+notifications the workers report.
+
+Each worker count is measured in a new process since a reactor can't be
+restarted. The speedup can only be linear while there are free cores for
+the workers and the emulators.
+
+Usage:
+
+    python benchmarks/bench_shards.py --devices 2000 --workers 1,2,4,8
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from common import raise_file_limit, spawn_emulator
+
+
+def measure(args):
+    """ Run the supervisor with the given number of workers and print the
+    results as json.
+
+    """
+    from twisted.internet import reactor
+    from twisted.internet.task import LoopingCall
+    from shard import ShardSupervisor, SHARD_NOTIFICATIONS
+
+    supervisor = ShardSupervisor(workers=args.measure,
+                                 heartbeatInterval=args.heartbeat,
+                                 reportInterval=0.5)
+    supervisor.start()
+    for i in range(args.devices):
+        supervisor.add('127.0.0.1:{}'.format(args.port+i))
+
+    def connected():
+        return sum(s['connected'] for s in supervisor.stats.values())
+
+    def notifications():
+        return sum(SHARD_NOTIFICATIONS.values.values())
+
+    results = {'workers': args.measure}
+    start = time.time()
+
+    def wait():
+        if (connected() < args.devices and
+                time.time()-start < args.connect_timeout):
+            return
+        poll.stop()
+        results['connect_time_s'] = time.time()-start
+        results['connected'] = connected()
+        t0, n0 = time.time(), notifications()
+
+        def done():
+            elapsed = time.time()-t0
+            results['notifications_per_s'] = (notifications()-n0)/elapsed
+            supervisor.stop()
+            reactor.stop()
+        reactor.callLater(args.duration, done)
+
+    poll = LoopingCall(wait)
+    poll.start(0.5)
+    reactor.run()
+    print(json.dumps(results))
+
+
+def main():
+    doc = __doc__.strip().split("\n\n")[0]
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--workers', default='1,2,4',
+                        help="Worker counts to measure")
+    parser.add_argument('--emulators', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of emulator processes")
+    parser.add_argument('--notify-rate', type=float, default=10,
+                        help="Sensor updates per second per device")
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--heartbeat', type=float, default=30)
+    parser.add_argument('--connect-timeout', type=float, default=60)
+    parser.add_argument('--measure', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    raise_file_limit()
+
+    if args.measure:
+        return measure(args)
+
+    emulators = []
+    per = int(max(1, args.devices//args.emulators))
+    try:
+        for port in range(args.port, args.port+args.devices, per):
+            count = min(per, args.port+args.devices-port)
+            emulators.append(spawn_emulator(count, port, args.notify_rate))
+        print("{} devices on {} emulators reading sensors {:.0f} times/s "
+              "on {} cores".format(args.devices, len(emulators),
+                                   args.devices*args.notify_rate,
+                                   multiprocessing.cpu_count()))
+        print("{:>8} {:>10} {:>16} {:>8}".format(
+            'workers', 'connected', 'notifications/s', 'speedup'))
+        base = None
+        for workers in [int(w) for w in args.workers.split(',')]:
+            cmd = [sys.executable, os.path.abspath(__file__),
+                   '--measure', str(workers)]+[
+                a for k, v in (('--devices', args.devices),
+                               ('--port', args.port),
+                               ('--duration', args.duration),
+                               ('--heartbeat', args.heartbeat),
+                               ('--connect-timeout', args.connect_timeout))
+                for a in (k, str(v))]
+            output = subprocess.check_output(cmd)
+            r = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+            rate = r['notifications_per_s']
+            base = base or rate
+            print("{:>8} {:>10} {:>16.0f} {:>7.1f}x".format(
+                workers, r['connected'], rate, rate/base if base else 0))
+    finally:
+        for p in emulators:
+            p.kill()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the benchmarks. This must not import twisted so it can be
+used by the asyncio benchmarks.
+
+"""
+import os
+import sys
+import subprocess
+
+EMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'emulator.py')
+
+
+def rss():
+    """ Resident memory of this process in bytes """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+def percentile(values, p):
+    """ Nearest rank percentile of a sorted list """
+    if not values:
+        return float('nan')
+    k = max(0, min(len(values)-1, int(round(p/100.0*len(values)))-1))
+    return values[k]
+
+
+def raise_file_limit():
+    """ Each connection needs a file descriptor """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError):
+        pass
+
+
+def spawn_emulator(devices, port, notify_rate=0.5, latency=0.0, drop=0.0,
+                   python=None):
+    """ Start the emulator and wait until it's listening. The python used to
+    run it must have twisted installed.
+
+    """
+    cmd = [python or sys.executable, EMULATOR, '--devices', str(devices),
+           '--port', str(port), '--notify-rate', str(notify_rate),
+           '--latency', str(latency), '--drop', str(drop)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    line = proc.stdout.readline()
+    if not line.startswith(b'Listening'):
+        proc.kill()
+        raise RuntimeError("Emulator failed to start")
+    return proc
+
+
+def print_results(results):
+    for k in sorted(results):
+        v = results[k]
+        print("{:<24} {}".format(k, round(v, 3) if isinstance(v, float)
+                                 else v))
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Emulates the RPC server of arduino/Thermo/Thermo.ino so the client can be
+tested and load tested without a board. Each virtual device listens on it's
+own port starting at --port.
+
+With --serial a single device is served on a pseudo terminal instead, it
+stands in for a board plugged in over USB (see client.SerialConnector).
+
+Usage:
+
+    python benchmarks/emulator.py --devices 1000 --port 9000
+    python benchmarks/emulator.py --serial
+
+"""
+import os
+import sys
+import random
+import logging
+import argparse
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from server import RPCServerFactory, RPCServerProtocol
+from common import raise_file_limit
+
+log = logging.getLogger("enaml")
+
+#: Members of the firmware's Thermostat class and their defaults
+DEFAULT_STATE = OrderedDict([
+    ('tempPin1', 6), ('tempPin2', 7), ('ledPin', 13), ('fanPin', 9),
+    ('fireplacePin', 10), ('heatPin', 11), ('coolPin', 12),
+    ('wifiSsid', u'ssid'), ('wifiPass', u'password'),
+    ('wifiIp', u'127.0.0.1'),
+    ('tempSensor1Present', True), ('tempSensor2Present', False),
+    ('fireplacePresent', False), ('heatPresent', True),
+    ('coolPresent', True), ('fanPresent', True), ('configured', False),
+    ('heatMode', u'furnace'), ('fanMode', u'auto'), ('systemMode', u'off'),
+    ('ledActive', False), ('fireplaceActive', False), ('fanActive', False),
+    ('heatActive', False), ('coolActive', False), ('hysteresisTemp', 0.6),
+    ('desiredTemp', 24.0), ('insideTemp', 22.0), ('insideHumidity', 45.0),
+    ('outsideTemp', 0.0), ('outsideHumidity', 0.0),
+    ('version', u'emulator'),
+])
+
+#: Members that are not sent by getState
+WRITE_ONLY = ('wifiPass', 'tempSensor1Present', 'tempSensor2Present')
+
+#: Members the firmware sends a notification for when they change
+OBSERVED = set(DEFAULT_STATE.keys()) - {'wifiIp', 'version',
+                                        'hysteresisTemp'}
+
+
+class EmulatorProtocol(RPCServerProtocol):
+    """ Injects latency and drops into everything sent to the client """
+
+    def sendMessage(self, msg):
+        device = self.factory
+        if msg is None or random.random() < device.drop:
+            return
+        if device.latency:
+            delay = random.uniform(0.5, 1.5)*device.latency
+            reactor.callLater(delay, self._send, msg)
+        else:
+            self._send(msg)
+
+    def _send(self, msg):
+        if self.transport is not None and self.connected:
+            RPCServerProtocol.sendMessage(self, msg)
+
+
+class ThermostatEmulator(RPCServerFactory):
+    """ A virtual thermostat. Sensors are read every 1/notifyRate seconds
+    and follow a random walk which is pushed to the clients as `update`
+    notifications. Heating and cooling follow the firmware's logic.
+
+    """
+    protocol = EmulatorProtocol
+
+    def __init__(self, notifyRate=0.5, latency=0.0, drop=0.0):
+        super(ThermostatEmulator, self).__init__()
+        #: Sensor reads per second
+        self.notifyRate = notifyRate
+
+        #: Mean delay in seconds added to every message sent
+        self.latency = latency
+
+        #: Probability that a message sent is dropped
+        self.drop = drop
+
+        self.state = OrderedDict(DEFAULT_STATE)
+        self.state['insideTemp'] += random.uniform(-2, 2)
+        self._sensors = LoopingCall(self.processSensors)
+
+    def startFactory(self):
+        if self.notifyRate > 0:
+            #: Spread out the sensor reads of all the devices
+            reactor.callLater(random.random()/self.notifyRate,
+                              self._sensors.start, 1.0/self.notifyRate)
+
+    def stopFactory(self):
+        if self._sensors.running:
+            self._sensors.stop()
+
+    # -------------------------------------------------------------------------
+    # RPC API
+    # -------------------------------------------------------------------------
+    def rpc_getState(self, **params):
+        return {k: v for k, v in self.state.items() if k not in WRITE_ONLY}
+
+    def rpc_setState(self, **params):
+        params.pop('loading', None)
+        for k, v in params.items():
+            if k in self.state:
+                self.set(k, type(self.state[k])(v))
+        return self.rpc_getState()
+
+    # -------------------------------------------------------------------------
+    # Firmware behavior
+    # -------------------------------------------------------------------------
+    def set(self, name, value):
+        """ Set a member and notify all the clients if it changed """
+        old = self.state[name]
+        if old == value:
+            return
+        self.state[name] = value
+        if name in OBSERVED:
+            self.notifyAll({'type': 'update', 'name': name, 'old': old,
+                            'value': value})
+        if name in ('systemMode', 'insideTemp', 'desiredTemp',
+                    'hysteresisTemp', 'fanMode', 'heatMode'):
+            self.onThermostatChanged()
+        if name == 'heatActive' and self.state['heatMode'] == 'fireplace':
+            self.set('fireplaceActive', value)
+
+    def onThermostatChanged(self):
+        state = self.state
+        mode = state['systemMode']
+        temp, desired = state['insideTemp'], state['desiredTemp']
+        if mode == 'heat':
+            self.set('coolActive', False)
+            if temp <= desired:
+                self.set('heatActive', True)
+            elif temp >= desired + state['hysteresisTemp']:
+                self.set('heatActive', False)
+        elif mode == 'cool':
+            self.set('heatActive', False)
+            if temp >= desired:
+                self.set('coolActive', True)
+            elif temp <= desired - state['hysteresisTemp']:
+                self.set('coolActive', False)
+        else:
+            self.set('heatActive', False)
+            self.set('coolActive', False)
+
+    def processSensors(self):
+        """ Emulate a DHT22 read """
+        state = self.state
+        drift = 0.05 if state['heatActive'] else -0.05 \
+            if state['coolActive'] else 0
+        self.set('insideTemp', round(state['insideTemp'] + drift +
+                                     random.gauss(0, 0.1), 1))
+        self.set('insideHumidity', round(min(100, max(0, (
+            state['insideHumidity'] + random.gauss(0, 0.2)))), 1))
+
+
+def listen(devices, port, host='127.0.0.1', **kwargs):
+    """ Start the given number of virtual devices on consecutive ports.
+    Returns the list of emulators.
+
+    """
+    emulators = []
+    for i in range(devices):
+        device = ThermostatEmulator(**kwargs)
+        reactor.listenTCP(port+i, device, interface=host, backlog=128)
+        emulators.append(device)
+    return emulators
+
+
+def listen_serial(**kwargs):
+    """ Serve a virtual device on a pseudo terminal. Returns the emulator
+    and the path of it's serial port.
+
+    """
+    import tty
+    from twisted.internet.stdio import StandardIO
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    device = ThermostatEmulator(**kwargs)
+    device.doStart()
+
+    #: The reactor can't watch the same fd for reading and writing with
+    #: two objects. The slave is kept open so clients can reopen it.
+    device.pty = slave
+    StandardIO(device.buildProtocol(None), stdin=master,
+               stdout=os.dup(master))
+    return device, os.ttyname(slave)
+
+
+def main():
+    doc = __doc__.strip().split("\n\n")[0]
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('--devices', type=int, default=1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8888,
+                        help="Port of the first device")
+    parser.add_argument('--notify-rate', type=float, default=0.5,
+                        help="Sensor updates per second per device")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Mean delay in seconds added to messages")
+    parser.add_argument('--drop', type=float, default=0.0,
+                        help="Probability of dropping a message")
+    parser.add_argument('--serial', action='store_true',
+                        help="Serve a single device on a pseudo terminal")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+    raise_file_limit()
+    if args.serial:
+        device, path = listen_serial(notifyRate=args.notify_rate,
+                                     latency=args.latency, drop=args.drop)
+        print("Listening on {}".format(path))
+        sys.stdout.flush()
+        reactor.run()
+        return
+    listen(args.devices, args.port, args.host, notifyRate=args.notify_rate,
+           latency=args.latency, drop=args.drop)
+    print("Listening on {}:{}-{}".format(args.host, args.port,
+                                         args.port+args.devices-1))
+    sys.stdout.flush()
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
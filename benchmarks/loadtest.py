@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Load test client.Thermostat against emulated devices. Starts the emulator in
+a subprocess (unless --no-spawn is given), connects a ThermostatPool to every
+device and then keeps --concurrency RPC calls in flight per device for
+--duration seconds.
+
+Reports connect time, RPC throughput, p50/p99 latency, timeouts,
+notification rate and client memory per connection.
+
+Usage:
+
+    python benchmarks/loadtest.py --devices 1000 --duration 30
+
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, CancelledError
+from twisted.internet.task import deferLater
+from pool import ThermostatPool
+from common import (
+    rss, percentile, raise_file_limit, spawn_emulator, print_results
+)
+
+
+class LoadTest(object):
+    def __init__(self, args):
+        self.args = args
+        self.latencies = []
+        self.errors = 0
+        self.timeouts = 0
+        self.notifications = 0
+        self.results = {}
+        self.running = False
+
+    def on_message(self, change):
+        #: The listener also gets member changes which have an object
+        if 'object' not in change:
+            self.notifications += 1
+
+    @inlineCallbacks
+    def run(self):
+        args = self.args
+        results = self.results
+        mem0 = rss()
+        pool = ThermostatPool(heartbeatInterval=args.heartbeat,
+                              listener=self.on_message)
+        pool.scheduler.maxRate = max(1, args.devices/args.heartbeat)
+
+        #: Connect everything
+        t0 = time.time()
+        for i in range(args.devices):
+            pool.add("{}:{}".format(args.host, args.port+i))
+        while sum(t.connected for t in pool) < args.devices:
+            if time.time()-t0 > args.connect_timeout:
+                break
+            yield deferLater(reactor, 0.1, lambda: None)
+        connected = sum(t.connected for t in pool)
+        results['devices'] = args.devices
+        results['connected'] = connected
+        results['connect_time_s'] = time.time()-t0
+        results['rss_per_connection_kb'] = (rss()-mem0)/1024.0/max(1,
+                                                                   connected)
+
+        #: Drive RPC calls
+        self.running = True
+        self.notifications = 0
+        t0 = time.time()
+        workers = []
+        for t in pool:
+            if t.connected:
+                for i in range(args.concurrency):
+                    workers.append(self.worker(t))
+        yield deferLater(reactor, args.duration, lambda: None)
+        self.running = False
+        for d in workers:
+            yield d
+        elapsed = time.time()-t0
+
+        lat = sorted(self.latencies)
+        results['calls'] = len(lat)
+        results['errors'] = self.errors
+        results['timeouts'] = self.timeouts
+        results['calls_per_s'] = len(lat)/elapsed
+        results['p50_ms'] = percentile(lat, 50)*1000
+        results['p99_ms'] = percentile(lat, 99)*1000
+        results['notifications_per_s'] = self.notifications/elapsed
+        pool.clear()
+
+    @inlineCallbacks
+    def worker(self, thermostat):
+        """ Keep one call in flight on the given thermostat """
+        while self.running and thermostat.connected:
+            t0 = time.time()
+            try:
+                yield thermostat._protocol.getState()
+                self.latencies.append(time.time()-t0)
+            except CancelledError:
+                self.timeouts += 1
+            except Exception:
+                self.errors += 1
+
+
+def main():
+    doc = __doc__.strip().split("\n\n")[0]
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000,
+                        help="Port of the first device")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="Calls in flight per device")
+    parser.add_argument('--heartbeat', type=float, default=30,
+                        help="Heartbeat interval of each thermostat")
+    parser.add_argument('--connect-timeout', type=float, default=60)
+    parser.add_argument('--no-spawn', action='store_true',
+                        help="Use an emulator that is already running")
+    parser.add_argument('--notify-rate', type=float, default=0.5)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--drop', type=float, default=0.0)
+    parser.add_argument('--json', action='store_true',
+                        help="Print the results as json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    raise_file_limit()
+
+    proc = None if args.no_spawn else spawn_emulator(
+        args.devices, args.port, args.notify_rate, args.latency, args.drop)
+    test = LoadTest(args)
+
+    def done(result):
+        if reactor.running:
+            reactor.stop()
+        return result
+
+    reactor.callWhenRunning(lambda: test.run().addBoth(done))
+    try:
+        reactor.run()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    results = test.results
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
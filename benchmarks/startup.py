@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the cold start of the app: the import time of each module and the
+time until everything the first screen shows is ready (the persisted state
+is loaded and the members the dashboard binds to are evaluated).
+
+Every run is a new interpreter in a temporary app directory which is
+seeded with a saved state first, so the numbers don't depend on what is on
+this machine. The app's dependencies (atom, enaml, enaml-native and
+twisted) must be importable.
+
+Usage:
+
+    python benchmarks/startup.py [--repeat 5] [--top 15] [--view]
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+#: Members of the last reported state saved by the seed run
+STATE = {
+    'insideTemp': 21.5, 'insideHumidity': 41.0, 'desiredTemp': 22.0,
+    'systemMode': u'heat', 'fanMode': u'auto', 'heatActive': True,
+    'version': u'startup',
+}
+
+
+class ImportTimer(object):
+    """ Replaces __import__ to record how long each module took to load.
+    The self time excludes the modules it imported.
+
+    """
+    def __init__(self):
+        #: Maps the module name to (self time, total time)
+        self.times = {}
+        self._import = None
+        self._stack = []
+
+    def install(self):
+        self._import = builtins.__import__
+        builtins.__import__ = self
+
+    def uninstall(self):
+        builtins.__import__ = self._import
+
+    def __call__(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self._import(name, *args, **kwargs)
+        stack = self._stack
+        stack.append(0.0)
+        t0 = time.time()
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            total = time.time()-t0
+            children = stack.pop()
+            if stack:
+                stack[-1] += total
+            if name in sys.modules and name not in self.times:
+                self.times[name] = (total-children, total)
+
+
+def setup_path(directory):
+    """ The app stores it's files next to sys.path[0] """
+    sys.path.insert(0, os.path.join(directory, 'python'))
+    sys.path.insert(1, SRC)
+
+
+def seed(directory):
+    """ Save a state like the one left by a previous run of the app """
+    setup_path(directory)
+    import models
+    state = models.AppState()
+    state.thermostat_state = STATE
+    state._write_snapshot(state.__getstate__())
+
+
+def measure(directory, view=False):
+    """ Cold start in this process, returns the results as a dict """
+    t0 = time.time()
+    timer = ImportTimer()
+    timer.install()
+    try:
+        setup_path(directory)
+        import models
+        if view:
+            import enaml
+            with enaml.imports():
+                import view
+    finally:
+        timer.uninstall()
+    t1 = time.time()
+
+    state = models.AppState.instance()
+    t2 = time.time()
+
+    #: What the dashboard binds to
+    thermostat = state.thermostat
+    thermostat.insideTemp, thermostat.insideHumidity, thermostat.connected
+    state.time.hour, state.theme.bg, state.units, state.thermostat_state
+    t3 = time.time()
+
+    return {
+        'imports_ms': (t1-t0)*1000,
+        'state_ms': (t2-t1)*1000,
+        'first_frame_ms': (t3-t0)*1000,
+        'restored': thermostat.insideTemp == STATE['insideTemp'],
+        'modules': {k: [v[0]*1000, v[1]*1000]
+                    for k, v in timer.times.items()},
+    }
+
+
+def run(script_args, directory):
+    cmd = [sys.executable, os.path.abspath(__file__),
+           '--directory', directory]+script_args
+    output = subprocess.check_output(cmd)
+    return json.loads(output.decode('utf-8').strip().split('\n')[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+
+def main():
+    doc = __doc__.strip().split("\n\n")[0]
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15,
+                        help="Number of modules to show")
+    parser.add_argument('--view', action='store_true',
+                        help="Also import view.enaml (needs enaml-native)")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the results as json")
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    parser.add_argument('--seed', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.directory:
+        #: Child process
+        if args.seed:
+            seed(args.directory)
+            print(json.dumps({}))
+        else:
+            print(json.dumps(measure(args.directory, args.view)))
+        return
+
+    directory = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(directory, 'python'))
+        run(['--seed'], directory)
+        extra = ['--view'] if args.view else []
+        runs = [run(extra, directory) for i in range(args.repeat)]
+    finally:
+        shutil.rmtree(directory)
+
+    results = {k: median([r[k] for r in runs])
+               for k in ('imports_ms', 'state_ms', 'first_frame_ms')}
+    results['restored'] = all(r['restored'] for r in runs)
+    modules = {}
+    for name in runs[0]['modules']:
+        times = [r['modules'][name] for r in runs if name in r['modules']]
+        modules[name] = (median([t[0] for t in times]),
+                         median([t[1] for t in times]))
+    if args.json:
+        results['modules'] = modules
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    print("{:<40} {:>10} {:>10}".format('module', 'self ms', 'total ms'))
+    top = sorted(modules.items(), key=lambda m: -m[1][0])[:args.top]
+    for name, (own, total) in top:
+        print("{:<40} {:>10.1f} {:>10.1f}".format(name, own, total))
+    print("")
+    for k in ('imports_ms', 'state_ms', 'first_frame_ms'):
+        print("{:<40} {:>10.1f}".format(k, results[k]))
+    print("{:<40} {:>10}".format('restored', results['restored']))
+
+
+if __name__ == '__main__':
+    main()
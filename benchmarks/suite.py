@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+"""
+Micro benchmarks of the app's hot paths using recorded fixtures. Each
+result is divided by the time of a fixed pure python workload (reference)
+measured in the same run so the results don't depend on the speed of the
+machine. They are compared against benchmarks/baseline.json and the run
+fails when any benchmark is slower than it's baseline by more than the
+tolerance, or when there is no baseline for the python version.
+
+- reference: dict, string and list operations without any of the app's
+  code (per key)
+- rpc_framing: RPCProtocol.dataReceived of the stream recorded from the
+  emulator cut into 64 byte segments (per message)
+- sync_state: Thermostat.syncState with the recorded getState responses
+  (per call)
+- notify_apply: Thermostat.onNotify and applyNotifications of the recorded
+  notifications (per notification)
+- model_getstate / model_setstate: utils.Model.__getstate__ and
+  __setstate__ of the AppState (per call)
+- state_save: State._save_state of a single changed member, disk syncs are
+  disabled (per save)
+- forecast_parse: Weather.on_load_forecast of a 5 day forecast (per call)
+
+enaml and enaml-native are replaced by stubs so it runs headless, atom and
+twisted must be installed. Baselines are kept per python version, record
+one with --save-baseline using the python that runs the suite in CI.
+
+Usage:
+
+    python benchmarks/suite.py [--json] [--tolerance 0.5] [name ...]
+    python benchmarks/suite.py --save-baseline
+    python benchmarks/suite.py --record
+
+"""
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import socket
+import timeit
+import argparse
+import platform
+import tempfile
+from collections import OrderedDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', 'src')
+FIXTURES = os.path.join(HERE, 'fixtures')
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+#: Minimum time of each timed run in seconds
+MIN_TIME = 0.05
+
+#: Benchmark the others are divided by
+REFERENCE = 'reference'
+
+#: Benchmarks by name, see benchmark
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(f):
+    """ Register a benchmark. It's called once to set up and returns the
+    function to time and the number of operations each call of it does.
+
+    """
+    BENCHMARKS[f.__name__] = f
+    return f
+
+
+def install_stubs():
+    """ Replace enaml and enaml-native with the names the models import.
+    Timed and deferred calls are never run.
+
+    """
+    def stub(name, **attrs):
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+
+    class AsyncHttpClient(object):
+        pass
+
+    class BridgedApplication(object):
+        pass
+
+    def timed_call(ms, callback, *args, **kwargs):
+        pass
+
+    def deferred_call(callback, *args, **kwargs):
+        pass
+
+    stub('enaml')
+    stub('enaml.application', timed_call=timed_call,
+         deferred_call=deferred_call)
+    stub('enamlnative')
+    stub('enamlnative.core')
+    stub('enamlnative.core.api', AsyncHttpClient=AsyncHttpClient)
+    stub('enamlnative.core.app', BridgedApplication=BridgedApplication)
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def messages(data):
+    """ Decode a recorded stream into a list of messages """
+    from framing import JSONFramer
+    return JSONFramer(len(data)).feed(data)
+
+
+class MemoryTransport(object):
+    def write(self, data):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+class NullCall(object):
+    """ Returned by BenchThermostat.callLater, the call is run manually """
+    def active(self):
+        return False
+
+    def cancel(self):
+        pass
+
+
+def thermostat():
+    """ Create a Thermostat connected to an in memory protocol """
+    from client import Thermostat, RPCProtocol
+
+    class BenchThermostat(Thermostat):
+        def callLater(self, delay, f):
+            return NullCall()
+
+    t = BenchThermostat()
+    p = RPCProtocol()
+    p.factory = t
+    p.transport = MemoryTransport()
+    t._protocol = p
+    t.connected = True
+    return t
+
+
+# -----------------------------------------------------------------------------
+# Benchmarks
+# -----------------------------------------------------------------------------
+@benchmark
+def reference():
+    """ Dict, string and list operations like the hot paths do, without
+    any of the app's code so it only changes with the machine and python.
+
+    """
+    keys = ['member{}'.format(i) for i in range(32)]
+
+    def run():
+        state = {}
+        for i, k in enumerate(keys):
+            state[k] = '{}={}'.format(k, i*0.5)
+        changes = {k: v for k, v in state.items() if v[-1] != '0'}
+        return sorted(changes, key=len)
+
+    return run, len(keys)
+
+
+@benchmark
+def rpc_framing():
+    from client import RPCProtocol
+
+    class CountingProtocol(RPCProtocol):
+        def messageReceived(self, msg):
+            self.count += 1
+
+    data = fixture('thermostat.stream')
+    chunks = [data[i:i+64] for i in range(0, len(data), 64)]
+
+    def run():
+        p = CountingProtocol()
+        p.count = 0
+        for chunk in chunks:
+            p.dataReceived(chunk)
+        return p
+
+    return run, run().count
+
+
+@benchmark
+def sync_state():
+    from codec import lookup
+    codec = lookup('json')
+    states = [msg['result']
+              for msg in messages(fixture('thermostat.stream'))
+              if isinstance(msg.get('result'), dict) and
+              'insideTemp' in msg['result']]
+    responses = [codec.encode({'jsonrpc': '2.0', 'id': i+1, 'result': s})
+                 for i, s in enumerate(states)]
+    t = thermostat()
+    p = t._protocol
+
+    def run():
+        p._id = 0
+        for response in responses:
+            t.syncState()
+            p.dataReceived(response)
+        assert not p.pending
+
+    return run, len(responses)
+
+
+@benchmark
+def notify_apply():
+    changes = [msg for msg in messages(fixture('thermostat.stream'))
+               if msg.get('type') == 'update']
+    t = thermostat()
+
+    def run():
+        #: Applied once per frame of 10 notifications
+        for i, change in enumerate(changes):
+            t.onNotify(change)
+            if i % 10 == 9:
+                t.applyNotifications()
+        t.applyNotifications()
+
+    return run, len(changes)
+
+
+@benchmark
+def model_getstate():
+    from models import AppState
+    state = AppState.instance()
+
+    def run():
+        for i in range(100):
+            state.__getstate__()
+
+    return run, 100
+
+
+@benchmark
+def model_setstate():
+    from models import AppState
+    data = AppState.instance().__getstate__()
+
+    def run():
+        #: Restoring is done on a new instance
+        for i in range(100):
+            AppState.__new__(AppState).__setstate__(data)
+
+    return run, 100
+
+
+@benchmark
+def state_save():
+    from models import AppState
+    state = AppState.instance()
+    state._state_fsync = 'never'
+    change = {'type': 'update', 'name': 'set_temp'}
+
+    def run():
+        for i in range(100):
+            state.set_temp = 20+i % 2
+            state._state_save_pending = 1
+            state._save_state(change)
+
+    return run, 100
+
+
+@benchmark
+def forecast_parse():
+    from models import Weather
+    body = fixture('forecast.json').decode('utf-8')
+    weather = Weather(current=json.loads(fixture('weather.json')))
+
+    def run():
+        for i in range(10):
+            assert weather.on_load_forecast(body)
+
+    return run, 10
+
+
+# -----------------------------------------------------------------------------
+# Runner
+# -----------------------------------------------------------------------------
+def measure(name, repeat):
+    """ Run a benchmark and return the best time per operation in
+    microseconds.
+
+    """
+    run, ops = BENCHMARKS[name]()
+    run()
+    number = 1
+    while timeit.timeit(run, number=number) < MIN_TIME:
+        number *= 2
+    best = min(timeit.repeat(run, number=number, repeat=repeat))
+    return best/number/ops*1e6
+
+
+def python_version():
+    return 'python{}.{}'.format(*sys.version_info[:2])
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get(python_version(), {})
+
+
+def save_baseline(path, results):
+    data = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            data = json.load(f)
+    data.setdefault(python_version(), {}).update(
+        (k, round(v, 4)) for k, v in results.items())
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True, separators=(',', ': '))
+        f.write('\n')
+
+
+def relative(results):
+    """ Divide each result by the reference """
+    ref = results[REFERENCE]
+    return OrderedDict((name, us/ref) for name, us in results.items()
+                       if name != REFERENCE)
+
+
+def compare(ratios, baseline, tolerance):
+    """ Return a dict of the change of each benchmark from it's baseline,
+    a list of the benchmarks that are slower than the tolerance and a list
+    of the ones without a baseline.
+
+    """
+    changes = {}
+    regressions = []
+    missing = []
+    for name, ratio in ratios.items():
+        if name not in baseline:
+            missing.append(name)
+            continue
+        changes[name] = ratio/baseline[name]-1
+        if changes[name] > tolerance:
+            regressions.append(name)
+    return changes, regressions, missing
+
+
+def record(seconds=5, port=9990):
+    """ Record the stream a client receives from the emulator while it
+    polls the state and changes the desired temperature.
+
+    """
+    from common import spawn_emulator
+    proc = spawn_emulator(1, port, notify_rate=20)
+    try:
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.settimeout(0.05)
+        data = []
+        request_id = 0
+        end = time.time()+seconds
+        while time.time() < end:
+            request_id += 1
+            request = {'jsonrpc': '2.0', 'id': request_id,
+                       'method': 'getState'}
+            if request_id % 5 == 0:
+                request.update(method='setState', params={
+                    'desiredTemp': 20+request_id % 3})
+            sock.sendall(json.dumps(request).encode('utf-8'))
+            stop = time.time()+0.1
+            while time.time() < stop:
+                try:
+                    data.append(sock.recv(65536))
+                except socket.timeout:
+                    pass
+        sock.close()
+    finally:
+        proc.kill()
+    with open(os.path.join(FIXTURES, 'thermostat.stream'), 'wb') as f:
+        f.write(b''.join(data))
+
+
+def main():
+    doc = __doc__.strip().split("\n\n")[0]
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help="Benchmarks to run (default all)")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="Allowed slowdown from the baseline (0.5 is "
+                             "50%%)")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="Save the results as the baseline")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the results as json")
+    parser.add_argument('--record', action='store_true',
+                        help="Record the thermostat stream fixture")
+    args = parser.parse_args()
+
+    if args.record:
+        record()
+        return
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark {}, use one of: {}".format(
+                name, ", ".join(BENCHMARKS)))
+    names = [REFERENCE]+[name for name in (args.names or BENCHMARKS)
+                         if name != REFERENCE]
+
+    #: The state files are saved next to sys.path[0]
+    directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(directory, 'python'))
+    sys.path[:0] = [os.path.join(directory, 'python'), SRC]
+    install_stubs()
+
+    #: The models print what they parse
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        results = OrderedDict(
+            (name, measure(name, args.repeat)) for name in names)
+
+        #: Measured again at the end, the fastest is the least disturbed
+        results[REFERENCE] = min(results[REFERENCE],
+                                 measure(REFERENCE, args.repeat))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(directory)
+
+    ratios = relative(results)
+    baseline = load_baseline(args.baseline)
+    changes, regressions, missing = compare(ratios, baseline, args.tolerance)
+    if args.save_baseline:
+        save_baseline(args.baseline, ratios)
+
+    if args.json:
+        print(json.dumps({
+            'python': platform.python_version(),
+            'results': results,
+            'relative': ratios,
+            'baseline': baseline,
+            'changes': changes,
+            'regressions': regressions,
+            'missing': missing,
+        }, indent=2, separators=(',', ': ')))
+    else:
+        print("{:<16} {:>12} {:>10} {:>10} {:>8}".format(
+            'benchmark', 'us/op', 'relative', 'baseline', 'change'))
+        print("{:<16} {:>12.2f} {:>10} {:>10} {:>8}".format(
+            REFERENCE, results[REFERENCE], 1, '-', '-'))
+        for name, ratio in ratios.items():
+            if name in baseline:
+                print("{:<16} {:>12.2f} {:>10.2f} {:>10.2f} {:>+7.0f}%{}"
+                      .format(name, results[name], ratio, baseline[name],
+                              changes[name]*100,
+                              " SLOWER" if name in regressions else ""))
+            else:
+                print("{:<16} {:>12.2f} {:>10.2f} {:>10} {:>8}".format(
+                    name, results[name], ratio, '-', '-'))
+    if args.save_baseline:
+        return
+    if missing:
+        sys.stderr.write(
+            "No {} baseline for {} in {}, record one with "
+            "--save-baseline\n".format(python_version(), ", ".join(missing),
+                                        args.baseline))
+        sys.exit(2)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio version of the thermostat client (python 3 only, this is not used by
+the app). It speaks the same protocol as client.py with the same attribute
+style calls and shares the framing and state sync logic with it so it can be
+used from asyncio services or with uvloop.
+
+    thermostat = Thermostat(host='192.168.1.101', port=8888)
+    thermostat.start()
+    ...
+    state = await thermostat.protocol.getState()
+
+"""
+import heapq
+import random
+import asyncio
+import logging
+import functools
+import traceback
+from collections import OrderedDict
+from atom.api import Float, Instance, Int
+from framing import FrameTooLong
+from codec import lookup
+from metrics import registry
+from sync import RPCMixin, ThermostatState, Unicode
+
+log = logging.getLogger("enaml")
+
+#: Same metrics as the Twisted client
+RPC_LATENCY = registry.histogram(
+    'thermostat_rpc_latency_seconds',
+    "Time until the response of a request is received", ('method',))
+RPC_PENDING = registry.gauge(
+    'thermostat_rpc_pending', "Requests waiting for a response")
+RPC_TIMEOUTS = registry.counter(
+    'thermostat_rpc_timeouts_total', "Requests that timed out", ('method',))
+RPC_ERRORS = registry.counter(
+    'thermostat_rpc_errors_total', "Requests that failed", ('method',))
+NOTIFICATIONS = registry.counter(
+    'thermostat_notifications_total', "Notifications received")
+RECONNECTS = registry.counter(
+    'thermostat_reconnects_total',
+    "Times a connection was lost or failed and will be retried")
+
+
+class RPCProtocol(asyncio.Protocol, RPCMixin):
+    """ Any attribute that is not defined is a remote method, calling it
+    returns a coroutine with the result. Requests that get no response
+    within their timeout fail with an asyncio.TimeoutError.
+
+    """
+    #: Max size of a single message in bytes
+    MAX_LENGTH = 16384
+
+    #: Timeouts (in seconds) for specific methods, others use _timeout
+    timeouts = {}
+
+    #: Number of ids of expired requests kept to drop their late responses
+    MAX_EXPIRED = 256
+
+    def __init__(self, thermostat=None, loop=None, codec='json'):
+        #: Encodes the requests and decodes the stream, see codec.py
+        self.codec = lookup(codec)
+
+        #: Notified of the connection and notifications
+        self.thermostat = thermostat
+
+        self.loop = loop or asyncio.get_event_loop()
+        self.transport = None
+
+        #: Resolved when the connection is lost
+        self.closed = self.loop.create_future()
+
+        #: Pending requests by id
+        self._queue = OrderedDict()
+
+        #: Ids of requests that timed out, a response to them that arrives
+        #: late is dropped
+        self._expired = OrderedDict()
+
+        #: Heap of (deadline, id) for the pending requests. Entries for
+        #: requests that already got a response are skipped when popped.
+        self._deadlines = []
+
+        #: Timer for the earliest deadline and when it fires
+        self._timer = None
+        self._timerDeadline = None
+
+        self._framer = self.codec.framer(self.MAX_LENGTH)
+        self._id = 0
+        self._timeout = 3.0
+        self.timeouts = dict(self.timeouts)
+
+    @property
+    def pending(self):
+        """ Number of requests waiting for a response """
+        return len(self._queue)
+
+    @classmethod
+    def _makeStub(cls, method):
+        async def call(self, *args, **kwargs):
+            request = self._buildRequest(method, args, kwargs)
+            log.info("request: %s", request)
+            response = await self.sendRequest(request)
+            log.info("response: %s", response)
+            return self._getResult(response)
+        call.__name__ = method
+        return call
+
+    def connection_made(self, transport):
+        self.transport = transport
+        log.info("Thermostat connection made")
+        if self.thermostat is not None:
+            self.thermostat.onConnect(self)
+
+    def data_received(self, data):
+        """ Cut complete messages out of the stream and dispatch them """
+        try:
+            messages = self._framer.feed(data)
+        except FrameTooLong as e:
+            log.error("Thermostat message too long: %s", e)
+            self.transport.close()
+            return
+        for msg in messages:
+            if isinstance(msg, (dict, list)):
+                self.messageReceived(msg)
+            else:
+                log.warning("Discarding invalid message: %s", msg)
+
+    def messageReceived(self, response):
+        """ Dispatch a decoded message to the pending request or handle
+        it as a notification.
+
+        """
+        log.debug("Received message: %s", response)
+        if isinstance(response, list):
+            #: Batch response
+            for item in response:
+                if isinstance(item, dict):
+                    self.messageReceived(item)
+            return
+        req_id = response.get('id', None)
+        if req_id:
+            if req_id in self._queue:
+                f = self._queue.pop(req_id)
+            elif self._expired.pop(req_id, False):
+                log.warning("Discarding late response: %s", response)
+                return
+            elif self._queue:
+                # Set it as the most recent request ?
+                req_id, f = self._queue.popitem(last=True)
+            else:
+                log.warning("Discarding unexpected response: %s", response)
+                return
+            self._discardDeadlines()
+            if not f.done():
+                f.set_result(response)
+        else:
+            self.msgReceived(response)
+
+    def msgReceived(self, msg):
+        log.info("Notification: %s", msg)
+        NOTIFICATIONS.inc()
+        if self.thermostat is not None:
+            self.thermostat.onNotify(msg)
+
+    def sendRequest(self, request):
+        """ Send an RPC request and return a future of the response """
+        resp = self._expect(request)
+        self.transport.write(self.codec.encode(request))
+        return resp
+
+    def sendBatch(self, requests):
+        """ Send a list of RPC requests as a batch. Returns a list with a
+        future for each request.
+        """
+        responses = [self._expect(request) for request in requests]
+        self.transport.write(self.codec.encode(requests))
+        return responses
+
+    def _expect(self, request):
+        """ Add a pending request and schedule it's deadline """
+        req_id = request['id']
+        method = request['method']
+        now = self.loop.time()
+        timeout = self.timeouts.get(method, self._timeout)
+        resp = self.loop.create_future()
+        self._queue[req_id] = resp
+        heapq.heappush(self._deadlines, (now+timeout, req_id))
+        if self._deadlines[0][1] == req_id:
+            #: This is now the earliest deadline
+            self._armTimer()
+        RPC_PENDING.inc()
+        resp.add_done_callback(functools.partial(self._requestDone, method,
+                                                 now))
+        return resp
+
+    def _requestDone(self, method, start, resp):
+        """ Record the outcome of a request """
+        RPC_PENDING.dec()
+        if resp.cancelled():
+            return
+        e = resp.exception()
+        if e is None:
+            RPC_LATENCY.observe(self.loop.time()-start, method)
+        elif isinstance(e, asyncio.TimeoutError):
+            RPC_TIMEOUTS.inc(1, method)
+        else:
+            RPC_ERRORS.inc(1, method)
+
+    def _armTimer(self):
+        """ Arm the timer to fire at the earliest deadline """
+        deadline = self._deadlines[0][0] if self._deadlines else None
+        if deadline == self._timerDeadline:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timerDeadline = deadline
+        self._timer = None
+        if deadline is not None:
+            self._timer = self.loop.call_at(deadline, self._expire)
+
+    def _discardDeadlines(self):
+        """ Pop deadlines of requests that are no longer pending from the
+        top of the heap so the timer only fires when something expires.
+        """
+        deadlines, queue = self._deadlines, self._queue
+        if not deadlines or deadlines[0][1] in queue:
+            return
+        while deadlines and deadlines[0][1] not in queue:
+            heapq.heappop(deadlines)
+        self._armTimer()
+
+    def _expire(self):
+        """ Fail every pending request that passed it's deadline """
+        self._timer = self._timerDeadline = None
+        now = self.loop.time()
+        deadlines, queue = self._deadlines, self._queue
+        expired = self._expired
+        while deadlines and deadlines[0][0] <= now:
+            deadline, req_id = heapq.heappop(deadlines)
+            f = queue.pop(req_id, None)
+            if f is None:
+                continue
+            expired[req_id] = True
+            if not f.done():
+                log.warning("Request %s timed out", req_id)
+                f.set_exception(asyncio.TimeoutError(
+                    "Request {} timed out".format(req_id)))
+        while len(expired) > self.MAX_EXPIRED:
+            expired.popitem(last=False)
+        self._discardDeadlines()
+        self._armTimer()
+
+    def connection_lost(self, exc):
+        log.warning("Thermostat connection lost")
+
+        #: Fail anything still waiting for a response
+        queue, self._queue = self._queue, OrderedDict()
+        self._deadlines = []
+        self._armTimer()
+        for f in queue.values():
+            if not f.done():
+                f.set_exception(exc or ConnectionError("Connection lost"))
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        if self.thermostat is not None:
+            self.thermostat.onConnectionLost(exc)
+
+
+class Thermostat(ThermostatState):
+    """ Keeps a connection to a thermostat open, reconnecting with an
+    exponential backoff like twisted's ReconnectingClientFactory, and keeps
+    the members in sync with the device.
+
+    """
+    #: Address of the thermostat
+    host = Unicode()
+    port = Int(8888)
+
+    #: Reconnect delays (seconds)
+    initialDelay = Float(1.0)
+    maxDelay = Float(5)
+    factor = Float(2.7182818284590451)
+    jitter = Float(0.11962656472)
+
+    #: Current connection
+    _protocol = Instance(RPCProtocol)
+
+    #: Connect and heartbeat tasks
+    _connector = Instance(asyncio.Task)
+    _heartbeat = Instance(asyncio.Task)
+
+    _loop = Instance(asyncio.AbstractEventLoop)
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    @property
+    def protocol(self):
+        return self._protocol
+
+    def now(self):
+        return self.loop.time()
+
+    def callLater(self, delay, f):
+        return self.loop.call_later(delay, f)
+
+    def cancelCall(self, call):
+        call.cancel()
+
+    def start(self):
+        """ Connect and keep reconnecting until stopped """
+        if self._connector is None or self._connector.done():
+            self._connector = self.loop.create_task(self._connect())
+
+    def stop(self):
+        """ Disconnect and stop reconnecting """
+        if self._connector is not None:
+            self._connector.cancel()
+            self._connector = None
+        self.stopHeartbeat()
+        if self._protocol is not None and self._protocol.transport:
+            self._protocol.transport.close()
+
+    async def _connect(self):
+        loop = self.loop
+        delay = self.initialDelay
+        while True:
+            try:
+                transport, protocol = await loop.create_connection(
+                    lambda: RPCProtocol(self, loop, self.codec),
+                    self.host, self.port)
+            except OSError as e:
+                self.status = 'Connection failed. Reason: {}'.format(e)
+            else:
+                delay = self.initialDelay
+                await protocol.closed
+            RECONNECTS.inc()
+            delay = min(delay*self.factor, self.maxDelay)
+            if self.jitter:
+                delay = max(0, random.normalvariate(delay,
+                                                    delay*self.jitter))
+            await asyncio.sleep(delay)
+
+    def startHeartbeat(self):
+        self.stopHeartbeat()
+        self._heartbeat = self.loop.create_task(self._runHeartbeat())
+
+    def stopHeartbeat(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+
+    async def _replayThenSync(self):
+        await self.replayOutbox()
+        await self._runHeartbeat()
+
+    async def replayOutbox(self):
+        """ Send the changes made while disconnected in a single setState
+            call, see takeOutbox.
+        """
+        protocol = self._protocol
+        try:
+            state = await protocol.getState()
+        except Exception as e:
+            log.error("Error getting thermostat state: %s %s", type(e), e)
+            return
+        self._lastSync = self.now()
+        changes = self.takeOutbox(state)
+        if not changes:
+            return
+        try:
+            state = await protocol.setState(
+                **{k: v for k, (v, oldvalue) in changes.items()})
+        except Exception as e:
+            log.error("Error updating thermostat: %s %s", type(e), e)
+            self.requeueChanges(changes, e)
+            return
+        self.verifyChanges(changes, state)
+
+    async def _runHeartbeat(self):
+        while True:
+            await self.syncState()
+            await asyncio.sleep(self.heartbeatInterval)
+
+    def onConnect(self, protocol):
+        self._protocol = protocol
+        self.status = "Connected"
+        self.connected = True
+        self.resetState()
+        if self._outbox:
+            self._heartbeat = self.loop.create_task(self._replayThenSync())
+        else:
+            self.startHeartbeat()
+
+    def onConnectionLost(self, exc):
+        self.status = 'Connection lost. Reason: {}'.format(exc)
+        self.connected = False
+        self.stopHeartbeat()
+
+    async def syncState(self):
+        now = self.now()
+        if not self.needsSync(now):
+            #: Notifications are flowing so the link is alive
+            return
+        protocol = self._protocol
+        try:
+            state = await protocol.getState()
+        except Exception:
+            log.warning("Failed to sync with thermostat: %s",
+                        traceback.format_exc())
+            protocol.transport.close()
+            return
+        self._lastSync = now
+        self.applyState(state)
+
+    def flushChanges(self):
+        """ Send all pending changes in a single setState call then verify
+            each of them against the returned state.
+        """
+        return self.loop.create_task(self._flushChanges())
+
+    async def _flushChanges(self):
+        changes = self.takeChanges()
+        if not changes:
+            return
+        try:
+            #: Submit the changes
+            state = await self._protocol.setState(
+                **{k: v for k, (v, oldvalue) in changes.items()})
+        except Exception as e:
+            log.error("Error updating thermostat: %s %s", type(e), e)
+            self.requeueChanges(changes, e)
+            return
+        self.verifyChanges(changes, state)
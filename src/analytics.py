@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Heating and cooling analytics over the recorded history (see history.py).
+
+The heat and cool series hold a sample each time the system turned on (1)
+or off (0) so they are read as step functions and turned into on
+intervals. From those the runtime, duty cycle and cycles of any period are
+computed along with short cycles. The outside series is used for degree
+hours so runtime can be compared against the weather.
+
+Everything is vectorised with numpy so months of samples can be analysed
+on the device. Series for charts are downsampled with LTTB so the UI never
+gets the raw points.
+
+"""
+import time
+from datetime import date, datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#: Default degree hour base temperature (C)
+BASE_TEMP = 18.0
+
+#: On or off periods shorter than this (seconds) are short cycles
+MIN_ON = 300.0
+MIN_OFF = 300.0
+
+
+def samples(series, since=None):
+    """ Read the raw samples of a history series as arrays of times and
+    values sorted by time. When a time is given the last sample before it is
+    kept so the state at that time is known.
+
+    """
+    values = series.samples(since)
+    if not len(values):
+        return np.empty(0), np.empty(0)
+    values = np.frombuffer(values, dtype=np.float64).reshape(-1, 2)
+    order = np.argsort(values[:, 0], kind='mergesort')
+    t, v = values[order, 0], values[order, 1]
+    if since is not None and len(t):
+        i = max(0, np.searchsorted(t, since, side='right')-1)
+        t, v = t[i:], v[i:]
+    return t, v
+
+
+def intervals(t, v, end=None):
+    """ Return arrays of the start and end times the value was on (> 0.5).
+    A period that is still on ends at the given end time or the last
+    sample.
+
+    """
+    if not len(t):
+        return t, t
+    on = v > 0.5
+    was_on = np.concatenate(([False], on[:-1]))
+    starts = t[on & ~was_on]
+    ends = t[~on & was_on]
+    if len(ends) < len(starts):
+        last = t[-1] if end is None else max(end, t[-1])
+        ends = np.append(ends, last)
+    return starts, ends
+
+
+def day_edges(end, days):
+    """ Return the times of the local midnights starting the given number
+    of days before the day of end up to and including the one after it.
+
+    """
+    last = date.fromtimestamp(end)
+    return np.array([
+        time.mktime((last-timedelta(days=d)).timetuple())
+        for d in range(days-1, -2, -1)])
+
+
+def on_time(starts, ends, t):
+    """ Total seconds on before each of the times in t """
+    total = np.concatenate(([0.0], np.cumsum(ends-starts)))
+    i = np.searchsorted(starts, t, side='right')
+    result = total[i]
+    started = i > 0
+    last = i[started]-1
+    result[started] -= np.maximum(0.0, ends[last]-t[started])
+    return result
+
+
+def runtime(starts, ends, edges):
+    """ Seconds on within each period between the edges """
+    return np.diff(on_time(starts, ends, edges))
+
+
+def duty_cycle(starts, ends, edges):
+    """ Fraction of each period between the edges that was on """
+    return runtime(starts, ends, edges)/np.diff(edges)
+
+
+def cycles(starts, edges):
+    """ Number of times it turned on in each period between the edges """
+    return np.diff(np.searchsorted(starts, edges))
+
+
+def short_cycles(starts, ends, min_on=MIN_ON, min_off=MIN_OFF):
+    """ Return a mask of the intervals that were on for less than min_on or
+    started less than min_off after the previous one ended.
+
+    """
+    if not len(starts):
+        return np.zeros(0, dtype=bool)
+    off = np.concatenate(([np.inf], starts[1:]-ends[:-1]))
+    return ((ends-starts) < min_on) | (off < min_off)
+
+
+def degree_hours(t, temp, edges, base=BASE_TEMP, step=300.0):
+    """ Return the heating and cooling degree hours in each period between
+    the edges. The temperature is interpolated between the first and last
+    sample, periods without any sample are NaN.
+
+    """
+    below = np.full(len(edges)-1, np.nan)
+    above = np.full(len(edges)-1, np.nan)
+    if not len(t):
+        return below, above
+    grid = np.arange(max(edges[0], t[0]), min(edges[-1], t[-1]), step)
+    diff = base-np.interp(grid, t, temp)
+    i = np.searchsorted(grid, edges)
+    for result, x in ((below, np.maximum(diff, 0)),
+                      (above, np.maximum(-diff, 0))):
+        total = np.concatenate(([0.0], np.cumsum(x)))*(step/3600.0)
+        result[:] = total[i[1:]]-total[i[:-1]]
+    empty = np.diff(np.searchsorted(t, edges)) == 0
+    below[empty] = np.nan
+    above[empty] = np.nan
+    return below, above
+
+
+def finite(x):
+    """ Return the value as a float or None if it's NaN or infinite """
+    x = float(x)
+    return x if np.isfinite(x) else None
+
+
+def fit(x, y):
+    """ Least squares line through the finite points, returns
+    (slope, intercept) or None if there are less than two.
+
+    """
+    ok = np.isfinite(x) & np.isfinite(y)
+    if ok.sum() < 2 or np.ptp(x[ok]) == 0:
+        return None
+    slope, intercept = np.polyfit(x[ok], y[ok], 1)
+    return float(slope), float(intercept)
+
+
+def lttb(x, y, threshold):
+    """ Downsample to the given number of points with the largest triangle
+    three buckets algorithm which keeps the shape of the series. Returns
+    the x and y arrays.
+
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+    out = np.empty(threshold, dtype=np.intp)
+    out[0], out[-1] = 0, n-1
+
+    #: The points between the first and last are split into buckets
+    bounds = np.linspace(1, n-1, threshold-1).astype(np.intp)
+    a = 0
+    for i in range(threshold-2):
+        start, end = bounds[i], bounds[i+1]
+
+        #: Average of the next bucket (or the last point)
+        if i < threshold-3:
+            nxt = slice(bounds[i+1], bounds[i+2])
+            cx, cy = x[nxt].mean(), y[nxt].mean()
+        else:
+            cx, cy = x[-1], y[-1]
+
+        #: Pick the point making the largest triangle with the previous
+        #: selected point and the next bucket's average
+        ax, ay = x[a], y[a]
+        bx, by = x[start:end], y[start:end]
+        area = np.abs((ax-cx)*(by-ay)-(ax-bx)*(cy-ay))
+        a = start+int(np.argmax(area))
+        out[i+1] = a
+    return x[out], y[out]
+
+
+def chart(t, v, points, start=None):
+    """ Return a downsampled series as a list of (time, value) for charts """
+    if start is not None:
+        keep = t >= start
+        t, v = t[keep], v[keep]
+    ok = np.isfinite(v)
+    t, v = lttb(t[ok], v[ok], points)
+    return list(zip(t.tolist(), v.tolist()))
+
+
+def report(history, days=30, now=None, points=200, base=BASE_TEMP,
+           min_on=MIN_ON, min_off=MIN_OFF):
+    """ Analyse the last days of the history (a HistoryStore). Returns a
+    dict of plain lists so it can be bound to views directly:
+
+    - days: one dict per day, newest first, with the runtime (hours), duty
+      cycle, cycles per hour and short cycles of heat and cool and the
+      degree hours and mean outside temperature (None on days without any
+      outside temperature)
+    - heat / cool: totals over the whole period and the fit of the daily
+      runtime against the degree hours (hours per degree hour)
+    - temp / outside: downsampled (time, value) series
+
+    Returns None when numpy is not installed.
+
+    """
+    if np is None:
+        return None
+    if now is None:
+        now = time.time()
+    edges = day_edges(now, days)
+    start = edges[0]
+
+    #: Today is only over so far
+    hours = np.diff(np.minimum(edges, now))/3600.0
+
+    outside_t, outside = samples(history.get('outside'), start)
+    heat_dh, cool_dh = degree_hours(outside_t, outside, edges, base)
+    i = np.searchsorted(outside_t, edges)
+    sums = np.concatenate(([0.0], np.cumsum(outside)))
+    counts = np.diff(i)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        outside_mean = (sums[i[1:]]-sums[i[:-1]])/counts
+
+    result = {'days': [], 'base': base}
+    stats = {}
+    for mode, dh in (('heat', heat_dh), ('cool', cool_dh)):
+        t, v = samples(history.get(mode), start)
+        starts, ends = intervals(t, v, now)
+        on = runtime(starts, ends, edges)/3600.0
+        n = cycles(starts, edges)
+        short = short_cycles(starts, ends, min_on, min_off)
+        n_short = cycles(starts[short], edges)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats[mode] = (on, on/hours, n/hours, n_short, dh)
+        result[mode] = {
+            'runtime': float(on.sum()),
+            'duty_cycle': float(on.sum()/hours.sum()),
+            'cycles': int(n.sum()),
+            'short_cycles': int(n_short.sum()),
+            'fit': fit(dh, on),
+        }
+
+    for d in reversed(range(days)):
+        row = {'date': datetime.fromtimestamp(edges[d]).strftime("%a %b %d"),
+               'outside_mean': finite(outside_mean[d])}
+        for mode, (on, duty, per_hour, n_short, dh) in stats.items():
+            row[mode] = {
+                'runtime': float(on[d]),
+                'duty_cycle': float(duty[d]),
+                'cycles_per_hour': float(per_hour[d]),
+                'short_cycles': int(n_short[d]),
+                'degree_hours': finite(dh[d]),
+            }
+        result['days'].append(row)
+
+    temp_t, temp = samples(history.get('temp'), start)
+    result['temp'] = chart(temp_t, temp, points, start)
+    result['outside'] = chart(outside_t, outside, points, start)
+    return result
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP response cache for the web APIs used by the app (ex. the weather).
+
+Responses are kept by key and saved to disk so they survive a restart. A
+cached response is handed out immediately even when it's stale and is then
+revalidated in the background with it's ETag (stale-while-revalidate).
+Concurrent fetches of the same key share a single request. A request
+that fails or gets no response within the timeout is given up on and the
+waiting callers are told.
+
+"""
+import os
+import re
+import json
+import time
+from atom.api import Atom, Dict, Float, Unicode
+from enaml.application import timed_call
+
+#: Max age from a Cache-Control header
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+def header(response, name):
+    """ Get a response header ignoring case, returns None if missing """
+    headers = getattr(response, 'headers', None) or {}
+    name = name.lower()
+    for k, v in headers.items():
+        if k.lower() == name:
+            return v
+    return None
+
+
+class ResponseCache(Atom):
+    #: File where the cache is saved, empty to only keep it in memory
+    path = Unicode()
+
+    #: Seconds a response is fresh when the server doesn't say otherwise
+    ttl = Float(600)
+
+    #: Seconds to wait for a response before giving up on a request
+    timeout = Float(30)
+
+    #: Cached responses by key. Each is a dict of the body, etag, the time
+    #: it was fetched or revalidated and how long it's fresh for.
+    entries = Dict()
+
+    #: List of (callback, errback) waiting on the request in flight for
+    #: each key
+    _inflight = Dict()
+
+    def _default_entries(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except Exception as e:
+            print("Failed to load cache {}: {}".format(self.path, e))
+            return {}
+
+    def save(self):
+        """ Write the cache to disk """
+        if not self.path:
+            return
+        try:
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+        except Exception as e:
+            print("Failed to save cache {}: {}".format(self.path, e))
+
+    def is_fresh(self, entry):
+        return time.time()-entry['time'] < entry['max_age']
+
+    def fetch(self, client, key, url, callback, errback=None):
+        """ Get the body of the url using the AsyncHttpClient. The callback
+        is called with the body and must return whether it's valid, only
+        valid bodies are cached.
+
+        If a cached body exists the callback is called with it right away.
+        When it's stale the url is requested again and the callback is
+        called a second time only if the body changed. The errback is
+        called with a message if the request fails or times out.
+
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            callback(entry['body'])
+            if self.is_fresh(entry):
+                return
+        if key in self._inflight:
+            self._inflight[key].append((callback, errback))
+            return
+        waiting = self._inflight[key] = [(callback, errback)]
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        print("Fetching {}".format(url))
+        client.fetch(url, headers=headers, raise_error=False).then(
+            lambda response: self._on_response(key, response, waiting))
+        timed_call(int(self.timeout*1000), self._on_timeout, key, waiting)
+
+    def _on_timeout(self, key, waiting):
+        """ Give up on the request if it's still in flight """
+        if self._inflight.get(key) is not waiting:
+            return
+        del self._inflight[key]
+        self._fail(waiting, "Request for {} timed out".format(key))
+
+    def _fail(self, waiting, message):
+        print(message)
+        for callback, errback in waiting:
+            if errback is not None:
+                errback(message)
+
+    def _on_response(self, key, response, waiting):
+        if self._inflight.get(key) is not waiting:
+            #: It already timed out
+            return
+        del self._inflight[key]
+        callbacks = [callback for callback, errback in waiting]
+        entry = self.entries.get(key)
+        max_age = self.ttl
+        cache_control = header(response, 'Cache-Control')
+        if cache_control:
+            m = MAX_AGE.search(cache_control)
+            if m:
+                max_age = float(m.group(1))
+
+        if response.code == 304 and entry is not None:
+            #: Not modified, the callbacks already have the body
+            entry['time'] = time.time()
+            entry['max_age'] = max_age
+            self.save()
+            return
+        if not response.ok:
+            self._fail(waiting, "Request for {} failed: {}".format(
+                key, response.code))
+            return
+
+        body = response.body
+        if entry is not None and entry['body'] == body:
+            entry['time'] = time.time()
+            entry['max_age'] = max_age
+            self.save()
+            return
+
+        valid = False
+        for callback in callbacks:
+            if callback(body):
+                valid = True
+        if valid:
+            self.entries[key] = {
+                'body': body,
+                'etag': header(response, 'ETag'),
+                'time': time.time(),
+                'max_age': max_age,
+            }
+            self.save()
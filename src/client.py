@@ -1,304 +1,589 @@
-import math
-import json
+import heapq
 import logging
 import traceback
 from collections import OrderedDict
-from datetime import datetime, timedelta
-from atom.api import (
-    Atom, FloatRange, Callable, Float, Enum, Int, Bool, Instance, Unicode
-)
+from atom.api import Int, Instance
 
 from twisted.internet import reactor
-from twisted.protocols.basic import LineReceiver
-from twisted.internet.defer import inlineCallbacks, Deferred, returnValue
-from twisted.internet.protocol import connectionDone
+from twisted.internet.error import ConnectError, NotConnectingError
+from twisted.internet.defer import (
+    inlineCallbacks, Deferred, returnValue, CancelledError
+)
+from twisted.internet.protocol import Protocol, connectionDone
 from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
+from framing import FrameTooLong
+from codec import lookup
+from metrics import registry
+from sync import RPCError, RPCMixin, ThermostatState
+
+try:
+    from twisted.internet.serialport import SerialPort
+except ImportError:
+    #: pyserial is only needed for serial connections
+    SerialPort = None
 
 log = logging.getLogger("enaml")
 
+RPC_LATENCY = registry.histogram(
+    'thermostat_rpc_latency_seconds',
+    "Time until the response of a request is received", ('method',))
+RPC_PENDING = registry.gauge(
+    'thermostat_rpc_pending', "Requests waiting for a response")
+RPC_TIMEOUTS = registry.counter(
+    'thermostat_rpc_timeouts_total', "Requests that timed out", ('method',))
+RPC_ERRORS = registry.counter(
+    'thermostat_rpc_errors_total', "Requests that failed", ('method',))
+NOTIFICATIONS = registry.counter(
+    'thermostat_notifications_total', "Notifications received")
+RECONNECTS = registry.counter(
+    'thermostat_reconnects_total',
+    "Times a connection was lost or failed and will be retried")
+
+
+class RPCProtocol(Protocol, RPCMixin):
+    """ Calling a remote method returns a Deferred with the result.
+    Requests that get no response within their timeout are cancelled.
 
-class RPCError(Exception):
-    pass
+    """
+    #: Max size of a single message in bytes
+    MAX_LENGTH = 16384
 
+    #: Timeouts (in seconds) for specific methods, others use _timeout
+    timeouts = {}
 
-class RPCProtocol(LineReceiver, object):
-    def __init__(self):
+    #: Number of ids of cancelled requests kept to drop their late responses
+    MAX_CANCELLED = 256
+
+    def __init__(self, codec='json'):
+        #: Encodes the requests and decodes the stream, see codec.py
+        self.codec = lookup(codec)
+
+        #: Pending requests by id
         self._queue = OrderedDict()
-        self.delimiter = '}'
-        self.msgbuf = b''
+
+        #: Ids of requests that were cancelled (ex. timed out), a response
+        #: to them that arrives late is dropped
+        self._cancelled = OrderedDict()
+
+        #: Heap of (deadline, id) for the pending requests. Entries for
+        #: requests that already got a response are skipped when popped.
+        self._deadlines = []
+
+        #: Timer for the earliest deadline
+        self._timer = None
+
+        self._framer = self.codec.framer(self.MAX_LENGTH)
         self._id = 0
         self._timeout = 3.0
-    
-    def __getattr__(self, attr):
-        """ When no method or property is defined here,
-              try to access the method remotely on the Thermostat
-              by doing an RPC call.
-        """
-        if attr.startswith("_"):
-            return super(RPCProtocol, self).__getattr__(attr)
-        
+        self.timeouts = dict(self.timeouts)
+
+    @property
+    def pending(self):
+        """ Number of requests waiting for a response """
+        return len(self._queue)
+
+    @classmethod
+    def _makeStub(cls, method):
         @inlineCallbacks
-        def call(*args,**kwargs):
-            if args and kwargs:
-                raise RPCError("Can only do RPC calls with either args or "
-                               "kwargs, not both.")
-            params = args or kwargs
-            self._id += 1
-            request = {'method': attr, 'id': self._id, 'jsonrpc': '2.0'}
-            if params:
-                request['params'] = params
-            log.info("request: {}".format(request))
-            d = self.sendRequest(request)
-            reactor.callLater(self._timeout, d.cancel)
-            #log.info("waiting for response...")
-            response = yield d
-            log.info("response: {}".format(response))
-            
-            if 'result' in response:
-                returnValue(response['result'])
-            else:
-                raise RPCError(response['error'])
+        def call(self, *args, **kwargs):
+            request = self._buildRequest(method, args, kwargs)
+            log.info("request: %s", request)
+            response = yield self.sendRequest(request)
+            log.info("response: %s", response)
+            returnValue(self._getResult(response))
+        call.__name__ = str(method)
         return call
-    
+
+    def batch(self):
+        """ Start a batch of calls that are sent together as a single
+        JSON-RPC 2.0 batch array. See RPCBatch.
+        """
+        return RPCBatch(self)
+
     def connectionMade(self):
         super(RPCProtocol, self).connectionMade()
         log.info("Thermostat connection made")
         self.factory.onConnect()
     
-    def lineReceived(self, line):
-        #: Add the delimiter back on
-        self.msgbuf += line+self.delimiter
-        
-        #: Called when we get a closing bracket    
+    def dataReceived(self, data):
+        """ Cut complete messages out of the stream and dispatch them """
         try:
-            response = json.loads(self.msgbuf)
-            self.msgbuf = b''
-        except ValueError:
-            #: Message not ready
-            #log.info("message not yet ready {}".format(self.msgbuf))
+            messages = self._framer.feed(data)
+        except FrameTooLong as e:
+            self.lengthExceeded(e)
+            return
+        for msg in messages:
+            if isinstance(msg, (dict, list)):
+                self.messageReceived(msg)
+            else:
+                log.warning("Discarding invalid message: %s", msg)
+
+    def lengthExceeded(self, error):
+        """ Called when a message exceeds MAX_LENGTH. The stream can no
+        longer be trusted so drop the connection.
+
+        """
+        log.error("Thermostat message too long: %s", error)
+        self.transport.loseConnection()
+
+    def messageReceived(self, response):
+        """ Dispatch a decoded message to the pending request or handle
+        it as a notification.
+
+        """
+        log.debug("Received message: %s", response)
+        if isinstance(response, list):
+            #: Batch response
+            for item in response:
+                if isinstance(item, dict):
+                    self.messageReceived(item)
             return
-        log.debug("Received message: {}".format(response))
         req_id = response.get('id', None)
         if req_id:
             if req_id in self._queue:
-                d = self._queue[req_id]
-            else:
+                d = self._queue.pop(req_id)
+            elif self._cancelled.pop(req_id, False):
+                log.warning("Discarding late response: %s", response)
+                return
+            elif self._queue:
                 # Set it as the most recent request ?
                 req_id, d = self._queue.popitem(last=True)
-                
-            d.callback(response)
-            del self._queue[req_id]
+            else:
+                log.warning("Discarding unexpected response: %s", response)
+                return
+            self._discardDeadlines()
+            if not d.called:
+                d.callback(response)
         else:
             self.msgReceived(response)
             
     def msgReceived(self, msg):
-        log.info("Notification: {}".format(msg))
+        log.info("Notification: %s", msg)
+        NOTIFICATIONS.inc()
         self.factory.onNotify(msg)
 
     def sendRequest(self, request):
-        """ Send an RPC request """
-        msg = json.dumps(request)
-        resp = Deferred()
-        resp.time = datetime.now()
-        self._clean()
-        self._queue[request['id']] = resp
+        """ Send an RPC request. The returned Deferred is cancelled if no
+        response arrives before the method's timeout.
+        """
+        msg = self.codec.encode(request)
+        resp = self._expect(request)
         self.transport.write(msg)
         return resp
-    
-    def _clean(self):
-        #: Remove old items
-        now = datetime.now()
-        for k,d in self._queue.iteritems():
-            if now-d.time > timedelta(seconds=30):
-                del self._queue[k]
+
+    def sendBatch(self, requests):
+        """ Send a list of RPC requests as a batch. Returns a list with a
+        Deferred for each request.
+        """
+        msg = self.codec.encode(requests)
+        responses = [self._expect(request) for request in requests]
+        self.transport.write(msg)
+        return responses
+
+    def _expect(self, request):
+        """ Add a pending request and schedule it's deadline """
+        req_id = request['id']
+        timeout = self.timeouts.get(request['method'], self._timeout)
+        deadline = reactor.seconds()+timeout
+        resp = Deferred(lambda d: self._cancel(req_id))
+        self._queue[req_id] = resp
+        heapq.heappush(self._deadlines, (deadline, req_id))
+        if self._deadlines[0][1] == req_id:
+            #: This is now the earliest deadline
+            self._armTimer()
+        RPC_PENDING.inc()
+        resp.addBoth(self._requestDone, request['method'], reactor.seconds())
+        return resp
+
+    def _cancel(self, req_id):
+        """ Stop waiting for the request and remember it's id """
+        if self._queue.pop(req_id, None) is None:
+            return
+        cancelled = self._cancelled
+        cancelled[req_id] = True
+        while len(cancelled) > self.MAX_CANCELLED:
+            cancelled.popitem(last=False)
+
+    def _requestDone(self, result, method, start):
+        """ Record the outcome of a request """
+        RPC_PENDING.dec()
+        if not isinstance(result, Failure):
+            RPC_LATENCY.observe(reactor.seconds()-start, method)
+        elif result.check(CancelledError):
+            RPC_TIMEOUTS.inc(1, method)
+        else:
+            RPC_ERRORS.inc(1, method)
+        return result
+
+    def _armTimer(self):
+        """ Arm the timer to fire at the earliest deadline """
+        timer = self._timer
+        if not self._deadlines:
+            if timer is not None and timer.active():
+                timer.cancel()
+            self._timer = None
+            return
+        delay = max(0, self._deadlines[0][0]-reactor.seconds())
+        if timer is not None and timer.active():
+            timer.reset(delay)
+        else:
+            self._timer = reactor.callLater(delay, self._expire)
+
+    def _discardDeadlines(self):
+        """ Pop deadlines of requests that are no longer pending from the
+        top of the heap so the timer only fires when something expires.
+        """
+        deadlines, queue = self._deadlines, self._queue
+        if not deadlines or deadlines[0][1] in queue:
+            return
+        while deadlines and deadlines[0][1] not in queue:
+            heapq.heappop(deadlines)
+        self._armTimer()
+
+    def _expire(self):
+        """ Cancel every pending request that passed it's deadline """
+        self._timer = None
+        now = reactor.seconds()
+        deadlines, queue = self._deadlines, self._queue
+        while deadlines and deadlines[0][0] <= now:
+            deadline, req_id = heapq.heappop(deadlines)
+            d = queue.get(req_id)
+            if d is not None:
+                log.warning("Request %s timed out", req_id)
+                d.cancel()
+        self._discardDeadlines()
+        self._armTimer()
     
     def connectionLost(self, reason=connectionDone):
         super(RPCProtocol, self).connectionLost(reason)
         log.warning("Thermostat connection lost")
+
+        #: Fail anything still waiting for a response
+        queue, self._queue = self._queue, OrderedDict()
+        self._deadlines = []
+        self._armTimer()
+        for d in queue.values():
+            if not d.called:
+                d.errback(reason)
+
+
+class RPCBatch(object):
+    """ Collects RPC calls and sends them as a single JSON-RPC 2.0 batch
+    when committed. Each call returns a Deferred that fires with it's own
+    result once the batch response arrives.
+
+        batch = protocol.batch()
+        state = batch.getState()
+        result = batch.setState(desiredTemp=21.0)
+        batch.commit()
+
+    Note: The stock firmware only handles single requests, batches are for
+    servers that support them (ex. the device emulator or a gateway).
+
+    """
+    def __init__(self, protocol):
+        self._protocol = protocol
+        self._calls = []
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+
+        def call(*args, **kwargs):
+            request = self._protocol._buildRequest(attr, args, kwargs)
+            d = Deferred()
+            self._calls.append((request, d))
+            return d
+        return call
+
+    def __len__(self):
+        return len(self._calls)
+
+    def commit(self):
+        """ Send all the queued calls """
+        calls, self._calls = self._calls, []
+        if not calls:
+            return
+        protocol = self._protocol
+        requests = [request for request, d in calls]
+        log.info("batch request: %s", requests)
+        responses = protocol.sendBatch(requests)
+        for (request, d), resp in zip(calls, responses):
+            resp.addCallback(protocol._getResult)
+            resp.chainDeferred(d)
         
 
-class Thermostat(ReconnectingClientFactory, Atom):
-    #: Used to block sending updates 
-    _syncing = Bool()
+class Thermostat(ReconnectingClientFactory, ThermostatState):
     _heartbeat = Instance(LoopingCall)
     _protocol = Instance(RPCProtocol)
-    
-    #: Validation precision for floats
-    _precision = Int(12)
 
     #: Max delay between reconnect attempts (seconds)
     maxDelay = Int(5)
-    
-    #: Connected flag
-    connected = Bool().tag(local=True)
-    
-    #: Status / error messges
-    status = Unicode().tag(local=True)
-    
-    #: State variables 
-    tempPin1 = Int(6)
-    tempPin2 = Int(7)
-    ledPin = Int(13)
-    fanPin = Int(9)
-    fireplacePin = Int(10)
-    heatPin = Int(11)
-    coolPin = Int(12)
-    
-    ledActive = Bool()
-    fireplaceActive = Bool()
-    fanActive = Bool()
-    heatActive = Bool()
-    coolActive = Bool()
-    hysteresisTemp = FloatRange(low=0.2, high=10.0, value=0.6)
-    desiredTemp = Float(24.0)
-    insideTemp = Float(24.0).tag(readonly=True)
-    insideHumidity = Float(50.0).tag(readonly=True)
-    outsideTemp = Float(24.0).tag(readonly=True)
-    outsideHumidity = Float(50.0).tag(readonly=True)
-
-    wifiSsid = Unicode()
-    wifiPass = Unicode()
-    wifiIp = Unicode()
-
-    fanPresent = Bool()
-    fireplacePresent = Bool()
-    heatPresent = Bool()
-    coolPresent = Bool()
-    
-    heatMode = Enum("furnace", "fireplace")
-    fanMode = Enum("off", "auto")
-    systemMode = Enum("off", "heat", "cool")
-    version = Unicode()
 
-    #: Listen to messages
-    listener = Callable()
-    
+    #: Shared heartbeat scheduler (see pool.HeartbeatScheduler). When set
+    #: the heartbeat is driven by the scheduler instead of a LoopingCall
+    #: owned by this thermostat.
+    scheduler = Instance(object).tag(local=True)
+
+    #: Shared reconnect coordinator (see pool.ReconnectCoordinator). When
+    #: set it decides when to retry and limits how many thermostats connect
+    #: and do their initial sync at once.
+    coordinator = Instance(object).tag(local=True)
+
     def __init__(self, *args, **kwargs):
         super(Thermostat, self).__init__(*args, **kwargs)
         self._heartbeat = LoopingCall(self.syncState)
-        self.bindObservers()
-        
+
+    def now(self):
+        return reactor.seconds()
+
+    def callLater(self, delay, f):
+        return reactor.callLater(delay, f)
+
+    def cancelCall(self, call):
+        if call.active():
+            call.cancel()
+
     def startHeartbeat(self):
-        self._heartbeat.start(30)
+        if self.scheduler is not None:
+            self.scheduler.register(self)
+        else:
+            #: With a coordinator the initial sync was already done
+            self._heartbeat.start(self.heartbeatInterval,
+                                  now=self.coordinator is None)
     
     def stopHeartbeat(self):
+        if self.scheduler is not None:
+            self.scheduler.unregister(self)
         if self._heartbeat.running:
             self._heartbeat.stop()
     
     def buildProtocol(self, addr):
-        self.resetDelay()
-        p = RPCProtocol()
+        p = RPCProtocol(self.codec)
         p.factory = self
         self._protocol = p
         return p
     
-    def bindObservers(self):
-        """ Bind _on_change to any members not tagged as readonly"""
-        for name, m in self.members().items():
-            if ((m.metadata and
-                     (m.metadata.get('readonly', False) or
-                      m.metadata.get('local', False)))
-                    or name.startswith("_")):
-                continue
-            self.observe(name, self.onChange)
-    
+    @inlineCallbacks
     def onConnect(self):
+        self.resetDelay()
         self.status = "Connected"
         self.connected = True
-        self.startHeartbeat()
+        self.resetState()
+        if self._outbox:
+            yield self.replayOutbox()
+        if self.coordinator is not None and self.connected:
+            #: The initial sync is part of the connection attempt
+            if not self._snapshot:
+                yield self.syncState()
+            if self.connected:
+                self.coordinator.connected(self)
+        if self.connected:
+            self.startHeartbeat()
+
+    @inlineCallbacks
+    def replayOutbox(self):
+        """ Send the changes made while disconnected in a single setState
+            call, see takeOutbox.
+        """
+        protocol = self._protocol
+        try:
+            state = yield protocol.getState()
+        except Exception as e:
+            log.error("Error getting thermostat state: %s %s", type(e), e)
+            return
+        self._lastSync = self.now()
+        changes = self.takeOutbox(state)
+        if not changes:
+            return
+        try:
+            state = yield protocol.setState(
+                **{k: v for k, (v, oldvalue) in changes.items()})
+        except Exception as e:
+            log.error("Error updating thermostat: %s %s", type(e), e)
+            self.requeueChanges(changes, e)
+            return
+        self.verifyChanges(changes, state)
     
     @inlineCallbacks      
     def syncState(self):
+        now = reactor.seconds()
+        if not self.needsSync(now):
+            #: Notifications are flowing so the link is alive
+            return
+
         try:
             state = yield self._protocol.getState()
         except Exception as e:
-            log.warning("Failed to sync with thermostat: {}".format(
-                traceback.format_exc()))
+            log.warning("Failed to sync with thermostat: %s",
+                        traceback.format_exc())
             self._protocol.transport.loseConnection()
             return        
-            
-        self._syncing = True
-        try:
-            for k, v in state.items():
-                if hasattr(self, k):
-                    try:
-                        setattr(self, k, v)
-                    except Exception as e:
-                        log.warning("Failed to sync with thermostat: "
-                                    "{} {}".format(k, v))
-        finally:
-            self._syncing = False        
-    
+        self._lastSync = now
+        self.applyState(state)
+
     @inlineCallbacks
-    def onChange(self, change): 
-        """ Called when one of the members changes. 
-            Sends RPC command to set the state on the Thermostat.
-            @param change: member change dict from this object
+    def flushChanges(self):
+        """ Send all pending changes in a single setState call then verify
+            each of them against the returned state.
         """
-        if self.listener:
-            self.listener(change)
-        if self.connected and not self._syncing:
-            prec = self._precision
-            try:
-                k, v = change['name'], change['value']
-                
-                #: Submit the change
-                state = yield self._protocol.setState(**{k:v})
-                
-                #: Verify the change
-                result = state.get(k, change['oldvalue'])
-                
-                #: Special case for float rounding errors
-                ok = True
-                if type(result) == float:
-                    if round(result, prec) != round(v, prec):
-                        ok = False
-                elif result != v:
-                    ok = False
-                
-                #: Undo change in UI
-                if not ok:
-                    log.error("Failed to update value {} to {}, "
-                              "got {}".format(k, v, result))
-                    self._syncing = True
-                    try:
-                        setattr(self, k, change['oldvalue'])
-                    finally:
-                        self._syncing = False
-            except Exception as e:
-                log.error("Error updating thermostat: "
-                          "{} {}".format(type(e), e))
-    
-    def onNotify(self, change):
-        """ Called when a notification is received from the thermostat. 
-            Updates the state variable.
-            @param change: member change dict from thermostat
-        """
-        if self.listener:
-            self.listener(change)
-        if change.get('type', None) == 'update':
-            k, v = change['name'], change['value']
-            self._syncing = True
-            try:
-                # Discard all nan values
-                if isinstance(v, float) and math.isnan(v):
-                    return
-                if hasattr(self, k):
-                    setattr(self, k, v)
-            except Exception as e:
-                log.error("Failed to sync with thermostat: {} {}".format(k, v))
-            finally:
-                self._syncing = False
-            
+        changes = self.takeChanges()
+        if not changes:
+            return
+        try:
+            #: Submit the changes
+            state = yield self._protocol.setState(
+                **{k: v for k, (v, oldvalue) in changes.items()})
+        except Exception as e:
+            log.error("Error updating thermostat: %s %s", type(e), e)
+            self.requeueChanges(changes, e)
+            return
+        self.verifyChanges(changes, state)
+
+    def retry(self, connector=None):
+        if self.coordinator is None:
+            return super(Thermostat, self).retry(connector)
+        if not self.continueTrying:
+            return
+        if connector is None:
+            connector = self.connector
+        self.connector = connector
+        self.coordinator.retry(self, connector)
+
     def clientConnectionLost(self, connector, reason):
         self.status = 'Connection lost. Reason: {}'.format(reason)
         self.connected = False
         self.stopHeartbeat()
+        RECONNECTS.inc()
+        if self.coordinator is not None:
+            self.coordinator.lost(self)
         super(Thermostat, self).clientConnectionLost(connector, reason)
 
     def clientConnectionFailed(self, connector, reason):
         self.status = 'Connection failed. Reason: {}'.format(reason)
         self.connected = False
         self.stopHeartbeat()
+        RECONNECTS.inc()
+        if self.coordinator is not None:
+            self.coordinator.failed(self)
         super(Thermostat, self).clientConnectionFailed(connector, reason)
+
+
+if SerialPort is not None:
+    class SerialTransport(SerialPort):
+        """ A SerialPort that tells it's connector when it's lost """
+
+        def __init__(self, connector, protocol, device, reactor, baudrate):
+            self.connector = connector
+            SerialPort.__init__(self, protocol, device, reactor,
+                                baudrate=baudrate)
+
+        def connectionLost(self, reason):
+            SerialPort.connectionLost(self, reason)
+            self.connector.connectionLost(reason)
+
+
+class SerialConnector(object):
+    """ Connects a client factory over a serial port (ex. a board plugged in
+    over USB) like reactor.connectTCP does over TCP. The factory is told
+    when the port can't be opened or is lost so a Thermostat reconnects
+    the same way. Requests are pipelined and notifications handled by the
+    same RPCProtocol.
+
+    """
+    def __init__(self, factory, device, baudrate=115200):
+        if SerialPort is None:
+            raise ImportError("pyserial is required to connect over serial")
+        self.factory = factory
+        self.device = device
+        self.baudrate = baudrate
+        self.state = 'disconnected'
+        self.transport = None
+        self.factoryStarted = False
+        self._call = None
+
+    def connect(self):
+        """ Open the port on the next iteration of the reactor """
+        if self.state != 'disconnected':
+            raise RuntimeError("Can't connect in the current state")
+        self.state = 'connecting'
+        if not self.factoryStarted:
+            self.factory.doStart()
+            self.factoryStarted = True
+        self.factory.startedConnecting(self)
+        self._call = reactor.callLater(0, self._open)
+
+    def _open(self):
+        self._call = None
+        protocol = self.factory.buildProtocol(self.getDestination())
+        try:
+            self.transport = SerialTransport(self, protocol, self.device,
+                                             reactor, self.baudrate)
+        except Exception as e:
+            self.state = 'disconnected'
+            self.factory.clientConnectionFailed(
+                self, Failure(ConnectError(string=str(e))))
+            self._stopFactory()
+            return
+        self.state = 'connected'
+
+    def connectionLost(self, reason):
+        self.state = 'disconnected'
+        self.transport = None
+        self.factory.clientConnectionLost(self, reason)
+        self._stopFactory()
+
+    def _stopFactory(self):
+        #: Unless the factory is retrying
+        if self.state == 'disconnected' and self.factoryStarted:
+            self.factoryStarted = False
+            self.factory.doStop()
+
+    def stopConnecting(self):
+        if self.state != 'connecting':
+            raise NotConnectingError("We're not trying to connect")
+        self._call.cancel()
+        self._call = None
+        self.state = 'disconnected'
+        self._stopFactory()
+
+    def disconnect(self):
+        if self.state == 'connecting':
+            self.stopConnecting()
+        elif self.transport is not None:
+            self.transport.loseConnection()
+
+    def getDestination(self):
+        return self.device
+
+
+def parseAddress(address):
+    """ Parse an address as used by connect into ("tcp", host, port) or
+    ("serial", device, baudrate). Raises a ValueError if it's invalid and an
+    ImportError if pyserial is needed but not installed.
+
+    """
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return ('tcp', str(host), int(port))
+    if SerialPort is None:
+        raise ImportError("pyserial is required to connect to {}".format(
+            address))
+    device, _, baudrate = address.partition('@')
+    return ('serial', str(device), int(baudrate or 115200))
+
+
+def connect(address, factory):
+    """ Connect the factory to the thermostat at the given address. Either
+    "host:port" for TCP or the path of a serial device with an optional
+    baud rate (ex. "/dev/ttyACM0" or "COM3@115200"). Returns the connector.
+
+    """
+    kind, target, arg = parseAddress(address)
+    if kind == 'tcp':
+        return reactor.connectTCP(target, arg, factory)
+    connector = SerialConnector(factory, target, arg)
+    connector.connect()
+    return connector
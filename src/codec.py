@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Wire codecs for the RPC protocol. Each codec turns a message into bytes and
+provides a streaming framer that turns the bytes back into messages.
+
+- "json" uses the stdlib and is always available
+- "ujson" and "orjson" are faster JSON encoders used when installed
+- "auto" picks the fastest JSON codec that is installed
+- "msgpack" is a binary encoding for links where both ends are python
+  (ex. a client and a gateway or two gateways)
+
+The firmware only speaks JSON so a JSON codec must be used with devices.
+
+"""
+import json
+from collections import OrderedDict
+from framing import JSONFramer, FrameTooLong
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+#: Creating an encoder with options is slow so it's done once
+_dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+
+class JSONCodec(object):
+    """ The stdlib json codec """
+    name = 'json'
+
+    def encode(self, msg):
+        data = _dumps(msg)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data
+
+    def framer(self, max_length):
+        return JSONFramer(max_length)
+
+
+class UJSONCodec(JSONCodec):
+    name = 'ujson'
+
+    def encode(self, msg):
+        data = ujson.dumps(msg, ensure_ascii=False)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data
+
+    def framer(self, max_length):
+        return JSONFramer(max_length, loads=ujson.loads)
+
+
+class ORJSONCodec(JSONCodec):
+    name = 'orjson'
+
+    def encode(self, msg):
+        return orjson.dumps(msg)
+
+    def framer(self, max_length):
+        return JSONFramer(max_length, loads=orjson.loads)
+
+
+class MsgpackFramer(object):
+    """ Same interface as the JSONFramer for msgpack streams. msgpack
+    objects are self delimiting so the unpacker does the framing.
+
+    """
+    def __init__(self, max_length=16384):
+        #: Max size of a single message
+        self.max_length = max_length
+
+        #: Number of messages that failed to decode
+        self.dropped = 0
+
+        self.reset()
+
+    def feed(self, data):
+        """ Add data received from the transport and return a list of the
+        decoded messages that are now complete. Raises FrameTooLong if a
+        message grows past the max length.
+
+        """
+        try:
+            self._unpacker.feed(data)
+            return list(self._unpacker)
+        except msgpack.BufferFull:
+            self.reset()
+            raise FrameTooLong("Message exceeds {} bytes".format(
+                self.max_length))
+        except ValueError:
+            #: The stream can't be resynchronized, drop what was buffered
+            self.dropped += 1
+            self.reset()
+            return []
+
+    def reset(self):
+        """ Discard any partial message """
+        self._unpacker = msgpack.Unpacker(raw=False,
+                                          max_buffer_size=self.max_length)
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+
+    def encode(self, msg):
+        return msgpack.packb(msg, use_bin_type=True)
+
+    def framer(self, max_length):
+        return MsgpackFramer(max_length)
+
+
+#: Codecs by name, JSON codecs are in order of preference for "auto"
+CODECS = OrderedDict()
+if orjson is not None:
+    CODECS['orjson'] = ORJSONCodec()
+if ujson is not None:
+    CODECS['ujson'] = UJSONCodec()
+CODECS['json'] = JSONCodec()
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
+
+
+def available():
+    """ Names of the codecs that can be used """
+    return list(CODECS.keys())
+
+
+def lookup(name):
+    """ Return the codec with the given name. Raises a LookupError if it's
+    unknown or the library it needs is not installed.
+
+    """
+    if name == 'auto':
+        name = next(k for k, c in CODECS.items()
+                    if isinstance(c, JSONCodec))
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise LookupError("Codec {} is not available, use one of: {}".format(
+            name, ", ".join(['auto']+available())))
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming framer for the JSON-RPC messages sent by the thermostat.
+
+The firmware writes JSON objects back to back on the socket without any
+delimiter or length prefix so messages have to be cut by tracking the
+nesting depth of the stream.
+
+"""
+import re
+import json
+import codecs
+
+
+class FrameTooLong(Exception):
+    """ Raised when a message exceeds the framer's max length """
+
+
+class JSONFramer(object):
+    """ Cuts complete JSON objects (or batch arrays) out of a stream and
+    decodes them in a single pass.
+
+    When a segment holds whole messages they are decoded directly from the
+    buffer. Otherwise the brackets and strings of the partial message are
+    tracked and the scan resumes where the previous call left off, so the
+    stream is scanned once no matter how many segments a message arrives
+    in. Anything outside of a top level object or array is discarded.
+
+    A `loads` function (ex. from orjson or ujson) can be given to decode
+    the messages instead of the stdlib decoder. It can't report where a
+    message ends so the fast path only applies when the rest of the buffer
+    is a single message, otherwise the messages are scanned.
+
+    """
+    #: Skips everything up to the next bracket including whole strings and
+    #: captures what it stopped at. An opening quote is captured when the
+    #: string is not terminated yet and nothing when the buffer ran out.
+    _scan = re.compile(r'(?:[^{}\[\]"]+|"[^"\\]*(?:\\.[^"\\]*)*")*'
+                       r'([{}\[\]"]?)')
+
+    #: Characters that start a message
+    _opening = re.compile(r'[{\[]')
+
+    def __init__(self, max_length=16384, loads=None):
+        #: Max size of a single message
+        self.max_length = max_length
+
+        #: Number of complete frames that failed to decode
+        self.dropped = 0
+
+        self._decode = json.JSONDecoder().raw_decode
+        self._loads = loads
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buf = []
+        self._size = 0
+        self._pos = 0
+        self._depth = 0
+
+    def feed(self, data):
+        """ Add data received from the transport and return a list of the
+        decoded messages that are now complete. Raises FrameTooLong if a
+        message grows past the max length, the buffer is reset when this
+        occurs.
+
+        """
+        if not isinstance(data, str):
+            data = self._text.decode(data)
+        depth = self._depth
+        if depth:
+            #: Nothing can complete until a closing bracket arrives so just
+            #: hold onto the chunk
+            self._buf.append(data)
+            self._size += len(data)
+            if '}' not in data and ']' not in data:
+                return self._check_size([])
+            buf = ''.join(self._buf)
+        else:
+            buf = data
+        pos = self._pos
+        decode = self._decode
+        loads = self._loads
+        scan = self._scan.match
+        start = 0
+        messages = []
+        while True:
+            if depth == 0:
+                m = self._opening.search(buf, pos)
+                if m is None:
+                    break
+                start = m.start()
+
+                #: Fast path, the whole message may already be here
+                if loads is not None:
+                    if buf[-1] == '}' or buf[-1] == ']':
+                        try:
+                            messages.append(loads(buf[start:]))
+                            pos = len(buf)
+                            continue
+                        except ValueError:
+                            pass
+                elif buf.rfind('}') > start or buf.rfind(']') > start:
+                    try:
+                        msg, pos = decode(buf, start)
+                        messages.append(msg)
+                        continue
+                    except ValueError:
+                        pass
+                depth, pos = 1, start+1
+
+            #: Slow path, track the depth until the message is complete
+            while depth:
+                m = scan(buf, pos)
+                c = m.group(1)
+                pos = m.end()
+                if c == '{' or c == '[':
+                    depth += 1
+                elif c == '}' or c == ']':
+                    depth -= 1
+                else:
+                    if c:
+                        #: String is incomplete, resume from it's start
+                        pos -= 1
+                    break
+            if depth:
+                break
+            try:
+                if loads is None:
+                    messages.append(decode(buf, start)[0])
+                else:
+                    messages.append(loads(buf[start:pos]))
+            except ValueError:
+                self.dropped += 1
+
+        if depth:
+            partial = buf[start:]
+            self._buf = [partial]
+            self._size = len(partial)
+            self._pos = pos-start
+        else:
+            #: Nothing partial is left, drop any garbage in between
+            self._buf = []
+            self._size = self._pos = 0
+        self._depth = depth
+        return self._check_size(messages)
+
+    def _check_size(self, messages):
+        if self._size > self.max_length:
+            self.reset()
+            raise FrameTooLong("Message exceeds {} bytes".format(
+                self.max_length))
+        return messages
+
+    def reset(self):
+        """ Discard any partial message """
+        self._buf = []
+        self._size = self._pos = self._depth = 0
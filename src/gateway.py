@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Gateway that lets many clients share a single connection to each thermostat.
+
+The firmware only accepts a few clients at once and every app polls it on
+it's own. The gateway holds one connection per device and looks like the
+device to any number of clients (point the app's address at the gateway).
+
+- `getState` is answered from the last state reported by the device which
+  is kept current by it's notifications and the heartbeat.
+- `setState` is forwarded to the device one call at a time.
+- Notifications from the device are sent to every client.
+
+Clients can use a faster codec than the device (ex. msgpack between two
+gateways or a gateway and a python client), see --codec.
+
+A device plugged in over USB is served the same way using it's serial
+port instead of the host and port (ex. /dev/ttyACM0=9888), this gives
+clients a low and stable latency without depending on the Wi-Fi.
+
+Usage:
+
+    python src/gateway.py 192.168.1.101:8888=9888 192.168.1.102:8888=9889
+
+"""
+import logging
+import argparse
+from atom.api import Instance
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredLock, inlineCallbacks, returnValue
+from client import Thermostat, RPCError, connect
+from server import RPCServerFactory
+from codec import lookup
+
+log = logging.getLogger("enaml")
+
+
+class UpstreamThermostat(Thermostat):
+    """ The gateway's connection to the device, forwards every notification
+    to the gateway's clients.
+
+    """
+    #: Gateway to notify
+    gateway = Instance(object).tag(local=True)
+
+    def onNotify(self, change):
+        super(UpstreamThermostat, self).onNotify(change)
+        if self.gateway is not None:
+            self.gateway.notifyAll(change)
+
+
+class DeviceGateway(RPCServerFactory):
+    """ Serves the RPC API of a single device to any number of clients """
+
+    def __init__(self, upstream, codec='json'):
+        super(DeviceGateway, self).__init__()
+        self.codec = codec
+        #: Connection to the device
+        self.upstream = upstream
+        upstream.gateway = self
+
+        #: setState calls are sent to the device one at a time
+        self._lock = DeferredLock()
+
+    def _protocol(self):
+        upstream = self.upstream
+        if not upstream.connected or upstream._protocol is None:
+            raise RPCError("Thermostat is not connected")
+        return upstream._protocol
+
+    # -------------------------------------------------------------------------
+    # RPC API
+    # -------------------------------------------------------------------------
+    def rpc_getState(self, **params):
+        """ Return the cached state, the device is only asked if nothing
+        has been received from it since it connected.
+
+        """
+        protocol = self._protocol()
+        snapshot = self.upstream._snapshot
+        if snapshot:
+            return dict(snapshot)
+        return self._fetchState(protocol)
+
+    @inlineCallbacks
+    def _fetchState(self, protocol):
+        state = yield protocol.getState()
+        self.upstream.applyState(state)
+        returnValue(state)
+
+    def rpc_setState(self, **params):
+        return self._lock.run(self._setState, params)
+
+    @inlineCallbacks
+    def _setState(self, params):
+        state = yield self._protocol().setState(**params)
+        self.upstream.applyState(state)
+        returnValue(state)
+
+
+def serve(device, port, interface='', client_codec='json', **kwargs):
+    """ Connect to the device at the address ("host:port" or a serial
+    device, see client.connect) and serve it on the given port using the
+    client_codec. The kwargs are passed to the
+    UpstreamThermostat. Returns the gateway.
+
+    """
+    upstream = UpstreamThermostat(**kwargs)
+    gateway = DeviceGateway(upstream, client_codec)
+    connect(device, upstream)
+    reactor.listenTCP(port, gateway, interface=interface)
+    log.info("Serving %s on port %s", device, port)
+    return gateway
+
+
+def main():
+    doc = __doc__.strip().split("\n\n")[0]
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('devices', nargs='+', metavar='ADDRESS=LISTEN',
+                        help="Device address (host:port or a serial device "
+                             "like /dev/ttyACM0@115200) and the port to "
+                             "serve it on")
+    parser.add_argument('--interface', default='',
+                        help="Interface to listen on (default all)")
+    parser.add_argument('--heartbeat', type=float, default=30,
+                        help="Seconds between state syncs with the device")
+    parser.add_argument('--codec', default='json',
+                        help="Codec spoken to the clients (default json)")
+    parser.add_argument('--upstream-codec', default='json',
+                        help="Codec spoken to the device, only a gateway "
+                             "understands anything but json")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+    for name in (args.codec, args.upstream_codec):
+        try:
+            lookup(name)
+        except LookupError as e:
+            parser.error(str(e))
+    for spec in args.devices:
+        try:
+            device, port = spec.split('=')
+            serve(device, int(port), args.interface, args.codec,
+                  heartbeatInterval=args.heartbeat,
+                  codec=args.upstream_codec)
+        except ValueError:
+            parser.error("Invalid device {}".format(spec))
+        except ImportError as e:
+            parser.error(str(e))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
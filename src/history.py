@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+Time series storage for the thermostat history (temperature, humidity and
+heat / cool runtime).
+
+Recent samples are kept in fixed capacity ring buffers backed by arrays and
+every sample is appended to a memory mapped segment file on disk. Samples
+are also rolled up into 1 minute, 1 hour and 1 day min / max / mean buckets
+which are stored the same way. Appending is O(1) and never rewrites
+existing data, old segment files are simply deleted.
+
+"""
+import os
+import glob
+import mmap
+import time
+import struct
+from array import array
+from atom.api import Atom, Dict, Int, Unicode
+
+#: Rollup resolutions and their bucket width in seconds
+ROLLUPS = (
+    ('1m', 60),
+    ('1h', 60*60),
+    ('1d', 24*60*60),
+)
+
+
+class RingBuffer(object):
+    """ A fixed capacity buffer of rows of floats. Each column is stored in
+    it's own array so a column can be copied out without unpacking rows.
+
+    """
+    def __init__(self, capacity, columns=2):
+        self.capacity = capacity
+        self.columns = [array('d', [0.0])*capacity for i in range(columns)]
+        self._start = 0
+        self._size = 0
+
+    def append(self, row):
+        """ Add a row, overwriting the oldest one when full """
+        capacity = self.capacity
+        i = self._start+self._size
+        if i >= capacity:
+            i -= capacity
+        for column, value in zip(self.columns, row):
+            column[i] = value
+        if self._size < capacity:
+            self._size += 1
+        else:
+            self._start = i+1 if i+1 < capacity else 0
+
+    def column(self, index):
+        """ Return a copy of the column ordered from oldest to newest """
+        column = self.columns[index]
+        start, end = self._start, self._start+self._size
+        if end <= self.capacity:
+            return column[start:end]
+        return column[start:]+column[:end-self.capacity]
+
+    def last(self):
+        """ Return the newest row or None if empty """
+        if not self._size:
+            return None
+        i = (self._start+self._size-1) % self.capacity
+        return tuple(column[i] for column in self.columns)
+
+    def clear(self):
+        self._start = self._size = 0
+
+    def __len__(self):
+        return self._size
+
+
+class SegmentLog(object):
+    """ Append only log of fixed size rows of floats split into memory
+    mapped segment files named `<path>.<number>.seg`. When a segment is full
+    a new one is started and the oldest are removed so at most
+    `max_segments` are kept.
+
+    """
+    #: Magic, number of columns, number of rows written
+    HEADER = struct.Struct('<4sIQ')
+    MAGIC = b'THS1'
+
+    def __init__(self, path, columns=2, segment_size=65536, max_segments=8):
+        self.path = path
+        self.columns = columns
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.row = struct.Struct('<{}d'.format(columns))
+        self._file = None
+        self._mmap = None
+        self._number = 0
+        self._count = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        segments = self.segments()
+        self._open(segments[-1][0] if segments else 0)
+
+    def segments(self):
+        """ Return a sorted list of (number, filename) of the segments """
+        segments = []
+        for filename in glob.glob('{}.*.seg'.format(self.path)):
+            try:
+                number = int(filename.rsplit('.', 2)[-2])
+            except ValueError:
+                continue
+            if filename == self._filename(number):
+                segments.append((number, filename))
+        return sorted(segments)
+
+    def _filename(self, number):
+        return '{}.{:06d}.seg'.format(self.path, number)
+
+    def _open(self, number):
+        """ Open (or create) and map the given segment """
+        self.close()
+        filename = self._filename(number)
+        size = self.HEADER.size+self.row.size*self.segment_size
+        exists = os.path.exists(filename)
+        f = open(filename, 'r+b' if exists else 'w+b')
+        if not exists or os.path.getsize(filename) != size:
+            f.truncate(size)
+        mm = mmap.mmap(f.fileno(), size)
+        magic, columns, count = self.HEADER.unpack_from(mm, 0)
+        if magic != self.MAGIC or columns != self.columns:
+            #: New or unreadable
+            count = 0
+            self.HEADER.pack_into(mm, 0, self.MAGIC, self.columns, count)
+        self._file, self._mmap = f, mm
+        self._number, self._count = number, min(count, self.segment_size)
+
+    def append(self, row):
+        """ Write a row to the current segment """
+        if self._count >= self.segment_size:
+            self._rotate()
+        mm = self._mmap
+        self.row.pack_into(mm, self.HEADER.size+self._count*self.row.size,
+                           *row)
+        self._count += 1
+        self.HEADER.pack_into(mm, 0, self.MAGIC, self.columns, self._count)
+
+    def _rotate(self):
+        """ Start a new segment and delete the oldest ones """
+        self._open(self._number+1)
+        segments = self.segments()
+        for number, filename in segments[:-self.max_segments]:
+            os.remove(filename)
+
+    def read(self, number):
+        """ Read the rows of a segment. Returns a flat array of the values
+        in row order.
+
+        """
+        if number == self._number:
+            mm, count = self._mmap, self._count
+            data = mm[self.HEADER.size:self.HEADER.size+count*self.row.size]
+        else:
+            with open(self._filename(number), 'rb') as f:
+                magic, columns, count = self.HEADER.unpack(
+                    f.read(self.HEADER.size))
+                if magic != self.MAGIC or columns != self.columns:
+                    return array('d')
+                data = f.read(min(count, self.segment_size)*self.row.size)
+        values = array('d')
+        if hasattr(values, 'frombytes'):
+            values.frombytes(data)
+        else:
+            values.fromstring(data)
+        return values
+
+    def tail(self, n):
+        """ Return up to the last n rows as a flat array of values """
+        result = array('d')
+        needed = n*self.columns
+        for number, filename in reversed(self.segments()):
+            values = self.read(number)
+            result = values[-(needed-len(result)):]+result
+            if len(result) >= needed:
+                break
+        return result
+
+    def flush(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+        self._mmap = self._file = None
+
+
+class Rollup(object):
+    """ Aggregates samples into fixed width buckets aligned to the epoch
+    (so days are in UTC). A bucket is written once the first sample of a
+    later bucket arrives.
+
+    """
+    STATS = {'min': 1, 'max': 2, 'mean': 3}
+
+    def __init__(self, width, capacity, log):
+        self.width = width
+        self.buffer = RingBuffer(capacity, 4)
+        self.log = log
+        self._bucket = None
+        self._min = self._max = self._sum = 0.0
+        self._count = 0
+
+    def load(self, raw):
+        """ Restore the buckets from the log and rebuild the open bucket
+        from the raw samples that came after the last one written.
+
+        """
+        values = self.log.tail(self.buffer.capacity)
+        for i in range(0, len(values), 4):
+            self.buffer.append(values[i:i+4])
+        last = self.buffer.last()
+        after = last[0]+self.width if last else 0
+        for t, v in zip(raw.column(0), raw.column(1)):
+            if t >= after:
+                self.add(t, v)
+
+    def add(self, t, value):
+        bucket = t-t % self.width
+        if bucket != self._bucket:
+            self.close()
+            self._bucket = bucket
+            self._min = self._max = self._sum = value
+            self._count = 1
+            return
+        if value < self._min:
+            self._min = value
+        if value > self._max:
+            self._max = value
+        self._sum += value
+        self._count += 1
+
+    def close(self):
+        """ Write the open bucket """
+        if not self._count:
+            return
+        row = (self._bucket, self._min, self._max, self._sum/self._count)
+        self.buffer.append(row)
+        self.log.append(row)
+        self._count = 0
+
+
+class Series(object):
+    """ History of a single measurement. Raw samples are (time, value) and
+    each rollup row is (bucket start time, min, max, mean).
+
+    """
+    def __init__(self, path, capacity=4096, rollup_capacity=1440):
+        self.path = path
+        self.raw = RingBuffer(capacity, 2)
+        self.log = SegmentLog(path, 2)
+        self.rollups = {}
+        for name, width in ROLLUPS:
+            self.rollups[name] = Rollup(width, rollup_capacity,
+                                        SegmentLog('{}.{}'.format(path, name),
+                                                   4))
+        self._load()
+
+    def _load(self):
+        """ Restore the ring buffers from the segment files """
+        raw = self.raw
+        values = self.log.tail(raw.capacity)
+        for i in range(0, len(values), 2):
+            raw.append((values[i], values[i+1]))
+        for rollup in self.rollups.values():
+            rollup.load(raw)
+
+    def append(self, value, t=None):
+        """ Add a sample, the time defaults to now """
+        if t is None:
+            t = time.time()
+        row = (t, value)
+        self.raw.append(row)
+        self.log.append(row)
+        for rollup in self.rollups.values():
+            rollup.add(t, value)
+
+    def timestamps(self, resolution='raw'):
+        """ Return an array of timestamps at the given resolution """
+        if resolution == 'raw':
+            return self.raw.column(0)
+        return self.rollups[resolution].buffer.column(0)
+
+    def values(self, resolution='raw', stat='mean'):
+        """ Return an array of values at the given resolution. For rollups
+        the stat may be 'min', 'max' or 'mean'.
+
+        """
+        if resolution == 'raw':
+            return self.raw.column(1)
+        return self.rollups[resolution].buffer.column(Rollup.STATS[stat])
+
+    def last(self):
+        """ Return the newest (time, value) or None """
+        return self.raw.last()
+
+    def samples(self, since=None):
+        """ Return the raw samples on disk as a flat array of time and
+        value pairs. When a time is given only the segments that may have
+        samples from it onwards are read.
+
+        """
+        segments = []
+        for number, filename in reversed(self.log.segments()):
+            values = self.log.read(number)
+            segments.append(values)
+            if since is not None and values and values[0] <= since:
+                break
+        result = array('d')
+        for values in reversed(segments):
+            result.extend(values)
+        return result
+
+    def flush(self):
+        self.log.flush()
+        for rollup in self.rollups.values():
+            rollup.log.flush()
+
+    def close(self):
+        self.log.close()
+        for rollup in self.rollups.values():
+            rollup.log.close()
+
+    def __len__(self):
+        return len(self.raw)
+
+
+class HistoryStore(Atom):
+    """ The history of every recorded measurement by name """
+
+    #: Directory where the segment files are stored
+    directory = Unicode()
+
+    #: Number of raw samples kept in memory per series
+    capacity = Int(4096)
+
+    #: Number of buckets kept in memory per rollup
+    rollup_capacity = Int(1440)
+
+    #: Series by name
+    series = Dict()
+
+    #: Incremented on every append so views can observe it
+    revision = Int()
+
+    def get(self, name):
+        """ Get or create the series with the given name """
+        series = self.series.get(name)
+        if series is None:
+            series = Series(os.path.join(self.directory, name),
+                            self.capacity, self.rollup_capacity)
+            self.series[name] = series
+        return series
+
+    def append(self, name, value, t=None):
+        """ Add a sample to the named series """
+        self.get(name).append(value, t)
+        self.revision += 1
+
+    def flush(self):
+        for series in self.series.values():
+            series.flush()
+
+    def close(self):
+        for series in self.series.values():
+            series.close()
+        self.series = {}
@@ -12,12 +12,8 @@ Created on Sep 14, 2017
 """
 import sys
 import os
+import time
 # import logging
-# # ### Comment out to disable profiling
-# import cProfile
-# pr = cProfile.Profile()
-# pr.enable()
-# # End profiling
 #
 #
 # def init_logging():
@@ -30,11 +26,22 @@ import os
 #     ch.setFormatter(formatter)
 #     root.addHandler(ch)
 
+#: When main was called, for the time to the first frame
+STARTED = time.time()
+
 
 def main():
     """ Called by PyBridge.start()
     """
+    global STARTED
+    STARTED = time.time()
     #init_logging()
+
+    #: Profile startup, see metrics.py to dump the stats or stop it
+    if os.environ.get('THERMOSTAT_PROFILE'):
+        from metrics import profiler
+        profiler.start()
+
     #: If we don't our code goes away
     #os.environ['TMP'] = os.path.join(sys.path[0], '../tmp')
     #from charts.android.factories import install
@@ -57,17 +64,29 @@ def load_view(app):
             reload(view)
         app.view = view.ContentView()
     app.show_view()
-#     app.timed_call(20000, dump_stats)
-#
-#
-# def dump_stats():
-#     try:
-#         pr.disable()
-#         import pstats, StringIO
-#         for sort_by in ['cumulative', 'time']:
-#             s = StringIO.StringIO()
-#             ps = pstats.Stats(pr, stream=s).sort_stats(sort_by)
-#             ps.print_stats(0.3)
-#             print s.getvalue()
-#     except:
-#         pass
+    app.deferred_call(start, app)
+
+
+def start(app):
+    """ Start everything the first screen does not need once it's shown
+    """
+    import metrics
+    metrics.registry.gauge(
+        'app_first_frame_seconds',
+        "Time from starting until the first screen was shown").set(
+        time.time()-STARTED)
+
+    #: Connect, load the weather and history
+    from models import AppState
+    state = AppState.instance()
+    state.start()
+
+    #: Save the last reported state when the app goes to the background
+    def on_state(change):
+        if change['value'] in ('paused', 'stopped'):
+            state.save_thermostat_state()
+    if 'state' in app.members():
+        app.observe('state', on_state)
+
+    #: Serve the metrics and profiler on localhost
+    metrics.listen()
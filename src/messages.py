@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded log of the messages received from the thermostats.
+
+"""
+import time
+from itertools import islice
+from collections import OrderedDict
+from atom.api import Atom, Instance, Int
+
+
+class MessageLog(Atom):
+    """ Keeps the last `capacity` distinct messages. Messages are indexed
+    by their content so duplicates are dropped in constant time no matter
+    how long the log is, and the oldest message is evicted when it's full.
+
+    """
+    #: Max number of messages kept
+    capacity = Int(1000)
+
+    #: Incremented whenever a message is added so views can observe it
+    revision = Int()
+
+    #: Messages by key from oldest to newest
+    _entries = Instance(OrderedDict, ())
+
+    def key(self, change, device):
+        """ Key that identifies a duplicate message """
+        return (device, change.get('type'), change.get('name'),
+                repr(change.get('oldvalue', change.get('old'))),
+                repr(change.get('value')))
+
+    def add(self, change, device=None):
+        """ Add a member change or notification from the given device.
+        Returns False if it's a duplicate of a message in the log.
+
+        """
+        key = self.key(change, device)
+        entries = self._entries
+        if key in entries:
+            return False
+        msg = {k: v for k, v in change.items() if k != 'object'}
+        msg['device'] = device
+        msg['time'] = time.time()
+        entries[key] = msg
+        while len(entries) > self.capacity:
+            entries.popitem(last=False)
+        self.revision += 1
+        return True
+
+    def messages(self, device=None, name=None):
+        """ Iterate the messages from newest to oldest optionally only those
+        from a device or about a member.
+
+        """
+        entries = self._entries
+        for key in reversed(entries):
+            msg = entries[key]
+            if device is not None and msg['device'] != device:
+                continue
+            if name is not None and msg.get('name') != name:
+                continue
+            yield msg
+
+    def page(self, index, size=50, device=None, name=None):
+        """ Return a list of the messages on the given page, newest first """
+        start = index*size
+        return list(islice(self.messages(device, name), start, start+size))
+
+    def clear(self):
+        self._entries.clear()
+        self.revision += 1
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Runtime metrics and profiling.
+
+Counters, gauges and histograms are kept in memory and can be served in the
+Prometheus text format on a local port along with a profiler that can be
+turned on and off at runtime:
+
+    GET /metrics          All metrics
+    GET /profile/start    Start profiling
+    GET /profile/stop     Stop profiling
+    GET /profile?n=30     Top n functions (sort=cumulative|time|calls)
+
+"""
+import time
+import logging
+from collections import OrderedDict
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+log = logging.getLogger("enaml")
+
+#: Default histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def formatLabels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+class Metric(object):
+    """ Base class of the metrics. Values are kept per combination of
+    label values.
+
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for key in sorted(self.values):
+            lines.append('%s%s %s' % (self.name,
+                                      formatLabels(self.labels, key),
+                                      repr(float(self.values[key]))))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *labels):
+        self.values[labels] = self.values.get(labels, 0)+amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def inc(self, amount=1, *labels):
+        self.values[labels] = self.values.get(labels, 0)+amount
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """ Record a value. Values are stored as the count per bucket, the
+        sum and the total count.
+
+        """
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0]*len(self.buckets), 0.0, 0]
+        counts = entry[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, *labels):
+        """ Return a context manager that records how long the block took """
+        return Timer(self, labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        name, names = self.name, self.labels
+        for key in sorted(self.values):
+            counts, total, count = self.values[key]
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('%s_bucket%s %s' % (
+                    name, formatLabels(names, key, ('le', repr(bound))),
+                    cumulative))
+            lines.append('%s_bucket%s %s' % (
+                name, formatLabels(names, key, ('le', '+Inf')), count))
+            lines.append('%s_sum%s %s' % (name, formatLabels(names, key),
+                                          repr(total)))
+            lines.append('%s_count%s %s' % (name, formatLabels(names, key),
+                                            count))
+        return lines
+
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time()-self.start, *self.labels)
+
+
+class Registry(object):
+    """ A collection of metrics by name """
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self.register(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=BUCKETS):
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def render(self):
+        """ Return all the metrics in the Prometheus text format """
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class Profiler(object):
+    """ cProfile that can be turned on and off at runtime """
+
+    def __init__(self):
+        self.profile = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        import cProfile
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.profile.disable()
+            self.running = False
+
+    def reset(self):
+        self.stop()
+        self.profile = None
+
+    def dump(self, n=20, sort='cumulative'):
+        """ Return the top n functions as text """
+        if self.profile is None:
+            return "Profiler has not been started\n"
+        import pstats
+        s = StringIO()
+        pstats.Stats(self.profile, stream=s).sort_stats(sort).print_stats(n)
+        return s.getvalue()
+
+
+#: Default registry and profiler
+registry = Registry()
+profiler = Profiler()
+
+#: Listening port of the metrics server
+_server = None
+
+
+def listen(port=9464, interface='127.0.0.1'):
+    """ Serve the metrics and profiler on the given port. Only the first call
+    starts a server.
+
+    """
+    global _server
+    if _server is not None:
+        return _server
+    from twisted.internet import reactor
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+
+    class MetricsResource(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(b'Content-Type',
+                              b'text/plain; version=0.0.4; charset=utf-8')
+            return registry.render().encode('utf-8')
+
+    class ProfileResource(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(b'Content-Type', b'text/plain; charset=utf-8')
+            action = request.postpath[0] if request.postpath else b''
+            if action == b'start':
+                profiler.start()
+                return b'Profiling\n'
+            elif action == b'stop':
+                profiler.stop()
+                return b'Stopped\n'
+            elif action == b'reset':
+                profiler.reset()
+                return b'Reset\n'
+            args = request.args
+            n = int(args.get(b'n', [20])[0])
+            sort = args.get(b'sort', [b'cumulative'])[0]
+            if not isinstance(sort, str):
+                sort = sort.decode('utf-8')
+            return profiler.dump(n, sort).encode('utf-8')
+
+    root = Resource()
+    root.putChild(b'metrics', MetricsResource())
+    root.putChild(b'profile', ProfileResource())
+    _server = reactor.listenTCP(port, Site(root), interface=interface)
+    log.info("Metrics available at http://%s:%s/metrics", interface, port)
+    return _server
@@ -5,19 +5,23 @@ Put your atom models here
 
 
 """
+import os
+import sys
 import json
 import math
+import time
 import collections
+from array import array
 from atom.api import *
 from enamlnative.core.api import AsyncHttpClient
-from enamlnative.core.app import BridgedApplication
 from datetime import datetime
 from client import Thermostat
 from twisted.internet import reactor
-from twisted.internet.protocol import Protocol
-from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
-from twisted.internet.defer import DeferredList
+from enaml.application import timed_call
 from utils import Model, State
+from history import HistoryStore
+from cache import ResponseCache
+from messages import MessageLog
 #from pprint import pprint
 
 
@@ -32,6 +36,26 @@ class Theme(Model):
     drawer = Unicode("#d63a5f")
 
 
+class ForecastDay(Model):
+    """ Aggregates of the forecast for a single day. The day's periods are
+    the rows `start` to `end` of the forecast columns.
+
+    """
+    #: Row range in the forecast columns
+    start = Int()
+    end = Int()
+
+    #: Time of the first period
+    time = Float()
+
+    #: Min and max temperature over the day
+    temp_min = Float()
+    temp_max = Float()
+
+    #: Most frequent weather condition id
+    condition = Int()
+
+
 class Weather(Model):
     #: Loading
     loading_current = Bool()
@@ -47,6 +71,9 @@ class Weather(Model):
     api_key = Unicode("9a225bbabfc3ef64bcbf023c4b5359b9")
     location = Unicode("18092")
 
+    #: Responses by mode and location, kept across restarts
+    cache = Instance(ResponseCache).tag(persist=False)
+
     #: Map weather icons ID to an Icon
     icons = Dict(default={
         200: {'icon': 'wi_storm_showers',
@@ -132,42 +159,48 @@ class Weather(Model):
     #: Current weather data
     current = Dict()
 
-    #: Forecast data
-    forecast = Dict()
-
-    #: Forecast for every 3 hours
-    hourly_forecast = List()
+    #: Forecast for every 3 hours as columns, the first row is the current
+    #: weather
+    forecast_time = Instance(array, ('d',))
+    forecast_temp = Instance(array, ('d',))
+    forecast_humidity = Instance(array, ('d',))
+    forecast_rain = Instance(array, ('d',))
+    forecast_condition = Instance(array, ('i',))
 
-    #: Forecast for each day
-    daily_forecast = List()
+    #: Forecast for each day as a list of ForecastDay
+    daily_forecast = List(ForecastDay)
 
     def _observe_outdated(self, change):
         if self.outdated:
             self.load()
 
+    def _default_cache(self):
+        return ResponseCache(
+            path=os.path.join(sys.path[0], '../weather.cache'))
+
     def load(self):
-        #: Fetch current
-        self.loading_current = True
-        url = self.url.format(mode="weather",
-                              zip=self.location,
-                              key=self.api_key)
-        print("Fetching {}".format(url))
-        self.client.fetch(url).then(self.on_load_current)
+        """ Load the current weather and forecast. Cached results are
+        shown immediately and refreshed when they are out of date.
 
-        #: Fetch forecast
+        """
+        self.loading_current = True
         self.loading_forecast = True
-        url = self.url.format(mode="forecast",
-                              zip=self.location,
-                              key=self.api_key)
-        print("Fetching {}".format(url))
-        self.client.fetch(url).then(self.on_load_forecast)
-
-    def on_load_current(self, response):
-        if not response.ok:
-            return
-
+        for mode, callback, loading in (
+                ('weather', self.on_load_current, 'loading_current'),
+                ('forecast', self.on_load_forecast, 'loading_forecast')):
+            url = self.url.format(mode=mode,
+                                  zip=self.location,
+                                  key=self.api_key)
+            key = "{}:{}".format(mode, self.location)
+            #: Stop loading if it fails, it's retried on the next hour
+            errback = lambda message, loading=loading: setattr(
+                self, loading, False)
+            self.cache.fetch(self.client, key, url, callback, errback)
+
+    def on_load_current(self, body):
+        """ Update the current weather, returns whether it was valid """
         #: Source data
-        current = json.loads(response.body)
+        current = json.loads(body)
         print("Current:")
         print(current)
         #: Make sure it's good before saving it
@@ -177,17 +210,17 @@ class Weather(Model):
                 print("Current weather response is invalid: "
                       "{}".format(current))
                 #: Required key is missing, something is not right
-                return
+                return False
 
         self.current = current
         self.outdated = False
         self.loading_current = False
+        return True
 
-    def on_load_forecast(self, response):
-        if not response.ok:
-            return
-            #: Source data
-        forecast = json.loads(response.body)
+    def on_load_forecast(self, body):
+        """ Update the forecast, returns whether it was valid """
+        #: Source data
+        forecast = json.loads(body)
         print("Forecast:")
         print(forecast)
         #: Make sure it's good before saving it
@@ -202,35 +235,49 @@ class Weather(Model):
             print("Forecast weather response is invalid: "
                   "{}".format(forecast))
             #: Required key is missing, something is not right
-            return
-
-        self.forecast = forecast
-        #print("Forecast:")
-        #pprint(self.forecast)
-
-        #: Update hourly
-        self.hourly_forecast = self.forecast['list'][:9]
-
-        #: Update daily
-        daily_forecast = {}
-        now = datetime.now()
-        today = datetime(now.year, now.month, now.day)
-        daily_forecast[0] = [self.current]
-        for item in self.forecast['list']:
-            #: Item is 3 hour period
-            date = datetime.fromtimestamp(item['dt'])
-
-            #: Put in correct index
-            dd = math.floor((date-today).total_seconds()/(60*60*24.0))
-            if dd not in daily_forecast:
-                daily_forecast[dd] = []
-            daily_forecast[dd].append(item)
-
-        self.daily_forecast = [daily_forecast[k]
-                               for k in sorted(daily_forecast.keys())]
+            return False
+
+        #: Parse into columns
+        t, temp, humidity = array('d'), array('d'), array('d')
+        rain, condition = array('d'), array('i')
+        items = forecast['list']
+        if self.current:
+            items = [self.current]+items
+        for item in items:
+            main = item.get('main', {})
+            t.append(item.get('dt', 0))
+            temp.append(main.get('temp', float('nan')))
+            humidity.append(main.get('humidity', float('nan')))
+            rain.append((item.get('rain') or {}).get('3h', 0))
+            condition.append(item['weather'][0]['id'])
+
+        #: Group into days starting at local midnight
+        now = time.localtime()
+        today = time.mktime((now.tm_year, now.tm_mon, now.tm_mday,
+                             0, 0, 0, 0, 0, -1))
+        days = []
+        start = 0
+        for i in range(1, len(t)+1):
+            if i < len(t) and (t[i]-today)//86400 == (t[start]-today)//86400:
+                continue
+            temps = temp[start:i]
+            counts = collections.Counter(condition[start:i])
+            days.append(ForecastDay(
+                start=start, end=i, time=t[start],
+                temp_min=min(temps), temp_max=max(temps),
+                condition=max(condition[start:i], key=counts.get)))
+            start = i
+
+        self.forecast_time = t
+        self.forecast_temp = temp
+        self.forecast_humidity = humidity
+        self.forecast_rain = rain
+        self.forecast_condition = condition
+        self.daily_forecast = days
 
         self.outdated = False
         self.loading_forecast = False
+        return True
 
 
 class DateTime(Model):
@@ -238,6 +285,12 @@ class DateTime(Model):
     value to update the ui whenever a certain
     value changes (ex every hour). Use date.now.strftime()
     to get whatever textual values needed.
+
+    Instead of ticking every second a single timer is armed for the next
+    boundary of the fastest changing field that is observed (ex. the top of
+    the hour when only `hour` is observed). Observing or unobserving a
+    field re-arms the timer.
+
     """
     now = Instance(datetime)
 
@@ -249,25 +302,74 @@ class DateTime(Model):
     minute = Int()
     second = Int()
 
+    #: Pending timer
+    _timer = Instance(object)
+
+    #: Fields from the fastest to the slowest changing
+    fields = ('second', 'minute', 'hour', 'day', 'month', 'year')
+
     def __init__(self, *args, **kwargs):
-        #: When default is requested, trigger
-        #: an async loop to keep updating the time
-        self._refresh_time()
+        super(DateTime, self).__init__(*args, **kwargs)
+        self.refresh()
+
+    def observe(self, topic, callback):
+        super(DateTime, self).observe(topic, callback)
+        self._arm()
+
+    def unobserve(self, *args):
+        super(DateTime, self).unobserve(*args)
+        self._arm()
+
+    def refresh(self):
+        """ Update the time now and re-arm the timer """
+        self.now = datetime.now()
+        self._arm()
 
     def _observe_now(self, change):
-        """ Whenever now is changed, update all the fields """
+        """ Whenever now is changed, update the fields that changed """
         now = self.now
-        self.year = now.year
-        self.day = now.day
-        self.hour = now.hour
-        self.minute = now.minute
-        self.second = now.second
+        for name in self.fields:
+            value = getattr(now, name)
+            if getattr(self, name) != value:
+                setattr(self, name, value)
 
-    def _refresh_time(self):
-        self.now = datetime.now()
-        #: Update every second
-        app = BridgedApplication.instance()
-        app.timed_call(1000, self._refresh_time)
+    def _arm(self):
+        """ Schedule a refresh at the next boundary of the fastest changing
+        field that is observed. Nothing is scheduled if nothing is.
+
+        """
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        now = self.now
+        if now is None:
+            return
+        elapsed = now.microsecond/1e6
+        if self.has_observers('now') or self.has_observers('second'):
+            period = 1
+        elif self.has_observers('minute'):
+            period = 60
+            elapsed += now.second
+        elif self.has_observers('hour'):
+            period = 3600
+            elapsed += now.minute*60+now.second
+        elif any(self.has_observers(f) for f in ('day', 'month', 'year')):
+            period = 86400
+            elapsed += now.hour*3600+now.minute*60+now.second
+        else:
+            return
+
+        #: Fire slightly after so the new value is seen
+        self._timer = reactor.callLater(period-elapsed+0.01, self.refresh)
+
+
+#: Thermostat members that are recorded and the name of their series
+HISTORY_SERIES = {
+    'insideTemp': 'temp',
+    'insideHumidity': 'humidity',
+    'heatActive': 'heat',
+    'coolActive': 'cool',
+}
 
 
 class AppState(State):
@@ -301,6 +403,16 @@ class AppState(State):
     address = Unicode("192.168.1.101:8888")
     addresses = List()
     connection = Instance(object).tag(persist=False)
+    scanner = Instance(object).tag(persist=False)
+
+    #: Last state reported by the thermostat, shown until it connects
+    thermostat_state = Dict()
+
+    #: Whether a save of the thermostat_state is scheduled
+    thermostat_state_pending = Bool().tag(persist=False)
+
+    #: Set by start once the first screen is shown
+    started = Bool().tag(persist=False)
 
     #: Settings
     set_temp = Float(28)  # in C
@@ -310,14 +422,15 @@ class AppState(State):
     developer_mode = Bool(True)
 
     #: TODO: Should be on the actual thermostat!
-    temp_history = ContainerList(float)
-    humidity_history = ContainerList(float)
-    heat_history = ContainerList()
-    cool_history = ContainerList()
+    history = Instance(HistoryStore).tag(persist=False)
+
+    #: Heating and cooling usage over the last usage_days, see
+    #: analytics.report. Empty when numpy is not available.
+    usage = Dict().tag(persist=False)
+    usage_days = Int(30)
 
     #: Messages
-    messages = Instance(collections.deque, ()).tag(persist=False)
-    message_count = Int().tag(persist=False)
+    message_log = Instance(MessageLog, ()).tag(persist=False)
 
     #: Page in
     current_screen = Int().tag(persist=False)
@@ -325,20 +438,105 @@ class AppState(State):
     def _default_theme(self):
         return self.themes[0]
 
+    def start(self):
+        """ Connect and load everything that is not needed to show the
+        first screen. Called once it's shown so none of this delays it.
+
+        """
+        if self.started:
+            return
+        thermostat = self.thermostat
+        self.started = True
+        self.connect_thermostat(thermostat)
+        #: Reading outdated the first time starts loading
+        weather = self.weather
+        if weather.outdated and not weather.loading_current:
+            weather.load()
+        timed_call(1000, self.update_usage)
+
     @observe('time.hour')
     def _update_weather(self, change):
         """ Update weather every hour """
+        if change['type'] != 'update':
+            return
         self.weather.load()
+        self.update_usage()
+
+    @observe('thermostat.connected', 'thermostat.insideTemp',
+             'thermostat.insideHumidity', 'thermostat.desiredTemp',
+             'thermostat.systemMode', 'thermostat.fanMode',
+             'thermostat.heatActive', 'thermostat.coolActive')
+    def _queue_thermostat_state(self, change):
+        """ Save the reported state at most once a minute while it's
+        changing.
+
+        """
+        if change['type'] != 'update' or self.thermostat_state_pending:
+            return
+        self.thermostat_state_pending = True
+        timed_call(60000, self.save_thermostat_state)
+
+    def save_thermostat_state(self):
+        """ Keep the last reported state, it's only saved if it changed.
+        Also called when the app is paused or stopped.
+
+        """
+        self.thermostat_state_pending = False
+        if self.thermostat._snapshot:
+            self.thermostat_state = dict(self.thermostat._snapshot)
+
+    def update_usage(self):
+        """ Recompute the usage from the history """
+        import analytics
+        self.usage = analytics.report(self.history, self.usage_days) or {}
+
+    def _default_scanner(self):
+        from scanner import Scanner
+        return Scanner()
+
+    def _default_history(self):
+        return HistoryStore(directory=os.path.join(sys.path[0], '../history'))
+
+    @observe('thermostat.insideTemp', 'thermostat.insideHumidity',
+             'thermostat.heatActive', 'thermostat.coolActive')
+    def _record_history(self, change):
+        """ Record thermostat changes in the history """
+        if change['type'] != 'update':
+            return
+        value = float(change['value'])
+        if not math.isnan(value):
+            self.history.append(HISTORY_SERIES[change['name']], value)
+
+    @observe('weather.current')
+    def _record_outside(self, change):
+        """ Record the outside temperature for the degree hours """
+        current = change['value']
+        try:
+            t, value = float(current['dt']), float(current['main']['temp'])
+        except (KeyError, TypeError, ValueError):
+            return
+        #: The same observation is reported until the next one
+        last = self.history.get('outside').last()
+        if last is None or t > last[0]:
+            self.history.append('outside', value, t)
 
     def _default_thermostat(self):
+        t = Thermostat()
+        t.listener = self._on_message
+        #: Show the last known state until it connects
+        t.applyState(self.thermostat_state)
+        if self.started:
+            self.connect_thermostat(t)
+        return t
+
+    def connect_thermostat(self, thermostat=None):
+        """ Open the connection to the thermostat """
+        t = thermostat or self.thermostat
         try:
             host, port = self.address.split(":")
         except ValueError:
             host, port = "192.168.1.101:8888".split(":")
-        t = Thermostat()
-        t.listener = self._on_message
         self.connection = reactor.connectTCP(str(host), int(port), t)
-        return t
 
     def _observe_address(self, change):
         """ When the address changes reset the thermostat """
@@ -349,38 +547,32 @@ class AppState(State):
                 self.connection.loseConnection()
             except Exception as e:
                 print(e)
+        self.thermostat_state = {}
         self.thermostat = self._default_thermostat()
 
     def _on_message(self, change):
         """ Watch thermostat messages """
         #print("Thermostat update: {}".format(change))
-        if change not in self.messages:
-            self.messages.append(change)
-            self.message_count += 1
-
-    def find_thermostats(self):
-        """ Scan the subnet to find all the thermostats or anything serving
-        on the port 8888
-        
+        self.message_log.add(change, self.address)
+
+    def find_thermostats(self, network=None):
+        """ Scan the network (by default the /24 of the current address)
+        for thermostats. The addresses found last time are checked first
+        and everything found is added to `addresses` as it answers.
+
         """
         ip, port = self.address.split(':')
-        subnet = ip.split(".")[0:2]
-        ds = []
-        for i in range(255):
-            point = TCP4ClientEndpoint(reactor, ".".join(subnet+[i]), port)
-            d = connectProtocol(point, Protocol())
-            d.addTimeout(1, reactor)
-            ds.append(d)
-
-        def on_results(results):
-            addrs = []
-            for i, result in enumerate(results):
-                success, p = result
-                if success:
-                    addrs.append("{}:{}".format(
-                            ".".join(subnet+[i]), port))
-                    p.transport.loseConnection()
-            self.addresses = addrs
-
-        DeferredList(ds, consumeErrors=True).addCallback(on_results)
+        if network is None:
+            network = "{}/24".format(ip)
+        known = list(self.addresses)
+        self.addresses = []
+        scanner = self.scanner
+        scanner.port = int(port)
+        scanner.listener = self._on_thermostat_found
+        return scanner.scan(network, known)
+
+    def _on_thermostat_found(self, address, state):
+        #: Assigned so observers are notified and the state is saved
+        if address not in self.addresses:
+            self.addresses = self.addresses + [address]
 
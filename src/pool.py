@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+Manage a fleet of thermostats from a single reactor.
+
+Each thermostat normally owns a LoopingCall for it's heartbeat which makes
+all of them fire in lockstep when many devices are connected at once. The
+pool instead drives every heartbeat from one shared scheduler which spreads
+the syncs evenly over the interval and limits how many run at once.
+
+Reconnects have the same problem, after a network blip every device
+retries within the same few seconds. The pool's reconnect coordinator
+jitters the retries and limits how many connect at once.
+
+"""
+import math
+import heapq
+import random
+import logging
+from atom.api import Atom, Dict, Float, Int, Instance, Callable
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+from client import Thermostat, connect, parseAddress
+from metrics import registry
+
+log = logging.getLogger("enaml")
+
+RECONNECT_WAITING = registry.gauge(
+    'thermostat_reconnect_waiting',
+    "Thermostats waiting for a connection slot")
+RECONNECT_ACTIVE = registry.gauge(
+    'thermostat_reconnect_active',
+    "Connection attempts and initial syncs in progress")
+
+#: Fractional part of the golden ratio, used to spread heartbeat phases
+#: evenly no matter how many devices are registered.
+GOLDEN_RATIO = 0.6180339887498949
+
+
+class HeartbeatScheduler(Atom):
+    """ Runs the `syncState` heartbeat of many thermostats using a single
+    timer. Each registered thermostat is assigned a phase within the
+    heartbeat interval so syncs are evenly spaced, and a token bucket plus a
+    concurrency limit keep bursts flat (ex. after a network blip when
+    everything reconnects at once).
+
+    """
+    #: Max number of syncs that may be in flight at once
+    maxConcurrent = Int(16)
+
+    #: Max number of syncs started per second
+    maxRate = Float(20.0)
+
+    #: Heap of (due time, sequence, thermostat)
+    _queue = Instance(list, ())
+
+    #: Maps a registered thermostat to it's sequence number. Entries in the
+    #: queue that no longer match are stale and skipped.
+    _registered = Dict()
+
+    #: Number of syncs in flight
+    _active = Int()
+
+    #: Token bucket state
+    _tokens = Float()
+    _lastRefill = Float()
+
+    #: Counter used for assigning phases and sequence numbers
+    _count = Int()
+
+    #: Pending timer
+    _timer = Instance(object)
+
+    @property
+    def pending(self):
+        """ Number of registered thermostats """
+        return len(self._registered)
+
+    def register(self, thermostat):
+        """ Start the heartbeat of the given thermostat. The first sync is
+        delayed by the thermostat's phase within it's heartbeat interval.
+
+        """
+        self.unregister(thermostat)
+        self._count += 1
+        seq = self._count
+        self._registered[thermostat] = seq
+        phase = (seq * GOLDEN_RATIO) % 1.0
+        due = reactor.seconds() + phase * thermostat.heartbeatInterval
+        heapq.heappush(self._queue, (due, seq, thermostat))
+        self._schedule()
+
+    def unregister(self, thermostat):
+        """ Stop the heartbeat of the given thermostat. The queue entry is
+        left in place and discarded when it comes due.
+
+        """
+        self._registered.pop(thermostat, None)
+
+    def _schedule(self):
+        """ Arm the timer for the next thermostat that is due """
+        queue = self._queue
+        registered = self._registered
+
+        #: Drop stale entries so the heap top is always a live one
+        while queue and registered.get(queue[0][2]) != queue[0][1]:
+            heapq.heappop(queue)
+
+        timer = self._timer
+        if not queue or self._active >= self.maxConcurrent:
+            if timer is not None and timer.active():
+                timer.cancel()
+            self._timer = None
+            return
+
+        delay = max(0, queue[0][0] - reactor.seconds(), self._tokenDelay())
+        if timer is not None and timer.active():
+            timer.reset(delay)
+        else:
+            self._timer = reactor.callLater(delay, self._run)
+
+    def _tokenDelay(self):
+        """ Refill the token bucket and return how long to wait until a
+        token is available.
+
+        """
+        now = reactor.seconds()
+        rate = self.maxRate
+        self._tokens = min(rate, self._tokens + (now-self._lastRefill)*rate)
+        self._lastRefill = now
+        if self._tokens >= 1:
+            return 0
+        return (1-self._tokens)/rate
+
+    def _run(self):
+        """ Start syncs for every thermostat that is due until either the
+        rate or concurrency limit is hit.
+
+        """
+        self._timer = None
+        queue = self._queue
+        registered = self._registered
+        now = reactor.seconds()
+        while queue and self._active < self.maxConcurrent:
+            due, seq, thermostat = queue[0]
+            if registered.get(thermostat) != seq:
+                heapq.heappop(queue)
+                continue
+            if due > now or self._tokenDelay() > 0:
+                break
+            heapq.heappop(queue)
+            self._tokens -= 1
+
+            #: Keep the phase by scheduling from the due time, unless we
+            #: fell more than an interval behind
+            interval = thermostat.heartbeatInterval
+            heapq.heappush(queue, (max(due+interval, now), seq, thermostat))
+
+            self._active += 1
+            d = maybeDeferred(thermostat.syncState)
+            d.addErrback(self._onSyncError, thermostat)
+            d.addBoth(self._onSyncDone)
+        self._schedule()
+
+    def _onSyncError(self, failure, thermostat):
+        log.warning("Heartbeat failed for %s: %s", thermostat,
+                    failure.getErrorMessage())
+
+    def _onSyncDone(self, result):
+        self._active -= 1
+        self._schedule()
+
+
+class DeviceHealth(Atom):
+    """ Reconnect state of a single thermostat """
+
+    #: Last reconnect delay
+    delay = Float()
+
+    #: Failures and flaps, decays over time
+    penalty = Float()
+
+    #: When the penalty was last updated
+    updated = Float()
+
+    #: When the last connection was made, zero when not connected
+    connectedAt = Float()
+
+
+class ReconnectCoordinator(Atom):
+    """ Decides when thermostats reconnect so a fleet recovers from an
+    outage without a reconnect storm.
+
+    - Retries are delayed with decorrelated jitter (a random delay between
+      initialDelay and three times the previous one, up to maxDelay) so
+      devices that dropped together don't retry together.
+    - At most maxConcurrent connection attempts and initial syncs run at
+      once, the rest wait for a slot. Healthier devices get slots first.
+    - Failed attempts and connections lost within stableTime add to the
+      device's penalty which stretches it's max delay. The penalty halves
+      every penaltyHalfLife seconds.
+
+    A slot is held for at most attemptTimeout seconds so the time for the
+    whole fleet to reconnect is bounded, see recoveryTime.
+
+    """
+    #: Reconnect delays (seconds)
+    initialDelay = Float(1.0)
+    maxDelay = Float(30.0)
+
+    #: Max number of connection attempts and initial syncs at once
+    maxConcurrent = Int(16)
+
+    #: Max seconds an attempt may hold a slot
+    attemptTimeout = Float(10.0)
+
+    #: Connections lost sooner than this count as a flap
+    stableTime = Float(60.0)
+
+    #: Penalty decay and the max penalty, a device's max delay is
+    #: maxDelay*(1+penalty)
+    penaltyHalfLife = Float(600.0)
+    maxPenalty = Float(4.0)
+
+    #: DeviceHealth by thermostat
+    _devices = Dict()
+
+    #: Heap of (penalty, sequence, thermostat, connect) waiting for a slot
+    _queue = Instance(list, ())
+    _count = Int()
+
+    #: Release timers of the attempts holding a slot by thermostat
+    _active = Dict()
+
+    def recoveryTime(self, count):
+        """ Upper bound of the seconds it takes for the given number of
+        thermostats to get a connection attempt after an outage.
+
+        """
+        waves = int(math.ceil(count/float(self.maxConcurrent)))
+        return (self.maxDelay*(1+self.maxPenalty) +
+                waves*self.attemptTimeout)
+
+    def health(self, thermostat):
+        """ Score from 1 (healthy) towards 0 (flapping) """
+        return 1/(1+self._penalty(self._device(thermostat)))
+
+    def _device(self, thermostat):
+        device = self._devices.get(thermostat)
+        if device is None:
+            device = self._devices[thermostat] = DeviceHealth(
+                delay=self.initialDelay, updated=reactor.seconds())
+        return device
+
+    def _penalty(self, device):
+        """ Decay the penalty up to now and return it """
+        now = reactor.seconds()
+        device.penalty *= 0.5**((now-device.updated)/self.penaltyHalfLife)
+        device.updated = now
+        return device.penalty
+
+    def _penalize(self, device):
+        device.penalty = min(self.maxPenalty, self._penalty(device)+1)
+
+    # -------------------------------------------------------------------------
+    # Called by the thermostats
+    # -------------------------------------------------------------------------
+    def retry(self, thermostat, connector):
+        """ Schedule the next connection attempt of the thermostat """
+        device = self._device(thermostat)
+        cap = self.maxDelay*(1+self._penalty(device))
+        device.delay = min(cap, random.uniform(self.initialDelay,
+                                               device.delay*3))
+        log.info("Reconnecting %s in %0.1f seconds", thermostat,
+                 device.delay)
+        thermostat._callID = reactor.callLater(device.delay, self._due,
+                                               thermostat, connector)
+
+    def _due(self, thermostat, connector):
+        thermostat._callID = None
+        self.request(thermostat, connector.connect)
+
+    def request(self, thermostat, connect):
+        """ Call connect once a slot is free """
+        self._count += 1
+        penalty = self._penalty(self._device(thermostat))
+        heapq.heappush(self._queue, (penalty, self._count, thermostat,
+                                     connect))
+        self._dispatch()
+
+    def connected(self, thermostat):
+        """ The thermostat connected and did it's initial sync """
+        self._device(thermostat).connectedAt = reactor.seconds()
+        self._release(thermostat)
+
+    def failed(self, thermostat):
+        """ The connection attempt failed """
+        self._penalize(self._device(thermostat))
+        self._release(thermostat)
+
+    def lost(self, thermostat):
+        """ The connection was lost """
+        device = self._device(thermostat)
+        if device.connectedAt:
+            if reactor.seconds()-device.connectedAt < self.stableTime:
+                self._penalize(device)
+            else:
+                device.delay = self.initialDelay
+        else:
+            #: Lost during the initial sync
+            self._penalize(device)
+        device.connectedAt = 0
+        self._release(thermostat)
+
+    def remove(self, thermostat):
+        """ Forget the thermostat """
+        self._release(thermostat)
+        self._devices.pop(thermostat, None)
+
+    # -------------------------------------------------------------------------
+    # Slots
+    # -------------------------------------------------------------------------
+    def _dispatch(self):
+        """ Start waiting attempts while there are free slots """
+        queue, active = self._queue, self._active
+        while queue and len(active) < self.maxConcurrent:
+            penalty, seq, thermostat, connect = heapq.heappop(queue)
+            if not thermostat.continueTrying or thermostat in active:
+                continue
+            active[thermostat] = reactor.callLater(
+                self.attemptTimeout, self._release, thermostat)
+            try:
+                connect()
+            except Exception as e:
+                log.error("Failed to connect %s: %s", thermostat, e)
+                thermostat.status = "Failed to connect: {}".format(e)
+                self._release(thermostat)
+        RECONNECT_WAITING.set(len(queue))
+        RECONNECT_ACTIVE.set(len(active))
+
+    def _release(self, thermostat):
+        timer = self._active.pop(thermostat, None)
+        if timer is None:
+            return
+        if timer.active():
+            timer.cancel()
+        self._dispatch()
+
+
+class ThermostatPool(Atom):
+    """ Owns the connections to many thermostats and runs their heartbeats
+    through a shared HeartbeatScheduler. Thermostats are looked up by the
+    address they were added with ("host:port" or a serial device, see
+    client.connect).
+
+    """
+    #: Shared heartbeat scheduler
+    scheduler = Instance(HeartbeatScheduler, ())
+
+    #: Shared reconnect coordinator
+    coordinator = Instance(ReconnectCoordinator, ())
+
+    #: Seconds between state syncs of each thermostat
+    heartbeatInterval = Float(30)
+
+    #: Passed to each thermostat's listener
+    listener = Callable()
+
+    #: Creates the thermostats (ex. a Thermostat subclass)
+    thermostatClass = Callable(Thermostat)
+
+    #: Thermostats keyed by address
+    thermostats = Dict()
+
+    #: Connectors keyed by address
+    _connectors = Dict()
+
+    def add(self, address, **kwargs):
+        """ Connect to the thermostat at the given address. If it was
+        already added the existing thermostat is returned. Raises a
+        ValueError or ImportError if it can't be connected to, see
+        client.parseAddress.
+
+        """
+        if address in self.thermostats:
+            return self.thermostats[address]
+        parseAddress(address)
+        kwargs.setdefault('heartbeatInterval', self.heartbeatInterval)
+        t = self.thermostatClass(scheduler=self.scheduler,
+                                 coordinator=self.coordinator, **kwargs)
+        if self.listener:
+            t.listener = self.listener
+        self.thermostats[address] = t
+
+        def attempt():
+            self._connectors[address] = connect(address, t)
+        self.coordinator.request(t, attempt)
+        return t
+
+    def remove(self, address):
+        """ Disconnect and remove the thermostat at the given address """
+        t = self.thermostats.pop(address, None)
+        connector = self._connectors.pop(address, None)
+        if t is None:
+            return
+        t.stopTrying()
+        t.stopHeartbeat()
+        if connector is not None:
+            connector.disconnect()
+        self.coordinator.remove(t)
+        return t
+
+    def get(self, address, default=None):
+        """ Lookup a thermostat by address """
+        return self.thermostats.get(address, default)
+
+    def clear(self):
+        """ Disconnect from all thermostats """
+        for address in list(self.thermostats.keys()):
+            self.remove(address)
+
+    def __getitem__(self, address):
+        return self.thermostats[address]
+
+    def __contains__(self, address):
+        return address in self.thermostats
+
+    def __iter__(self):
+        return iter(self.thermostats.values())
+
+    def __len__(self):
+        return len(self.thermostats)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Find thermostats on the local network.
+
+Every host in a CIDR range is probed on the thermostat port with a limited
+number of connections in flight. A host only counts as a thermostat once it
+answers a `getState` call with it's firmware `version`, an open port alone
+is not enough. Hosts that were found before are probed first.
+
+"""
+import socket
+import struct
+import logging
+from collections import deque
+from atom.api import Atom, Bool, Callable, Dict, Float, Instance, Int, List
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from client import RPCProtocol
+
+log = logging.getLogger("enaml")
+
+#: Largest range that may be scanned (a /16)
+MAX_HOSTS = 65536
+
+
+def hosts(network):
+    """ Return the list of host addresses in a CIDR range such as
+    "192.168.1.0/24". The network and broadcast addresses are excluded
+    unless the range is a /31 or /32. A single address is also accepted.
+
+    """
+    if '/' in network:
+        ip, prefix = network.split('/', 1)
+        prefix = int(prefix)
+    else:
+        ip, prefix = network, 32
+    if not 0 <= prefix <= 32:
+        raise ValueError("Invalid prefix: {}".format(network))
+    size = 1 << (32-prefix)
+    if size > MAX_HOSTS:
+        raise ValueError("Network {} is too large to scan".format(network))
+    start = struct.unpack('!I', socket.inet_aton(ip))[0] & ~(size-1)
+    if size > 2:
+        numbers = range(start+1, start+size-1)
+    else:
+        numbers = range(start, start+size)
+    return [socket.inet_ntoa(struct.pack('!I', n)) for n in numbers]
+
+
+class ProbeProtocol(RPCProtocol):
+    """ A connection that is only used to identify the device. It's not
+    owned by a Thermostat so notifications are ignored.
+
+    """
+    def __init__(self, timeout):
+        super(ProbeProtocol, self).__init__()
+        self._timeout = timeout
+
+    def connectionMade(self):
+        pass
+
+    def msgReceived(self, msg):
+        pass
+
+
+class Scanner(Atom):
+    """ Scans a network for thermostats. Each thermostat found is added to
+    `found` and passed to the `listener` as soon as it answers so results
+    can be shown while the scan is still running.
+
+    """
+    #: Port the thermostats listen on
+    port = Int(8888)
+
+    #: Max number of probes in flight
+    maxConcurrent = Int(32)
+
+    #: Seconds to wait for the connection and again for the handshake
+    timeout = Float(1.0)
+
+    #: Called with the address and state of each thermostat found
+    listener = Callable()
+
+    #: Addresses ("host:port") found by the current or last scan
+    found = List()
+
+    #: Firmware version of each address found
+    versions = Dict()
+
+    #: Whether a scan is running
+    scanning = Bool()
+
+    #: Addresses waiting to be probed as (host, port)
+    _queue = Instance(deque, ())
+
+    #: Number of probes in flight
+    _active = Int()
+
+    #: Fired with the found list when the scan completes
+    _done = Instance(object)
+
+    def scan(self, network, known=()):
+        """ Probe every host in the network. Addresses in `known` (ex. from
+        a previous scan) are probed first and may be on any port. Returns a
+        Deferred that fires with the list of addresses found.
+
+        """
+        self.stop()
+        queue = deque()
+        seen = set()
+        for address in known:
+            host, port = address.split(':')
+            queue.append((host, int(port)))
+            seen.add((host, int(port)))
+        for host in hosts(network):
+            if (host, self.port) not in seen:
+                queue.append((host, self.port))
+        self.found = []
+        self.versions = {}
+        self._queue = queue
+        self._done = d = Deferred()
+        self.scanning = True
+        self._next()
+        return d
+
+    def stop(self):
+        """ Stop starting new probes and fire the scan's Deferred with what
+        was found so far. Probes in flight finish normally and still report
+        to the listener.
+
+        """
+        self._queue.clear()
+        if self.scanning:
+            self._finish()
+
+    def _next(self):
+        """ Start probes until the concurrency limit is reached """
+        queue = self._queue
+        while queue and self._active < self.maxConcurrent:
+            host, port = queue.popleft()
+            self._active += 1
+            d = self.probe(host, port)
+            d.addCallbacks(self._onFound, self._onFailed,
+                           callbackArgs=(host, port),
+                           errbackArgs=(host, port))
+            d.addBoth(self._onProbeDone)
+        if not queue and not self._active and self.scanning:
+            self._finish()
+
+    @inlineCallbacks
+    def probe(self, host, port):
+        """ Connect to the host and ask for it's state. Returns a Deferred
+        that fires with the state if it's a thermostat or fails otherwise.
+
+        """
+        point = TCP4ClientEndpoint(reactor, host, port, timeout=self.timeout)
+        p = yield connectProtocol(point, ProbeProtocol(self.timeout))
+        try:
+            state = yield p.getState()
+        finally:
+            p.transport.loseConnection()
+        if not isinstance(state, dict) or 'version' not in state:
+            raise ValueError("{}:{} is not a thermostat".format(host, port))
+        returnValue(state)
+
+    def _onFound(self, state, host, port):
+        address = "{}:{}".format(host, port)
+        if address in self.found:
+            #: A probe of the previous scan found it too
+            return
+        log.info("Found thermostat %s version %s", address, state['version'])
+        self.versions[address] = state['version']
+        self.found.append(address)
+        if self.listener:
+            self.listener(address, state)
+
+    def _onFailed(self, failure, host, port):
+        log.debug("No thermostat at %s:%s: %s", host, port,
+                  failure.getErrorMessage())
+
+    def _onProbeDone(self, result):
+        self._active -= 1
+        self._next()
+
+    def _finish(self):
+        self.scanning = False
+        d, self._done = self._done, None
+        if d is not None:
+            d.callback(list(self.found))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Server side of the JSON-RPC protocol spoken by the thermostat firmware.
+
+Used for anything that must look like a thermostat to a client.RPCProtocol
+(ex. a device emulator or a gateway).
+
+"""
+import logging
+from twisted.internet.defer import maybeDeferred, succeed
+from twisted.internet.protocol import Factory, Protocol, connectionDone
+from framing import FrameTooLong
+from codec import lookup
+
+log = logging.getLogger("enaml")
+
+#: JSON-RPC 2.0 error codes
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INTERNAL_ERROR = -32603
+
+
+class RPCServerProtocol(Protocol, object):
+    """ Handles requests from a single client. Methods are looked up on the
+    factory as `rpc_<method>` and called with the request params, they may
+    return a Deferred. Batches are answered with a single array once every
+    call in it completes. Requests without an id get no response, just
+    like the firmware.
+
+    """
+    #: Max size of a single message in bytes
+    MAX_LENGTH = 16384
+
+    def connectionMade(self):
+        #: The codec is chosen by the factory
+        self.codec = lookup(self.factory.codec)
+        self._framer = self.codec.framer(self.MAX_LENGTH)
+        self.factory.clientConnected(self)
+
+    def connectionLost(self, reason=connectionDone):
+        self.factory.clientDisconnected(self)
+
+    def dataReceived(self, data):
+        try:
+            messages = self._framer.feed(data)
+        except FrameTooLong as e:
+            log.error("Client message too long: %s", e)
+            self.transport.loseConnection()
+            return
+        for msg in messages:
+            if isinstance(msg, list):
+                self.batchReceived(msg)
+            else:
+                self.requestReceived(msg).addCallback(self.sendMessage)
+
+    def batchReceived(self, requests):
+        """ Handle a batch of requests and send all the responses in a
+        single array.
+
+        """
+        responses = []
+        pending = [len(requests)]
+
+        def collect(response):
+            if response is not None:
+                responses.append(response)
+            pending[0] -= 1
+            if pending[0] == 0 and responses:
+                self.sendMessage(responses)
+
+        if not requests:
+            self.sendMessage(self.errorResponse(None, INVALID_REQUEST,
+                                                "Invalid Request."))
+            return
+        for request in requests:
+            self.requestReceived(request).addCallback(collect)
+
+    def requestReceived(self, request):
+        """ Process a single request. Returns a Deferred that fires with the
+        response or None if the request is a notification.
+
+        """
+        if not isinstance(request, dict) or 'method' not in request:
+            req_id = request.get('id') if isinstance(request, dict) else None
+            return succeed(self.errorResponse(req_id, INVALID_REQUEST,
+                                              "Invalid Request."))
+        req_id = request.get('id')
+        method = getattr(self.factory, 'rpc_{}'.format(request['method']),
+                         None)
+        if method is None:
+            if req_id is None:
+                return succeed(None)
+            return succeed(self.errorResponse(req_id, METHOD_NOT_FOUND,
+                                              "Method not found."))
+
+        params = request.get('params', {})
+        if isinstance(params, list):
+            d = maybeDeferred(method, *params)
+        else:
+            d = maybeDeferred(method, **params)
+
+        def on_result(result):
+            if req_id is None:
+                return None
+            return {'jsonrpc': '2.0', 'id': req_id, 'result': result}
+
+        def on_error(failure):
+            log.error("Error handling %s: %s", request,
+                      failure.getErrorMessage())
+            if req_id is None:
+                return None
+            return self.errorResponse(req_id, INTERNAL_ERROR,
+                                      failure.getErrorMessage())
+
+        return d.addCallbacks(on_result, on_error)
+
+    def errorResponse(self, req_id, code, message):
+        response = {'jsonrpc': '2.0', 'error': {'code': code,
+                                                'message': message}}
+        if req_id is not None:
+            response['id'] = req_id
+        return response
+
+    def sendMessage(self, msg):
+        """ Send a response or notification to the client """
+        if msg is not None and self.transport is not None:
+            self.transport.write(self.codec.encode(msg))
+
+
+class RPCServerFactory(Factory, object):
+    """ Keeps track of the connected clients so notifications can be sent to
+    all of them. Subclasses implement the API as `rpc_<method>` methods.
+
+    """
+    protocol = RPCServerProtocol
+
+    #: Wire codec spoken to the clients, see codec.py
+    codec = 'json'
+
+    def __init__(self):
+        self.clients = set()
+
+    def clientConnected(self, protocol):
+        self.clients.add(protocol)
+
+    def clientDisconnected(self, protocol):
+        self.clients.discard(protocol)
+
+    def notifyAll(self, msg):
+        """ Send a notification to every connected client """
+        for client in self.clients:
+            client.sendMessage(msg)
@@ -0,0 +1,598 @@
+# -*- coding: utf-8 -*-
+"""
+Shard a large fleet of thermostats over several processes to use every
+core.
+
+Everything a Thermostat does (framing, decoding, applying the state, it's
+observers and logging) runs on the reactor's thread so a single process
+can only use one core. The supervisor starts a number of worker processes
+which each run their own reactor and ThermostatPool, and assigns every
+device to the worker with the fewest devices.
+
+Workers talk to the supervisor over their stdin and stdout using the most
+compact codec installed (msgpack, otherwise json). Every report only has
+what each device reported since the last one.
+
+When a worker dies it's devices are assigned to the other workers and a
+new worker is started in it's place.
+
+A device given as ADDRESS=PORT is also served on the port by it's worker,
+like gateway.py does.
+
+Usage:
+
+    python src/shard.py --workers 4 192.168.1.101:8888 192.168.1.102:8888=9889
+    python src/shard.py --file devices.txt
+
+"""
+import os
+import sys
+import logging
+import argparse
+import multiprocessing
+from atom.api import Atom, Bool, Callable, Dict, Float, Instance, Int, List
+try:
+    from atom.api import Unicode
+except ImportError:
+    from atom.api import Str as Unicode
+from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
+from twisted.internet.protocol import Protocol, ProcessProtocol
+from twisted.internet.task import LoopingCall
+from client import NOTIFICATIONS
+from codec import available, lookup
+from framing import FrameTooLong
+from gateway import DeviceGateway, UpstreamThermostat
+from metrics import registry
+from pool import ThermostatPool
+from sync import diffState
+
+log = logging.getLogger("enaml")
+
+SHARD_DEVICES = registry.gauge(
+    'thermostat_shard_devices', "Devices assigned to each worker",
+    ('worker',))
+SHARD_CONNECTED = registry.gauge(
+    'thermostat_shard_connected', "Connected devices of each worker",
+    ('worker',))
+SHARD_NOTIFICATIONS = registry.counter(
+    'thermostat_shard_notifications_total',
+    "Notifications received by each worker", ('worker',))
+SHARD_RESTARTS = registry.counter(
+    'thermostat_shard_restarts_total', "Workers that died and were restarted")
+
+#: Codec of the channel between the supervisor and the workers
+CHANNEL_CODEC = 'msgpack' if 'msgpack' in available() else 'auto'
+
+#: Max size of a message on the channel
+MAX_LENGTH = 16*1024*1024
+
+
+# -----------------------------------------------------------------------------
+# Worker
+# -----------------------------------------------------------------------------
+class WorkerChannel(Protocol):
+    """ The worker's end of the channel (it's stdin and stdout) """
+
+    def __init__(self, worker, codec):
+        self.worker = worker
+        self.codec = lookup(codec)
+        self._framer = self.codec.framer(MAX_LENGTH)
+
+    def dataReceived(self, data):
+        try:
+            messages = self._framer.feed(data)
+        except FrameTooLong as e:
+            #: The stream can't be trusted anymore, the supervisor starts
+            #: a new worker
+            log.error("Message from the supervisor too long: %s", e)
+            self.transport.loseConnection()
+            return
+        for msg in messages:
+            self.worker.handle(msg)
+
+    def send(self, msg):
+        self.transport.write(self.codec.encode(msg))
+
+    def connectionLost(self, reason):
+        #: The supervisor is gone
+        log.info("Supervisor disconnected, stopping")
+        if reactor.running:
+            reactor.stop()
+
+
+class ShardWorker(Atom):
+    """ Runs the devices assigned to this process and reports their state """
+
+    #: Connections and heartbeats of the devices
+    pool = Instance(ThermostatPool)
+
+    #: Codec spoken to the clients of the served devices
+    codec = Unicode('json')
+
+    #: Interface the served devices listen on
+    interface = Unicode()
+
+    #: Seconds between reports
+    reportInterval = Float(1)
+
+    #: Channel to the supervisor
+    channel = Instance(object)
+
+    #: Last state sent to the supervisor by address
+    _reported = Dict()
+
+    #: Listening ports of the served devices by address
+    _ports = Dict()
+
+    #: Notifications counted in the last report
+    _notifications = Float()
+
+    _reporter = Instance(LoopingCall)
+
+    def _default_pool(self):
+        return ThermostatPool(thermostatClass=UpstreamThermostat)
+
+    def start(self):
+        self._reporter = LoopingCall(self.report)
+        self._reporter.start(self.reportInterval, now=False)
+
+    def handle(self, msg):
+        """ Handle a message from the supervisor. Any error is reported
+        to the supervisor instead of taking down the worker and all of it's
+        devices.
+
+        """
+        op = msg.get('op')
+        try:
+            if op == 'add':
+                self.add(msg['address'], msg.get('port'))
+            elif op == 'remove':
+                self.remove(msg['address'])
+            elif op == 'set':
+                self.setState(msg['address'], msg['state'])
+            else:
+                log.warning("Unknown message from the supervisor: %s", msg)
+        except Exception as e:
+            log.exception("Failed to handle %s", msg)
+            self.error(msg.get('address'), "{} failed: {}".format(op, e))
+
+    def error(self, address, message):
+        """ Report an error with a device to the supervisor """
+        self.channel.send({'op': 'error', 'address': address,
+                           'message': message})
+
+    def add(self, address, port=None):
+        t = self.pool.add(address)
+        if port and address not in self._ports:
+            #: The device is still run when it can't be served
+            try:
+                self._ports[address] = reactor.listenTCP(
+                    port, DeviceGateway(t, self.codec),
+                    interface=self.interface)
+            except CannotListenError as e:
+                log.error("Can't serve %s on port %s: %s", address, port, e)
+                self.error(address, "Can't serve on port {}: {}".format(
+                    port, e.socketError))
+                return
+            log.info("Serving %s on port %s", address, port)
+
+    def remove(self, address):
+        port = self._ports.pop(address, None)
+        if port is not None:
+            port.stopListening()
+        self.pool.remove(address)
+        self._reported.pop(address, None)
+
+    def setState(self, address, state):
+        """ Change members of the device, they are sent like any change
+        made to a Thermostat.
+
+        """
+        t = self.pool.get(address)
+        if t is None:
+            return
+        for k, v in state.items():
+            setattr(t, k, v)
+
+    def report(self):
+        """ Send what each device reported since the last report along with
+        the worker's stats.
+
+        """
+        devices = {}
+        reported = self._reported
+        connected = 0
+        for address, t in self.pool.thermostats.items():
+            state = dict(t._snapshot)
+            state['connected'] = t.connected
+            connected += t.connected
+            last = reported.get(address)
+            if last is None:
+                last = reported[address] = {}
+            changes = diffState(last, state)
+            if changes:
+                last.update(changes)
+                devices[address] = changes
+
+        total = NOTIFICATIONS.values.get((), 0)
+        stats = {'devices': len(self.pool.thermostats),
+                 'connected': connected,
+                 'notifications': total-self._notifications}
+        self._notifications = total
+        self.channel.send({'op': 'report', 'devices': devices,
+                           'stats': stats})
+
+
+def runWorker(args):
+    """ Entry point of the worker processes """
+    from twisted.internet.stdio import StandardIO
+    worker = ShardWorker(codec=args.codec, interface=args.interface,
+                         reportInterval=args.report)
+    worker.pool.heartbeatInterval = args.heartbeat
+    worker.channel = WorkerChannel(worker, args.channel)
+    StandardIO(worker.channel)
+
+    #: stdout is the channel, anything printed would corrupt it
+    sys.stdout = sys.stderr
+    worker.start()
+    reactor.run()
+
+
+# -----------------------------------------------------------------------------
+# Supervisor
+# -----------------------------------------------------------------------------
+class WorkerProcess(ProcessProtocol):
+    """ The supervisor's end of the channel to a worker """
+
+    def __init__(self, supervisor, index, codec):
+        self.supervisor = supervisor
+        self.index = index
+        self.codec = lookup(codec)
+        self._framer = self.codec.framer(MAX_LENGTH)
+
+    def outReceived(self, data):
+        try:
+            messages = self._framer.feed(data)
+        except FrameTooLong as e:
+            #: The stream can't be trusted anymore, restart the worker
+            log.error("Message from worker %s too long: %s", self.index, e)
+            self.transport.signalProcess('KILL')
+            return
+        for msg in messages:
+            self.supervisor.workerMessage(self, msg)
+
+    def send(self, msg):
+        self.transport.write(self.codec.encode(msg))
+
+    def processEnded(self, reason):
+        self.supervisor.workerEnded(self, reason)
+
+
+class ShardSupervisor(Atom):
+    """ Starts the workers, assigns the devices to them and collects the
+    state they report.
+
+    """
+    #: Number of worker processes
+    workers = Int()
+
+    #: Options of the workers, see ShardWorker
+    heartbeatInterval = Float(30)
+    reportInterval = Float(1)
+    codec = Unicode('json')
+    interface = Unicode()
+
+    #: Codec of the channel to the workers
+    channelCodec = Unicode(CHANNEL_CODEC)
+
+    #: Seconds before a worker that died is started again
+    restartDelay = Float(1)
+
+    #: Number of times a worker can die with a device that did not stay
+    #: connected before the device is no longer assigned (it's likely what
+    #: kills them)
+    maxWorkerDeaths = Int(3)
+
+    #: Seconds a device must stay connected to reset it's worker deaths
+    healthyAfter = Float(60)
+
+    #: Called with the address and changes when a device reports
+    listener = Callable()
+
+    #: Port each device is served on (or None) by address
+    devices = Dict()
+
+    #: Index of the worker each device is assigned to by address
+    assignments = Dict()
+
+    #: Last reported state of each device by address
+    state = Dict()
+
+    #: Last stats of each worker by index
+    stats = Dict()
+
+    #: Last error reported for each device by address
+    errors = Dict()
+
+    #: Running worker processes by index (None while restarting)
+    _processes = List()
+
+    #: Number of devices assigned to each worker
+    _load = List()
+
+    #: Workers that died with the device since it was last healthy by
+    #: address
+    _deaths = Dict()
+
+    #: Time each device with worker deaths was last seen connected since
+    _connectedSince = Dict()
+
+    _stopping = Bool()
+
+    def _default_workers(self):
+        return multiprocessing.cpu_count()
+
+    def start(self):
+        self._processes = [None]*self.workers
+        self._load = [0]*self.workers
+        for i in range(self.workers):
+            self._spawn(i)
+
+    def stop(self):
+        """ Stop the workers, they exit when their stdin is closed """
+        self._stopping = True
+        for p in self._processes:
+            if p is not None:
+                p.transport.closeStdin()
+
+    def _spawn(self, index):
+        if self._stopping:
+            return
+        p = WorkerProcess(self, index, self.channelCodec)
+        args = [sys.executable, os.path.abspath(__file__), '--worker',
+                '--channel', str(self.channelCodec),
+                '--codec', str(self.codec),
+                '--heartbeat', str(self.heartbeatInterval),
+                '--report', str(self.reportInterval)]
+        if self.interface:
+            args += ['--interface', str(self.interface)]
+        reactor.spawnProcess(p, sys.executable, args, env=os.environ,
+                             childFDs={0: 'w', 1: 'r', 2: 2})
+        self._processes[index] = p
+        log.info("Started worker %s", index)
+
+        #: Take any devices that could not be assigned
+        for address in self.devices:
+            if address not in self.assignments:
+                self._assign(address)
+        self._rebalance(index)
+
+    def _rebalance(self, index):
+        """ Move devices from the busiest workers to the given one until it
+        has it's share. Served devices are not moved since their port
+        can't be opened by the new worker until the old one closes it.
+
+        """
+        running = [i for i, p in enumerate(self._processes) if p is not None]
+        share = len(self.assignments)//len(running)
+        load = self._load
+        movable = {}
+        for address, i in self.assignments.items():
+            if i != index and not self.devices.get(address):
+                movable.setdefault(i, []).append(address)
+        while load[index] < share:
+            busiest = max(movable, key=lambda i: load[i]) if movable else None
+            if busiest is None or load[busiest] <= share:
+                break
+            address = movable[busiest].pop()
+            if not movable[busiest]:
+                del movable[busiest]
+            load[busiest] -= 1
+            self._processes[busiest].send({'op': 'remove',
+                                           'address': address})
+            del self.assignments[address]
+            self._assign(address)
+            self.state.get(address, {})['connected'] = False
+
+    # -------------------------------------------------------------------------
+    # Devices
+    # -------------------------------------------------------------------------
+    def add(self, address, port=None):
+        """ Add the device at the address (see client.connect) and serve it
+        on the port if given.
+
+        """
+        if address in self.devices:
+            return
+        self.devices[address] = port
+        self._assign(address)
+
+    def remove(self, address):
+        if address not in self.devices:
+            return
+        del self.devices[address]
+        self.state.pop(address, None)
+        self.errors.pop(address, None)
+        self._deaths.pop(address, None)
+        self._connectedSince.pop(address, None)
+        index = self.assignments.pop(address, None)
+        if index is not None:
+            self._load[index] -= 1
+            p = self._processes[index]
+            if p is not None:
+                p.send({'op': 'remove', 'address': address})
+
+    def setState(self, address, **state):
+        """ Change members of the device through it's worker """
+        index = self.assignments.get(address)
+        if index is None or self._processes[index] is None:
+            raise KeyError("{} is not assigned to a worker".format(address))
+        self._processes[index].send({'op': 'set', 'address': address,
+                                     'state': state})
+
+    def _assign(self, address):
+        """ Assign the device to the running worker with the least devices
+        """
+        if self._deaths.get(address, 0) >= self.maxWorkerDeaths:
+            return
+        running = [i for i, p in enumerate(self._processes) if p is not None]
+        if not running:
+            #: Assigned when a worker starts
+            return
+        index = min(running, key=lambda i: self._load[i])
+        self.assignments[address] = index
+        self._load[index] += 1
+        self._processes[index].send({'op': 'add', 'address': address,
+                                     'port': self.devices[address]})
+
+    # -------------------------------------------------------------------------
+    # Workers
+    # -------------------------------------------------------------------------
+    def workerMessage(self, process, msg):
+        op = msg.get('op')
+        if op == 'error':
+            address = msg.get('address')
+            log.error("Worker %s: %s: %s", process.index, address,
+                      msg.get('message'))
+            if address in self.devices:
+                self.errors[address] = msg.get('message')
+            return
+        elif op != 'report':
+            log.warning("Unknown message from worker %s: %s",
+                        process.index, msg)
+            return
+        index = process.index
+        state = self.state
+        listener = self.listener
+        for address, changes in msg['devices'].items():
+            #: Reports sent before the device was moved are stale
+            if self.assignments.get(address) != index:
+                continue
+            if address in state:
+                state[address].update(changes)
+            else:
+                state[address] = changes
+            if listener:
+                listener(address, changes)
+        self._checkHealthy(index)
+        stats = self.stats[index] = msg['stats']
+        label = str(index)
+        SHARD_DEVICES.set(stats['devices'], label)
+        SHARD_CONNECTED.set(stats['connected'], label)
+        SHARD_NOTIFICATIONS.inc(stats['notifications'], label)
+
+    def _checkHealthy(self, index):
+        """ Forget the worker deaths of the devices on the worker that
+        stayed connected for healthyAfter seconds.
+
+        """
+        now = reactor.seconds()
+        since = self._connectedSince
+        for address in list(self._deaths):
+            if self.assignments.get(address) != index:
+                continue
+            if not self.state.get(address, {}).get('connected'):
+                since.pop(address, None)
+            elif now-since.setdefault(address, now) >= self.healthyAfter:
+                del self._deaths[address]
+                del since[address]
+
+    def workerEnded(self, process, reason):
+        index = process.index
+        if self._processes[index] is not process:
+            return
+        self._processes[index] = None
+        self._load[index] = 0
+        self.stats.pop(index, None)
+        SHARD_DEVICES.set(0, str(index))
+        SHARD_CONNECTED.set(0, str(index))
+        if self._stopping:
+            return
+        log.warning("Worker %s died: %s", index, reason.getErrorMessage())
+        SHARD_RESTARTS.inc()
+
+        #: Move it's devices to the other workers
+        orphans = [address for address, i in self.assignments.items()
+                   if i == index]
+        deaths = self._deaths
+        for address in orphans:
+            del self.assignments[address]
+            if address in self.state:
+                self.state[address]['connected'] = False
+            deaths[address] = deaths.get(address, 0)+1
+            self._connectedSince.pop(address, None)
+            if deaths[address] == self.maxWorkerDeaths:
+                log.error("%s was on %s workers that died, it's no longer "
+                          "assigned", address, deaths[address])
+                self.errors[address] = "Killed {} workers".format(
+                    deaths[address])
+        for address in orphans:
+            self._assign(address)
+        reactor.callLater(self.restartDelay, self._spawn, index)
+
+
+def main():
+    doc = __doc__.strip().split("\n\n")[0]
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('devices', nargs='*', metavar='ADDRESS[=PORT]',
+                        help="Device address (see gateway.py) and the port "
+                             "to serve it on if any")
+    parser.add_argument('--file', help="File with a device on each line")
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of worker processes (default the "
+                             "number of cores)")
+    parser.add_argument('--interface', default='',
+                        help="Interface the served devices listen on")
+    parser.add_argument('--heartbeat', type=float, default=30,
+                        help="Seconds between state syncs with each device")
+    parser.add_argument('--report', type=float, default=1,
+                        help="Seconds between reports of the workers")
+    parser.add_argument('--codec', default='json',
+                        help="Codec spoken to the clients (default json)")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="Serve the metrics on this port")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--worker', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--channel', default=CHANNEL_CODEC,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+    if args.worker:
+        return runWorker(args)
+
+    specs = list(args.devices)
+    if args.file:
+        with open(args.file) as f:
+            specs += [line.strip() for line in f
+                      if line.strip() and not line.startswith('#')]
+    if not specs:
+        parser.error("No devices given")
+    try:
+        lookup(args.codec)
+    except LookupError as e:
+        parser.error(str(e))
+
+    supervisor = ShardSupervisor(
+        workers=args.workers, heartbeatInterval=args.heartbeat,
+        reportInterval=args.report, codec=args.codec,
+        interface=args.interface)
+    supervisor.start()
+    for spec in specs:
+        address, _, port = spec.partition('=')
+        try:
+            supervisor.add(address, int(port) if port else None)
+        except ValueError:
+            parser.error("Invalid device {}".format(spec))
+    if args.metrics_port:
+        import metrics
+        metrics.listen(args.metrics_port)
+    reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""
+State sync logic shared by the Twisted (client.py) and asyncio (aioclient.py)
+clients. Nothing here depends on an event loop, the clients provide the
+clock and timers and do the actual RPC calls.
+
+"""
+import math
+import logging
+from collections import OrderedDict
+from atom.api import (
+    Atom, FloatRange, Callable, Float, Enum, Int, Bool, Instance, Dict
+)
+try:
+    from atom.api import Unicode
+except ImportError:
+    #: Newer versions of atom (used by aioclient on python 3) renamed it
+    from atom.api import Str as Unicode
+
+log = logging.getLogger("enaml")
+
+#: Remote methods registered by the firmware (see registerProcs in
+#: arduino/Thermo/Thermo.ino) and the params each of them reads
+METHODS = {
+    'getState': frozenset(),
+    'setState': frozenset([
+        'tempPin1', 'tempPin2', 'ledPin', 'fanPin', 'fireplacePin',
+        'heatPin', 'coolPin', 'ledActive', 'fanActive', 'heatActive',
+        'coolActive', 'fireplaceActive', 'hysteresisTemp', 'desiredTemp',
+        'systemMode', 'heatMode', 'fanMode', 'tempSensor1Present',
+        'tempSensor2Present', 'fanPresent', 'fireplacePresent',
+        'heatPresent', 'coolPresent', 'configured', 'wifiSsid', 'wifiPass',
+        'loading',
+    ]),
+}
+
+
+def diffState(old, new):
+    """ Return the items in the new state that differ from the old one.
+    NaN values are considered equal to each other.
+
+    """
+    changes = {}
+    for k, v in new.items():
+        if k in old:
+            v0 = old[k]
+            if v0 == v:
+                continue
+            if (isinstance(v, float) and isinstance(v0, float) and
+                    math.isnan(v) and math.isnan(v0)):
+                continue
+        changes[k] = v
+    return changes
+
+
+def sameValue(a, b, precision=12):
+    """ Whether two state values are equal, floats are compared at the
+    given precision and NaN values are equal to each other.
+
+    """
+    if isinstance(a, float) and isinstance(b, float):
+        if math.isnan(a) or math.isnan(b):
+            return math.isnan(a) and math.isnan(b)
+        return round(a, precision) == round(b, precision)
+    return a == b
+
+
+class RPCError(Exception):
+    pass
+
+
+class RPCMixin(object):
+    """ Builds the JSON-RPC requests and reads the responses.
+
+    Any attribute that is not defined is a remote method. The stub that
+    calls it is made by `_makeStub` the first time it's used and added to
+    the class so later calls are plain method lookups. Params of the
+    declared `methods` are checked before anything is sent, others are
+    sent as is.
+
+    """
+    #: Declared remote methods and the names of their params
+    methods = METHODS
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        cls = type(self)
+        setattr(cls, attr, cls._makeStub(attr))
+        return getattr(self, attr)
+
+    @classmethod
+    def _makeStub(cls, method):
+        """ Return a function that calls the remote method """
+        raise NotImplementedError
+
+    def _buildRequest(self, method, args, kwargs):
+        """ Create a request for the given method and params """
+        if args and kwargs:
+            raise RPCError("Can only do RPC calls with either args or "
+                           "kwargs, not both.")
+        allowed = self.methods.get(method)
+        if allowed is not None:
+            if args:
+                raise RPCError("{} only takes keyword params".format(method))
+            for k in kwargs:
+                if k not in allowed:
+                    raise RPCError("{} got an unexpected param {}".format(
+                        method, k))
+        params = args or kwargs
+        self._id += 1
+        request = {'method': method, 'id': self._id, 'jsonrpc': '2.0'}
+        if params:
+            request['params'] = params
+        return request
+
+    def _getResult(self, response):
+        """ Get the result from a response or raise an RPCError """
+        if 'result' in response:
+            return response['result']
+        raise RPCError(response.get('error'))
+
+
+class ThermostatState(Atom):
+    """ The state of a thermostat and the logic to keep it in sync with the
+    device. Subclasses must implement `now`, `callLater`, `cancelCall`,
+    `flushChanges` and `syncState`.
+
+    """
+    #: Used to block sending updates
+    _syncing = Bool()
+
+    #: Validation precision for floats
+    _precision = Int(12)
+
+    #: Seconds between state syncs when the heartbeat is running
+    heartbeatInterval = Float(30).tag(local=True)
+
+    #: Seconds to collect member changes before sending them all in a
+    #: single setState call. Zero sends them on the next reactor iteration.
+    writeDelay = Float(0).tag(local=True)
+
+    #: How the state is applied on each sync. In "delta" mode only values
+    #: that differ from the last state reported by the device are set.
+    syncMode = Enum("delta", "full").tag(local=True)
+
+    #: In delta mode, skip pulling the state on a heartbeat when a
+    #: notification arrived within this many seconds (it shows the link is
+    #: alive and the state is current). Zero always pulls.
+    notifyWindow = Float(10).tag(local=True)
+
+    #: Max seconds between full state pulls when they are being skipped
+    fullSyncInterval = Float(300).tag(local=True)
+
+    #: Seconds changes made while disconnected are kept to be sent once
+    #: connected again. Zero drops them.
+    outboxExpiry = Float(300).tag(local=True)
+
+    #: Notifications are buffered and applied together once per frame of
+    #: this many seconds. Repeated updates of a member within a frame are
+    #: collapsed into one.
+    frameInterval = Float(0.2).tag(local=True)
+
+    #: Updates of these members smaller than the given amount are ignored
+    deadbands = Dict(default={
+        'insideTemp': 0.05,
+        'insideHumidity': 0.1,
+        'outsideTemp': 0.05,
+        'outsideHumidity': 0.1,
+    }).tag(local=True)
+
+    #: Last state reported by the device
+    _snapshot = Dict()
+
+    #: Time the last notification was received and state was pulled
+    _lastNotify = Float()
+    _lastSync = Float()
+
+    #: Time the pulled state was last compared against every member
+    _lastFullSync = Float()
+
+    #: Changes waiting to be sent, maps the name to (value, oldvalue)
+    _pending = Instance(OrderedDict, ())
+    _flushCall = Instance(object)
+
+    #: Changes made while disconnected, maps the name to (value, the last
+    #: value reported by the device or None, time of the change)
+    _outbox = Instance(OrderedDict, ())
+
+    #: Notifications waiting to be applied by member name
+    _notified = Instance(OrderedDict, ())
+    _applyCall = Instance(object)
+
+    #: Wire codec used when connecting, see codec.py. The firmware only
+    #: speaks JSON, others are for links to a gateway.
+    codec = Unicode('json').tag(local=True)
+
+    #: Connected flag
+    connected = Bool().tag(local=True)
+
+    #: Status / error messges
+    status = Unicode().tag(local=True)
+
+    #: State variables
+    tempPin1 = Int(6)
+    tempPin2 = Int(7)
+    ledPin = Int(13)
+    fanPin = Int(9)
+    fireplacePin = Int(10)
+    heatPin = Int(11)
+    coolPin = Int(12)
+
+    ledActive = Bool()
+    fireplaceActive = Bool()
+    fanActive = Bool()
+    heatActive = Bool()
+    coolActive = Bool()
+    hysteresisTemp = FloatRange(low=0.2, high=10.0, value=0.6)
+    desiredTemp = Float(24.0)
+    insideTemp = Float(24.0).tag(readonly=True)
+    insideHumidity = Float(50.0).tag(readonly=True)
+    outsideTemp = Float(24.0).tag(readonly=True)
+    outsideHumidity = Float(50.0).tag(readonly=True)
+
+    wifiSsid = Unicode()
+    wifiPass = Unicode()
+    wifiIp = Unicode()
+
+    fanPresent = Bool()
+    fireplacePresent = Bool()
+    heatPresent = Bool()
+    coolPresent = Bool()
+
+    heatMode = Enum("furnace", "fireplace")
+    fanMode = Enum("off", "auto")
+    systemMode = Enum("off", "heat", "cool")
+    version = Unicode()
+
+    #: Listen to messages
+    listener = Callable().tag(local=True)
+
+    def __init__(self, *args, **kwargs):
+        super(ThermostatState, self).__init__(*args, **kwargs)
+        self.bindObservers()
+
+    # -------------------------------------------------------------------------
+    # Event loop
+    # -------------------------------------------------------------------------
+    def now(self):
+        """ Return the event loop's time in seconds """
+        raise NotImplementedError
+
+    def callLater(self, delay, f):
+        """ Call f after the delay, returns a handle for cancelCall """
+        raise NotImplementedError
+
+    def cancelCall(self, call):
+        """ Cancel a call from callLater if it has not run yet """
+        raise NotImplementedError
+
+    def flushChanges(self):
+        """ Send the pending changes, see takeChanges and verifyChanges """
+        raise NotImplementedError
+
+    def syncState(self):
+        """ Pull the state if needsSync and apply it """
+        raise NotImplementedError
+
+    # -------------------------------------------------------------------------
+    # Sync logic
+    # -------------------------------------------------------------------------
+    def bindObservers(self):
+        """ Bind _on_change to any members not tagged as readonly. Each
+            member is read first so it's default is never reported as a
+            change.
+        """
+        for name, m in self.members().items():
+            if ((m.metadata and
+                     (m.metadata.get('readonly', False) or
+                      m.metadata.get('local', False)))
+                    or name.startswith("_")):
+                continue
+            getattr(self, name)
+            self.observe(name, self.onChange)
+
+    def resetState(self):
+        """ Called when connected. Local values may have changed while
+            disconnected so the first sync must apply everything.
+        """
+        self._snapshot = {}
+
+    def needsSync(self, now):
+        """ Whether the heartbeat at the given time must pull the state """
+        return not (self.syncMode == "delta" and self._snapshot and
+                    now-self._lastNotify < self.notifyWindow and
+                    now-self._lastSync < self.fullSyncInterval)
+
+    def applyState(self, state):
+        """ Apply the state reported by the device. In delta mode only the
+            values that changed since the last reported state are set,
+            once every fullSyncInterval the state is compared against the
+            members instead so any local value that differs from the
+            device (ex. a change that was never sent) is corrected.
+            @param state: state dict from the thermostat
+        """
+        now = self.now()
+        #: Reading a member for the first time creates it's default which
+        #: must not be sent either
+        self._syncing = True
+        try:
+            if self.syncMode == "full":
+                changes = state
+            elif now-self._lastFullSync >= self.fullSyncInterval:
+                self._lastFullSync = now
+                prec = self._precision
+                pending = self._pending
+                changes = {k: v for k, v in state.items()
+                           if k not in pending and hasattr(self, k) and
+                           not sameValue(getattr(self, k), v, prec)}
+            else:
+                changes = diffState(self._snapshot, state)
+            self._snapshot.update(state)
+            for k, v in changes.items():
+                if hasattr(self, k):
+                    try:
+                        setattr(self, k, v)
+                    except Exception as e:
+                        log.warning("Failed to sync with thermostat: "
+                                    "%s %s", k, v)
+        finally:
+            self._syncing = False
+
+    def onChange(self, change):
+        """ Called when one of the members changes.
+            Queues the change to be sent to the Thermostat. Changes made
+            within the writeDelay are merged into a single setState call.
+            Changes made while disconnected go to the outbox.
+            @param change: member change dict from this object
+        """
+        if self.listener:
+            self.listener(change)
+        if self._syncing or change['type'] != 'update':
+            #: Only changes that were made are sent, not defaults created
+            #: when a member is first read
+            return
+        if not self.connected:
+            self.queueOffline(change['name'], change['value'])
+        else:
+            k = change['name']
+            if k in self._pending:
+                #: Keep the original value in case it must be undone
+                oldvalue = self._pending[k][1]
+            else:
+                oldvalue = change['oldvalue']
+            self._pending[k] = (change['value'], oldvalue)
+            if self._flushCall is None:
+                self._flushCall = self.callLater(self.writeDelay,
+                                                 self.flushChanges)
+
+    def queueOffline(self, name, value):
+        """ Add a change to the outbox, only the last value of each member
+            is kept. It's compared against the last value the device
+            reported when it's sent, see takeOutbox.
+        """
+        if not self.outboxExpiry or name not in METHODS['setState']:
+            return
+        entry = self._outbox.pop(name, None)
+        base = self._snapshot.get(name) if entry is None else entry[1]
+        self._outbox[name] = (value, base, self.now())
+
+    def requeueChanges(self, changes, error):
+        """ Put changes that could not be sent back in the outbox. Changes
+            the device rejected are undone.
+        """
+        if isinstance(error, RPCError):
+            self.undoChanges([(k, oldvalue)
+                              for k, (v, oldvalue) in changes.items()
+                              if oldvalue is not None])
+            return
+        for k, (v, oldvalue) in changes.items():
+            if k not in self._outbox:
+                self.queueOffline(k, v)
+
+    def takeOutbox(self, state):
+        """ Called with the device's state when connected. Removes the
+            changes from the outbox and returns the ones to send as name to
+            (value, device value). Expired changes and ones the device
+            changed to something else in the meantime are dropped and the
+            device's state is applied for every member that is not sent.
+        """
+        outbox, self._outbox = self._outbox, OrderedDict()
+        changes = OrderedDict()
+        expired = self.now()-self.outboxExpiry
+        prec = self._precision
+        for k, (v, base, t) in outbox.items():
+            current = state.get(k, base)
+            if t < expired:
+                log.warning("Discarding change to %s made while "
+                            "disconnected, it expired", k)
+            elif (base is not None and
+                    not sameValue(current, base, prec) and
+                    not sameValue(current, v, prec)):
+                log.warning("Discarding change to %s made while "
+                            "disconnected, the thermostat changed it from "
+                            "%s to %s", k, base, current)
+            elif not sameValue(current, v, prec):
+                changes[k] = (v, current)
+        self.applyState({k: v for k, v in state.items()
+                         if k not in changes})
+        return changes
+
+    def takeChanges(self):
+        """ Remove and return the pending changes as an OrderedDict of
+            name to (value, oldvalue).
+        """
+        if self._flushCall is not None:
+            self.cancelCall(self._flushCall)
+        self._flushCall = None
+        changes, self._pending = self._pending, OrderedDict()
+        return changes
+
+    def verifyChanges(self, changes, state):
+        """ Check each change against the state returned by setState and
+            undo the ones that failed.
+        """
+        self._snapshot.update(state)
+
+        #: Verify each change
+        failed = []
+        prec = self._precision
+        for k, (v, oldvalue) in changes.items():
+            result = state.get(k, oldvalue)
+
+            #: Special case for float rounding errors
+            ok = True
+            if type(result) == float:
+                if round(result, prec) != round(v, prec):
+                    ok = False
+            elif result != v:
+                ok = False
+
+            if not ok:
+                log.error("Failed to update value %s to %s, got %s",
+                          k, v, result)
+                if oldvalue is not None:
+                    failed.append((k, oldvalue))
+
+        #: Undo failed changes in UI
+        self.undoChanges(failed)
+
+    def undoChanges(self, changes):
+        """ Set the members back to their old values without sending them.
+            @param changes: list of (name, oldvalue)
+        """
+        if not changes:
+            return
+        self._syncing = True
+        try:
+            for k, oldvalue in changes:
+                setattr(self, k, oldvalue)
+        finally:
+            self._syncing = False
+
+    def onNotify(self, change):
+        """ Called when a notification is received from the thermostat.
+            Buffers updates until the next frame, see applyNotifications.
+            @param change: member change dict from thermostat
+        """
+        if change.get('type', None) != 'update':
+            if self.listener:
+                self.listener(change)
+            return
+        k = change['name']
+        self._lastNotify = self.now()
+        self._snapshot[k] = change['value']
+        buffered = self._notified.get(k)
+        if buffered is not None:
+            #: Collapse into a single change from the first old value
+            change = dict(change, old=buffered.get('old'))
+        self._notified[k] = change
+        if self._applyCall is None:
+            self._applyCall = self.callLater(self.frameInterval,
+                                             self.applyNotifications)
+
+    def applyNotifications(self):
+        """ Set all the buffered updates at once. Updates within the
+            member's deadband of the current value are dropped.
+        """
+        self._applyCall = None
+        changes, self._notified = self._notified, OrderedDict()
+        deadbands = self.deadbands
+        self._syncing = True
+        try:
+            for k, change in changes.items():
+                v = change['value']
+                # Discard all nan values
+                if isinstance(v, float) and math.isnan(v):
+                    continue
+                if not hasattr(self, k):
+                    continue
+                deadband = deadbands.get(k)
+                if deadband and abs(v-getattr(self, k)) < deadband:
+                    continue
+                if self.listener:
+                    self.listener(change)
+                try:
+                    setattr(self, k, v)
+                except Exception as e:
+                    log.error("Failed to sync with thermostat: %s %s", k, v)
+        finally:
+            self._syncing = False
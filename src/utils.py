@@ -1,8 +1,14 @@
 import os
 import sys
+import zlib
+import struct
 import cPickle as pickle
-from atom.api import Atom, Constant, Int, List, Member
+from atom.api import Atom, Constant, Enum, Instance, Int, List, Member
 from enaml.application import timed_call
+from metrics import registry
+
+STATE_SAVE = registry.histogram(
+    'state_save_seconds', "Time taken to save the app state", ('kind',))
 
 
 def clip(s, n=16):
@@ -19,15 +25,16 @@ class Model(Atom):
 
     def __getstate__(self):
         """ Exclude any members from the state that are
-        tagged with `persist=False`.
+        tagged with `persist=False`. They are not read so any defaults
+        that were not needed yet are not created.
 
         """
-        state = super(Model, self).__getstate__()
+        state = {}
         for name, member in self.members().items():
             metadata = member.metadata
-            if name in state and metadata and \
-                    not metadata.get('persist', True):
-                del state[name]
+            if metadata and not metadata.get('persist', True):
+                continue
+            state[name] = getattr(self, name)
         return state
 
     def __setstate__(self, state):
@@ -49,18 +56,43 @@ class State(Model):
     """ An Atom object that automatically saves and restores it's state
     when a member changes. Saves are queued and fired once to reduce save
 
+    Only the members that changed are appended to a journal file. Once the
+    journal grows past `_state_journal_limit` it is compacted into a full
+    snapshot which is written to a temporary file and renamed over the
+    state file so a crash mid-write never loses the previous state.
+
     """
     _instance = None
 
+    #: Journal record header (length, crc32 of the data)
+    _journal_header = struct.Struct('<II')
+
     #: File where state is saved within the assets folder
     #: relative to assets/python. By default this is outside the python
     #: folder so it is not overwritten when a new version of the app
     #: is installed (ex. otherwise when you push an update to the Play store
     #: it will overwrite the users saved state!)
-    _state_file = Constant(os.path.join(sys.path[0], '../state.db'))
+    _state_file = Constant(os.path.join(sys.path[0], '../state.db')).tag(
+        persist=False)
+
+    #: Changes since the last snapshot are appended to this file
+    _state_journal = Constant(os.path.join(sys.path[0], '../state.journal')
+                              ).tag(persist=False)
+
+    #: Size of the journal in bytes that triggers a compaction
+    _state_journal_limit = Int(64*1024).tag(persist=False)
+
+    #: When to fsync. Either after every journal write and snapshot
+    #: ('always'), only after writing a snapshot ('compact') or leave it
+    #: to the OS ('never').
+    _state_fsync = Enum('compact', 'always', 'never').tag(persist=False)
+
     _state_save_pending = Int().tag(persist=False)
     _state_members = List(Member).tag(persist=False)
 
+    #: Names of members changed since the last save
+    _state_dirty = Instance(set, ()).tag(persist=False)
+
     @classmethod
     def instance(cls):
         """ Get an instance of this object """
@@ -83,7 +115,7 @@ class State(Model):
     # State API
     # -------------------------------------------------------------------------
     def save(self):
-        """ Manually trigger a save """
+        """ Manually trigger a save, this writes a full snapshot """
         self._queue_save_state({'type': 'manual'})
 
     def _bind_observers(self):
@@ -99,8 +131,7 @@ class State(Model):
 
         #: Load the state from disk
         try:
-            with open(self._state_file, 'rb') as f:
-                state = pickle.load(f)
+            state = self._load_state()
 
             #: Delete anything that may have changed
             for k, v in state.items():
@@ -122,6 +153,7 @@ class State(Model):
 
         """
         if change['type'] in ['update', 'manual', 'container']:
+            self._state_dirty.add(change.get('name'))
             self._state_save_pending += 1
             timed_call(350, self._save_state, change)
 
@@ -141,18 +173,124 @@ class State(Model):
 
             #: Dump first so any failure to encode doesn't wipe out the
             #: previous state
-
+            dirty, self._state_dirty = self._state_dirty, set()
             state = self.__getstate__()
-            for k in state:
-                if k in self._state_members:
+            persistent_members = set(m.name for m in self._state_members)
+            for k in list(state.keys()):
+                if k not in persistent_members:
                     del state[k]
-            state = pickle.dumps(state)
 
-            with open(self._state_file, 'wb') as f:
-                f.write(state)
+            #: A manual save or a journal that grew too large is compacted
+            #: into a new snapshot
+            if (None in dirty or not os.path.exists(self._state_file) or
+                    self._journal_size() >= self._state_journal_limit):
+                with STATE_SAVE.time('snapshot'):
+                    self._write_snapshot(state)
+            else:
+                with STATE_SAVE.time('journal'):
+                    self._append_journal({k: state[k] for k in dirty
+                                          if k in state})
         except Exception as e:
             print("Failed to save state: {}".format(e))
 
+    def _load_state(self):
+        """ Load the last snapshot and replay the journal over it. Replay
+        stops at the first incomplete or corrupt record (ex. from a crash
+        during a write) and the journal is truncated there so records
+        appended later are not lost behind it. A journal that was written
+        for a different snapshot (ex. from a crash while compacting) is
+        discarded.
+
+        """
+        state = {}
+        snapshot = None
+        if os.path.exists(self._state_file):
+            with open(self._state_file, 'rb') as f:
+                data = f.read()
+            snapshot = zlib.crc32(data) & 0xffffffff
+            state = pickle.loads(data)
+        if not os.path.exists(self._state_journal):
+            return state
+        header = self._journal_header
+        end = 0
+        with open(self._state_journal, 'rb') as f:
+            while True:
+                data = f.read(header.size)
+                if len(data) < header.size:
+                    break
+                length, crc = header.unpack(data)
+                if length == 0:
+                    #: The journal header has the crc of it's snapshot
+                    if end == 0 and crc == snapshot:
+                        end = f.tell()
+                        continue
+                    print("Discarding state journal of another snapshot")
+                    self._reset_journal(snapshot)
+                    return state
+                data = f.read(length)
+                if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                    break
+                state.update(pickle.loads(data))
+                end = f.tell()
+        if self._journal_size() != end:
+            print("Discarding corrupt state journal record")
+            with open(self._state_journal, 'r+b') as f:
+                f.truncate(end)
+        return state
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self._state_journal)
+        except OSError:
+            return 0
+
+    def _append_journal(self, changes):
+        """ Append a record of the changed members to the journal """
+        if not changes:
+            return
+        data = pickle.dumps(changes, pickle.HIGHEST_PROTOCOL)
+        record = self._journal_header.pack(
+            len(data), zlib.crc32(data) & 0xffffffff) + data
+        with open(self._state_journal, 'ab') as f:
+            f.write(record)
+            if self._state_fsync == 'always':
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _reset_journal(self, snapshot=None):
+        """ Clear the journal and start it with a header that has the crc
+        of the snapshot it follows.
+
+        """
+        with open(self._state_journal, 'wb') as f:
+            if snapshot is not None:
+                f.write(self._journal_header.pack(0, snapshot))
+
+    def _write_snapshot(self, state):
+        """ Write the full state to a temporary file and rename it over
+        the state file, then clear the journal. A crash before the journal
+        is cleared leaves a journal of the previous snapshot which is
+        discarded when loading.
+
+        """
+        data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        path = self._state_file
+        tmp = '{}.tmp'.format(path)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            if self._state_fsync != 'never':
+                f.flush()
+                os.fsync(f.fileno())
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            #: Windows does not allow renaming over an existing file
+            os.remove(path)
+            os.rename(tmp, path)
+
+        #: Everything in the journal is now in the snapshot
+        self._reset_journal(zlib.crc32(data) & 0xffffffff)
+
     def _unbind_observers(self):
         """ Stop observing the state. """
         for member in self._state_members: